@@ -0,0 +1,167 @@
+"""
+asyncio data access for the FastAPI endpoints.
+
+Read helpers mirroring the getters in utils on top of one asyncpg pool per API process,
+so hot read endpoints can be `async def` and don't occupy a threadpool slot while
+waiting on Postgres. Queries use bind parameters instead of string formatting. Writes
+stay with the sync helpers in utils, which also write statuses through to Redis and
+cascade them to attached jobs.
+"""
+import os
+
+import asyncpg
+
+from schemas import Coordinate
+
+_pool = None
+
+
+async def init_pool():
+    global _pool
+    if _pool is None:
+        _pool = await asyncpg.create_pool(
+            host=os.getenv("PSDB_HOST"),
+            port=os.getenv("PSDB_PORT"),
+            user=os.getenv("PSDB_USER"),
+            password=os.getenv("PSDB_PASSWORD"),
+            database=os.getenv("PSDB_DBNAME"),
+            min_size=int(os.getenv("PSDB_ASYNC_POOL_MIN") or 1),
+            max_size=int(os.getenv("PSDB_ASYNC_POOL_MAX") or 10),
+        )
+    return _pool
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def get_pool():
+    if _pool is None:
+        raise RuntimeError("The async database pool has not been initialised")
+    return _pool
+
+
+async def get_pdb_coordinate(pool, uid):
+    record = await pool.fetchrow(
+        """SELECT end_lat, end_lon, start_lat, start_lon FROM xviewui_coordinates
+        WHERE uid = $1;""",
+        str(uid),
+    )
+
+    if record is None:
+        return None
+
+    return Coordinate(
+        end_lat=record["end_lat"],
+        end_lon=record["end_lon"],
+        start_lat=record["start_lat"],
+        start_lon=record["start_lon"],
+    )
+
+
+async def get_pdb_status(pool, uid):
+    return await pool.fetchval(
+        "SELECT status FROM xviewui_status WHERE uid = $1;", str(uid)
+    )
+
+
+async def get_pdb_results_version(pool, uid):
+    """Bumped whenever the job's OSM or result polygons are replaced."""
+    return await pool.fetchval(
+        "SELECT results_version FROM xviewui_status WHERE uid = $1;", str(uid)
+    )
+
+
+# Each query returns one GeoJSON Feature per row as text, built by PostGIS, so the
+# endpoints can stream the FeatureCollection without materialising Python objects
+OSM_POLYGON_FEATURES_SQL = """
+    SELECT '{"type": "Feature", "geometry": ' || ST_AsGeoJSON(geometry)
+        || ', "properties": {}}'
+    FROM xviewui_osm_polys WHERE uid = $1
+"""
+
+RESULT_FEATURES_SQL = """
+    SELECT '{"type": "Feature", "geometry": ' || ST_AsGeoJSON(geometry)
+        || ', "properties": ' || json_build_object('dmg', dmg)::text || '}'
+    FROM xviewui_results WHERE uid = $1
+"""
+
+
+async def has_pdb_osm_polygons(pool, uid):
+    return await pool.fetchval(
+        "SELECT EXISTS(SELECT 1 FROM xviewui_osm_polys WHERE uid = $1);", str(uid)
+    )
+
+
+async def stream_feature_collection(pool, features_sql, uid, prefix=b"", suffix=b"", batch_rows=2000):
+    """
+    Yields a GeoJSON FeatureCollection as bytes, batch_rows features at a time, from a
+    server-side cursor over features_sql. prefix/suffix wrap the collection, e.g. to
+    nest it in a larger JSON document.
+    """
+    async with pool.acquire() as conn:
+        # Cursors only live inside a transaction
+        async with conn.transaction():
+            yield prefix + b'{"type": "FeatureCollection", "features": ['
+
+            sep = ""
+            batch = []
+            async for record in conn.cursor(features_sql, str(uid), prefetch=batch_rows):
+                batch.append(sep + record[0])
+                sep = ", "
+                if len(batch) >= batch_rows:
+                    yield "".join(batch).encode()
+                    batch = []
+            if batch:
+                yield "".join(batch).encode()
+
+            yield b"]}" + suffix
+
+
+# Both layers are clipped to the tile with ST_AsMVTGeom. Rows are prefiltered in EPSG
+# 4326 against the tile envelope, grown by the same 256/4096 buffer ST_AsMVTGeom keeps
+MVT_SQL = """
+    WITH envelope AS (
+        SELECT ST_TileEnvelope($2, $3, $4) AS tile
+    ),
+    bounds AS (
+        SELECT tile,
+            ST_Transform(
+                ST_Expand(tile, (ST_XMax(tile) - ST_XMin(tile)) * 256 / 4096), 4326
+            ) AS filter
+        FROM envelope
+    ),
+    assessment AS (
+        SELECT ST_AsMVTGeom(ST_Transform(r.geometry, 3857), bounds.tile) AS geom,
+            r.dmg, r.area, r.osmid
+        FROM xviewui_results r, bounds
+        WHERE r.uid = $1 AND r.geometry && bounds.filter
+    ),
+    osm AS (
+        SELECT ST_AsMVTGeom(ST_Transform(o.geometry, 3857), bounds.tile) AS geom,
+            o.osmid
+        FROM xviewui_osm_polys o, bounds
+        WHERE o.uid = $1 AND o.geometry && bounds.filter
+    )
+    SELECT
+        COALESCE(
+            (SELECT ST_AsMVT(assessment, 'assessment', 4096, 'geom')
+            FROM assessment WHERE geom IS NOT NULL),
+            ''::bytea
+        )
+        || COALESCE(
+            (SELECT ST_AsMVT(osm, 'osm', 4096, 'geom') FROM osm WHERE geom IS NOT NULL),
+            ''::bytea
+        )
+"""
+
+
+async def get_pdb_mvt(pool, uid, z, x, y):
+    """
+    Returns the Mapbox vector tile for z/x/y with an `assessment` layer (dmg, area,
+    osmid) and an `osm` layer (osmid) for the job. Empty if neither has features there.
+    """
+    return await pool.fetchval(MVT_SQL, str(uid), z, x, y)
@@ -0,0 +1,90 @@
+"""
+Compares GeoDataFrame.to_postgis with the COPY based replace_pdb_job_polygons for
+loading a job's polygons into PostGIS.
+
+Writes synthetic building footprints into a scratch copy of xviewui_results, which is
+dropped afterwards. Uses the PSDB_* settings from .env. Run from the project directory:
+    python benchmarks/bench_ingest.py --rows 100000
+"""
+import argparse
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from dotenv import load_dotenv  # noqa: E402
+
+from utils import (  # noqa: E402
+    pdb_connection,
+    rdspostgis_sa_client,
+    replace_pdb_job_polygons,
+)
+
+TABLE = "xviewui_bench_results"
+
+
+def synthetic_polygons(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(30.4, 30.6, rows)
+    y = rng.uniform(50.4, 50.5, rows)
+    size = rng.uniform(5e-5, 2e-4, rows)
+    boxes = shapely.box(x, y, x + size, y + size)
+    return gpd.GeoDataFrame(
+        {
+            "osmid": np.arange(rows).astype(str),
+            "dmg": rng.uniform(0, 1, rows).astype("float32"),
+            "area": shapely.area(boxes),
+        },
+        geometry=shapely.multipolygons(boxes[:, None]),
+        crs=4326,
+    )
+
+
+def with_to_postgis(gdf, job_id):
+    gdf = gdf.copy()
+    gdf["uid"] = job_id
+    gdf.to_postgis(TABLE, rdspostgis_sa_client(), if_exists="append")
+
+
+def with_copy(gdf, job_id):
+    with pdb_connection() as conn:
+        replace_pdb_job_polygons(conn, TABLE, job_id, gdf, ["osmid", "dmg", "area"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    load_dotenv(override=True)
+    gdf = synthetic_polygons(args.rows)
+
+    with pdb_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {TABLE}")
+            cur.execute(f"CREATE TABLE {TABLE} (LIKE xviewui_results INCLUDING ALL)")
+
+    try:
+        for name, load in (("to_postgis", with_to_postgis), ("copy", with_copy)):
+            timings = []
+            for _ in range(args.repeat):
+                job_id = str(uuid.uuid4())
+                start = time.perf_counter()
+                load(gdf, job_id)
+                timings.append(time.perf_counter() - start)
+            print(f"{name:>10}: {min(timings):.2f}s for {args.rows} polygons (best of {args.repeat})")
+    finally:
+        with pdb_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"DROP TABLE IF EXISTS {TABLE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Compares the thread and async tile fetch engines of TileDataset against a local mock
+tile server at several concurrency levels.
+
+Run from the project directory:
+    python benchmarks/bench_tile_engines.py --tiles 1024 --latency 0.05
+"""
+import argparse
+import asyncio
+import http.server
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import mercantile
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from downloader import TileDataset  # noqa: E402
+from tilefetcher import AsyncTileFetcher, TileFetcher  # noqa: E402
+
+
+def make_server(latency):
+    _, png = cv2.imencode(".png", np.random.randint(0, 255, (256, 256, 3), np.uint8))
+    body = png.tobytes()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_thread(url, tiles, concurrency):
+    ds = TileDataset(url, None, None, 18, "bench",
+        fetcher=TileFetcher(url, concurrency=concurrency))
+    stime = time.time()
+    list(ds.fetcher.map(ds._get_image_from_tile, tiles))
+    ds.fetcher.close()
+    return time.time() - stime
+
+
+def bench_async(url, tiles, concurrency):
+    ds = TileDataset(url, None, None, 18, "bench", engine="async",
+        async_fetcher=AsyncTileFetcher(url, concurrency=concurrency))
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor() as executor:
+            async def fetch(tile):
+                data = await ds._aget_tile_bytes(tile, executor)
+                return await loop.run_in_executor(executor, ds._decode_tile, tile, data)
+
+            async with ds.async_fetcher:
+                await asyncio.gather(*[fetch(tile) for tile in tiles])
+
+    stime = time.time()
+    asyncio.run(run())
+    return time.time() - stime
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tiles", type=int, default=1024)
+    parser.add_argument("--latency", type=float, default=0.05,
+        help="seconds the mock server sleeps before answering each tile")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[4, 16, 64])
+    args = parser.parse_args()
+
+    server = make_server(args.latency)
+    url = f"http://127.0.0.1:{server.server_port}/{{subdomain}}/{{z}}/{{x}}/{{y}}.png"
+
+    side = int(np.ceil(np.sqrt(args.tiles)))
+    tiles = [mercantile.Tile(x, y, 18) for x in range(side) for y in range(side)]
+    tiles = tiles[:args.tiles]
+
+    print(f"{len(tiles)} tiles, {args.latency * 1000:.0f} ms simulated latency")
+    print(f"{'engine':>8} {'conc':>6} {'seconds':>9} {'tiles/s':>9}")
+    for concurrency in args.concurrency:
+        for name, bench in [("thread", bench_thread), ("async", bench_async)]:
+            elapsed = bench(url, tiles, concurrency)
+            print(f"{name:>8} {concurrency:>6} {elapsed:>9.2f} {len(tiles) / elapsed:>9.1f}")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Compares per-tile mercantile enumeration and georeferencing with the vectorized helpers
+in tileserverutils.
+
+Run from the project directory:
+    python benchmarks/bench_tile_math.py --size 0.1 --zoom 18
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import mercantile
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from tileserverutils import bbox_to_tiles, bbox_tile_grid  # noqa: E402
+
+
+def per_tile(bounds, zoom):
+    minx, miny, maxx, maxy = bounds
+    tiles = list(mercantile.tiles(minx, miny, maxx, maxy, zoom))
+    return [mercantile.bounds(tile) for tile in tiles], [mercantile.xy_bounds(tile) for tile in tiles]
+
+
+def vectorized(bounds, zoom):
+    minx, miny, maxx, maxy = bounds
+    tiles = bbox_to_tiles(minx, maxx, miny, maxy, zoom)
+    return tiles, bbox_tile_grid(minx, maxx, miny, maxy, zoom)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lon", type=float, default=30.5)
+    parser.add_argument("--lat", type=float, default=50.45)
+    parser.add_argument("--size", type=float, default=0.1, help="bbox side in degrees")
+    parser.add_argument("--zoom", type=int, default=18)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    bounds = (args.lon, args.lat, args.lon + args.size, args.lat + args.size)
+    num_tiles = len(bbox_to_tiles(bounds[0], bounds[2], bounds[1], bounds[3], args.zoom)[0])
+    print(f"{num_tiles} tiles at zoom {args.zoom}")
+
+    for name, fn in [("mercantile", per_tile), ("vectorized", vectorized)]:
+        best = float("inf")
+        for _ in range(args.repeat):
+            stime = time.perf_counter()
+            fn(bounds, args.zoom)
+            best = min(best, time.perf_counter() - stime)
+        print(f"{name:>11}: {best * 1000:9.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Measures requests/sec of the hot read endpoints of a running API.
+
+Point it at a server started from the old (sync) and new (async) code against the
+same local Postgres and compare the numbers, e.g.
+    python benchmarks/loadtest_api.py --url http://localhost:8000 \\
+        --job-id 73a42ed6-901b-4d08-9776-f548620e94ea --access-key accesskey1
+"""
+import argparse
+import asyncio
+import time
+
+import aiohttp
+
+ENDPOINTS = ("/job-status", "/fetch-coordinates", "/fetch-assessment", "/fetch-osm-polygons")
+
+
+async def hammer(session, url, params, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        stime = time.perf_counter()
+        try:
+            async with session.get(url, params=params) as r:
+                await r.read()
+                if r.status != 200:
+                    errors.append(r.status)
+                    continue
+        except aiohttp.ClientError as e:
+            errors.append(e)
+            continue
+        latencies.append(time.perf_counter() - stime)
+
+
+async def run_endpoint(base_url, endpoint, job_id, access_key, concurrency, duration):
+    latencies = []
+    errors = []
+    headers = {"access-key": access_key}
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*[
+            hammer(session, base_url + endpoint, {"job_id": job_id}, deadline, latencies, errors)
+            for _ in range(concurrency)
+        ])
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000 if latencies else float("nan")
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else float("nan")
+    print(
+        f"{endpoint:>22} {len(latencies) / duration:9.1f} req/s"
+        f"  p50 {p50:7.1f} ms  p99 {p99:7.1f} ms  errors {len(errors)}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--job-id", required=True)
+    parser.add_argument("--access-key", required=True)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--endpoints", nargs="+", default=ENDPOINTS)
+    args = parser.parse_args()
+
+    print(f"{args.url}, {args.concurrency} concurrent clients, {args.duration}s per endpoint")
+    for endpoint in args.endpoints:
+        await run_endpoint(
+            args.url, endpoint, args.job_id, args.access_key, args.concurrency, args.duration
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,289 @@
+"""
+Tiled, batched inference over a job's merged pre/post mosaics.
+
+The mosaics are cut into overlapping chips and only chips that contain at least one
+OSM building footprint are read and scored; on rural and suburban AOIs most chips are
+empty. Batches of chips go to a process pool whose workers each open the mosaics and
+build the model once. Every chip keeps only its centre, trimming half the overlap on
+the sides it shares with a neighbour, so the stitched damage raster has no seams and
+needs no blending buffers.
+
+    python chips.py pre.tif post.tif polys.geojson damage.tif --model chips:StubChipModel
+"""
+import argparse
+import os
+import threading
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+from inference import load_model
+
+# Model and open mosaics of each pool worker, whether a process or a thread
+_state = threading.local()
+
+
+class StubChipModel:
+    """
+    CPU-only stand-in for tests: scores each pixel by how much its brightness changed
+    between pre and post, in [0, 1].
+    """
+
+    def __call__(self, pre, post):
+        pre = pre.astype(np.float32).mean(axis=1)
+        post = post.astype(np.float32).mean(axis=1)
+        return np.abs(post - pre) / 255
+
+
+def chip_windows(width, height, chip_size, overlap):
+    """
+    Returns
+        (read, write) lists of Windows. Each read window is a full chip (smaller only if
+            the raster is), shifted back inside the raster at the edges; its write
+            window is the part of it the chip's output is kept for.
+    """
+    step = chip_size - overlap
+
+    def starts(size):
+        if size <= chip_size:
+            return [0]
+        values = list(range(0, size - chip_size, step)) + [size - chip_size]
+        return sorted(set(values))
+
+    def spans(size):
+        # Split each overlap between neighbouring chips at its midpoint
+        first = starts(size)
+        length = min(chip_size, size)
+        bounds = [0]
+        for prev, start in zip(first, first[1:]):
+            bounds.append((prev + length + start) // 2)
+        bounds.append(size)
+        return [(start, length, lo, hi) for start, lo, hi in zip(first, bounds, bounds[1:])]
+
+    read, write = [], []
+    for row, height_, row_lo, row_hi in spans(height):
+        for col, width_, col_lo, col_hi in spans(width):
+            read.append(Window(col, row, width_, height_))
+            write.append(Window(col_lo, row_lo, col_hi - col_lo, row_hi - row_lo))
+    return read, write
+
+
+def occupied_chips(windows, transform, footprints):
+    """
+    Returns
+        the indices of the windows that intersect at least one footprint
+    """
+    if len(footprints) == 0:
+        return np.array([], dtype=int)
+
+    boxes = shapely.box(
+        *np.array(
+            [rasterio.windows.bounds(window, transform) for window in windows]
+        ).T
+    )
+    tree = shapely.STRtree(np.asarray(footprints.geometry.values))
+    chip_idx, _ = tree.query(boxes, predicate="intersects")
+    return np.unique(chip_idx)
+
+
+def _init_worker(model_spec, pre_path, post_path):
+    _state.model = load_model(model_spec)
+    _state.pre = pre = rasterio.open(pre_path)
+    post = rasterio.open(post_path)
+    if (post.crs, post.transform, post.shape) == (pre.crs, pre.transform, pre.shape):
+        _state.post = post
+    else:
+        # Resample post onto the pre grid so the same window covers the same ground
+        _state.post = WarpedVRT(
+            post,
+            crs=pre.crs,
+            transform=pre.transform,
+            width=pre.width,
+            height=pre.height,
+        )
+
+
+def _run_batch(windows, chip_size):
+    """Reads, pads and scores a batch of chips in a pool worker."""
+    shape = (len(windows), _state.pre.count, chip_size, chip_size)
+    pre = np.zeros(shape, dtype=np.uint8)
+    post = np.zeros(shape, dtype=np.uint8)
+    for i, window in enumerate(windows):
+        h, w = window.height, window.width
+        pre[i, :, :h, :w] = _state.pre.read(window=window)
+        post[i, :, :h, :w] = _state.post.read(window=window)
+    return np.asarray(_state.model(pre, post), dtype=np.float32)
+
+
+class ChipPipeline:
+    """
+    Args:
+        model_spec: the model factory as module:callable (see inference.load_model);
+            the model takes (n, bands, chip_size, chip_size) pre and post uint8 batches
+            and returns (n, chip_size, chip_size) damage scores
+        chip_size: chip side in pixels
+        overlap: pixels shared by neighbouring chips
+        batch_size: chips per model call
+        workers: size of the pool
+        executor: "process", or "thread" where worker processes can't fork children
+            of their own (e.g. Celery's prefork pool)
+    """
+
+    def __init__(
+        self,
+        model_spec,
+        chip_size=1024,
+        overlap=128,
+        batch_size=4,
+        workers=None,
+        executor="process",
+    ):
+        if overlap >= chip_size:
+            raise ValueError("overlap must be smaller than chip_size")
+        if executor not in ("process", "thread"):
+            raise ValueError(f"Unknown executor {executor}")
+        self.executor = executor
+        self.model_spec = model_spec
+        self.chip_size = chip_size
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.workers = workers or os.cpu_count()
+
+    @classmethod
+    def from_env(cls, **kwargs):
+        """
+        Builds a ChipPipeline using CHIP_MODEL, CHIP_SIZE, CHIP_OVERLAP,
+        CHIP_BATCH_SIZE, CHIP_WORKERS and CHIP_EXECUTOR when they are set.
+        """
+        settings = {
+            "model_spec": ("CHIP_MODEL", str),
+            "chip_size": ("CHIP_SIZE", int),
+            "overlap": ("CHIP_OVERLAP", int),
+            "batch_size": ("CHIP_BATCH_SIZE", int),
+            "workers": ("CHIP_WORKERS", int),
+            "executor": ("CHIP_EXECUTOR", str),
+        }
+        for name, (env, cast) in settings.items():
+            if os.getenv(env):
+                kwargs.setdefault(name, cast(os.getenv(env)))
+        if "model_spec" not in kwargs:
+            raise ValueError("CHIP_MODEL is not set")
+        return cls(**kwargs)
+
+    def run(self, pre_path, post_path, footprints, out_path):
+        """
+        Scores the chips of the pre/post mosaics that contain footprints and writes the
+        stitched per-pixel damage scores to out_path as a float32 GeoTIFF on the pre
+        mosaic's grid. Pixels of skipped chips are left at 0.
+
+        Args:
+            footprints: GeoDataFrame of building footprints
+        Returns
+            out_path
+        """
+        with rasterio.open(pre_path) as pre:
+            transform, crs = pre.transform, pre.crs
+            width, height = pre.width, pre.height
+
+        read, write = chip_windows(width, height, self.chip_size, self.overlap)
+        selected = occupied_chips(read, transform, footprints.to_crs(crs))
+        print(f"Scoring {len(selected)} of {len(read)} chips that contain buildings")
+
+        profile = {
+            "driver": "GTiff",
+            "width": width,
+            "height": height,
+            "count": 1,
+            "dtype": "float32",
+            "crs": crs,
+            "transform": transform,
+            "tiled": True,
+            "blockxsize": 256,
+            "blockysize": 256,
+            # Blocks of skipped chips are never written and read back as 0
+            "sparse_ok": True,
+        }
+
+        batches = [
+            selected[i : i + self.batch_size]
+            for i in range(0, len(selected), self.batch_size)
+        ]
+        tmp_path = f"{out_path}.tmp.tif"
+        pool = ProcessPoolExecutor if self.executor == "process" else ThreadPoolExecutor
+        with rasterio.open(tmp_path, "w", **profile) as dst, pool(
+            max_workers=self.workers,
+            initializer=_init_worker,
+            initargs=(self.model_spec, str(pre_path), str(post_path)),
+        ) as executor:
+            pending = {}
+            batches = iter(batches)
+            while True:
+                # Keep a couple of batches per worker in flight to bound memory
+                while len(pending) < 2 * self.workers:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    windows = [read[i] for i in batch]
+                    future = executor.submit(_run_batch, windows, self.chip_size)
+                    pending[future] = batch
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = pending.pop(future)
+                    self._write(dst, future.result(), batch, read, write)
+
+        os.replace(tmp_path, out_path)
+        return out_path
+
+    @staticmethod
+    def _write(dst, scores, batch, read, write):
+        for score, i in zip(scores, batch):
+            r, w = read[i], write[i]
+            row = w.row_off - r.row_off
+            col = w.col_off - r.col_off
+            dst.write(
+                score[row : row + w.height, col : col + w.width], 1, window=w
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("pre_path")
+    parser.add_argument("post_path")
+    parser.add_argument("footprints", help="building polygons readable by geopandas")
+    parser.add_argument("out_path")
+    parser.add_argument("--model", required=True, help="model factory as module:callable")
+    parser.add_argument("--chip-size", type=int, default=1024)
+    parser.add_argument("--overlap", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--executor", choices=["process", "thread"], default="process")
+    args = parser.parse_args()
+
+    pipeline = ChipPipeline(
+        args.model,
+        args.chip_size,
+        args.overlap,
+        args.batch_size,
+        args.workers,
+        args.executor,
+    )
+    pipeline.run(
+        args.pre_path, args.post_path, gpd.read_file(args.footprints), args.out_path
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,165 +1,561 @@
-import requests
+import asyncio
+import math
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import shapely
 import mercantile
-import threading
-from queue import Queue
 import numpy as np
-import rasterio.merge
+import rasterio
+import rasterio.windows
+from osgeo import gdal
+
+from tilefetcher import AsyncTileFetcher, TileFetcher, TileFetchError
+from tileserverutils import (TILE_SIZE, bbox_to_xyz, lonlat_to_mercator,
+                             tile_grid_geotransform, tiles_in_range)
+
+ENGINES = ("thread", "async")
+
+# get_data_from_extent holds the whole mosaic in memory, so it is capped at this
+IN_MEMORY_MAX_DEGREES = 1
+
+
+class TileGrid:
+    """
+    The regular grid of web mercator tiles covering a lon/lat bounding box at one zoom
+    level.
+
+    All tiles share one zoom level, so in EPSG:3857 they sit on an exact pixel grid and
+    the geotransform can be computed analytically instead of merging per-tile rasters.
+    The output window is the grid cropped to the bounding box. Passing tile_range
+    restricts the grid to a sub-range of the tiles, e.g. one chunk of a large extent.
+    """
+
+    def __init__(self, bounds, zoom, tile_range=None):
+        minx, miny, maxx, maxy = bounds
+        self.zoom = zoom
+        x_min, x_max, y_min, y_max = tile_range or bbox_to_xyz(minx, maxx, miny, maxy, zoom)
+        xs, ys, _, _ = tiles_in_range(x_min, x_max, y_min, y_max, zoom)
+        self.tiles = [mercantile.Tile(x, y, zoom) for x, y in zip(xs.tolist(), ys.tolist())]
+        self.x0 = int(x_min)
+        self.y0 = int(y_min)
+        grid_width = int(x_max - x_min + 1) * TILE_SIZE
+        grid_height = int(y_max - y_min + 1) * TILE_SIZE
+
+        _, (left, self.res, _, top, _, _) = tile_grid_geotransform(
+            x_min, x_max, y_min, y_max, zoom, TILE_SIZE
+        )
+
+        # Crop the grid to the bounding box, in grid pixel coordinates
+        (bbox_left, bbox_right), (bbox_bottom, bbox_top) = lonlat_to_mercator(
+            np.array([minx, maxx]), np.array([miny, maxy])
+        )
+        self.col_off = max(0, math.floor((bbox_left - left) / self.res))
+        self.row_off = max(0, math.floor((top - bbox_top) / self.res))
+        self.width = min(grid_width, math.ceil((bbox_right - left) / self.res)) - self.col_off
+        self.height = min(grid_height, math.ceil((top - bbox_bottom) / self.res)) - self.row_off
+
+        self.transform = rasterio.transform.Affine(
+            self.res, 0, left + self.col_off * self.res,
+            0, -self.res, top - self.row_off * self.res,
+        )
+
+    def profile(self):
+        return {
+            "driver": "GTiff",
+            "width": self.width,
+            "height": self.height,
+            "transform": self.transform,
+            "crs": "epsg:3857",
+            "count": 3,
+            "dtype": "uint8",
+        }
+
+    def empty_mosaic(self):
+        return np.zeros((3, self.height, self.width), dtype=np.uint8)
+
+    def tile_window(self, tile):
+        """
+        Returns the (row, col) offset of the tile's top-left pixel relative to the
+        cropped output window. Either can be negative for tiles on the edge.
+        """
+        row = (tile.y - self.y0) * TILE_SIZE - self.row_off
+        col = (tile.x - self.x0) * TILE_SIZE - self.col_off
+        return row, col
+
+    def paste(self, mosaic, tile, img, row_off=0):
+        """
+        Copies the 256x256x3 tile image into its slot of the mosaic, clipped to the
+        mosaic. row_off is the output row a partial mosaic (a band) starts at.
+        """
+        row, col = self.tile_window(tile)
+        row -= row_off
+        r0, c0 = max(row, 0), max(col, 0)
+        r1 = min(row + TILE_SIZE, mosaic.shape[1])
+        c1 = min(col + TILE_SIZE, mosaic.shape[2])
+        if r0 >= r1 or c0 >= c1:
+            return
+        mosaic[:, r0:r1, c0:c1] = img[r0 - row:r1 - row, c0 - col:c1 - col].transpose(2, 0, 1)
+
+    def bands(self, min_tiles=1):
+        """
+        Splits the grid into bands of whole tile rows, top to bottom. Each band holds
+        as few rows as possible while still having at least min_tiles tiles, so a fetch
+        engine with that much concurrency is kept busy.
+        Returns
+            a list of (tiles, row_start, row_end) with the output rows the band covers
+        """
+        rows = {}
+        for tile in self.tiles:
+            rows.setdefault(tile.y, []).append(tile)
+        row_tiles = [rows[y] for y in sorted(rows)]
+        rows_per_band = max(1, math.ceil(min_tiles / len(row_tiles[0])))
+
+        bands = []
+        for i in range(0, len(row_tiles), rows_per_band):
+            tiles = [tile for row in row_tiles[i:i + rows_per_band] for tile in row]
+            row_start = max(0, (tiles[0].y - self.y0) * TILE_SIZE - self.row_off)
+            row_end = min(self.height, (tiles[-1].y - self.y0 + 1) * TILE_SIZE - self.row_off)
+            bands.append((tiles, row_start, row_end))
+        return bands
+
+
+class MosaicWriter:
+    """
+    Writes a TileGrid mosaic to a tiled, LZW-compressed GeoTIFF band by band.
+
+    Bands of tile rows rarely line up with the GeoTIFF's internal 256-row blocks because
+    the output is cropped to the bbox, so rows are buffered until a whole block row can
+    be written; compressed blocks are then never rewritten. The file is written under a
+    temporary name and renamed into place on close, so a partial file never looks
+    complete.
+    """
+
+    def __init__(self, path, grid):
+        self.path = path
+        self.grid = grid
+        self._tmp_path = path.with_suffix(".tmp.tif")
+        self._pending = np.zeros((3, 0, grid.width), dtype=np.uint8)
+        self._written = 0
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        profile = self.grid.profile()
+        profile.update(
+            tiled=True,
+            blockxsize=TILE_SIZE,
+            blockysize=TILE_SIZE,
+            compress="lzw",
+            predictor=2,
+            BIGTIFF="IF_SAFER",
+        )
+        self._dst = rasterio.open(self._tmp_path, "w", **profile)
+        return self
+
+    def write(self, strip):
+        """Appends the next rows of the mosaic."""
+        self._pending = np.concatenate([self._pending, strip], axis=1)
+        n = self._pending.shape[1] // TILE_SIZE * TILE_SIZE
+        if n:
+            self._flush(n)
+
+    def _flush(self, n):
+        window = rasterio.windows.Window(0, self._written, self.grid.width, n)
+        self._dst.write(self._pending[:, :n], window=window)
+        self._written += n
+        self._pending = self._pending[:, n:]
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None and self._pending.shape[1]:
+            self._flush(self._pending.shape[1])
+        self._dst.close()
+
+        if exc_type is None:
+            os.replace(self._tmp_path, self.path)
+        else:
+            self._tmp_path.unlink(missing_ok=True)
 
 
 class TileDataset:
-    def __init__(self, url, output_dir, bounding_box, zoom, job_id):
+    def __init__(
+        self,
+        url,
+        output_dir,
+        bounding_box,
+        zoom,
+        job_id,
+        item_id=None,
+        cache=None,
+        fetcher=None,
+        engine="thread",
+        async_fetcher=None,
+        max_extent_degrees=None,
+        chunk_tiles=256,
+        chunk_workers=2,
+        chunk_output="gtiff",
+        manifest=None,
+    ):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown tile fetch engine {engine!r}, expected one of {ENGINES}")
         self.subdomains = ['tiles0', 'tiles1', 'tiles2', 'tiles3']
         self.url = url
         self.output_dir = output_dir
         self.bounding_box = bounding_box
         self.zoom = zoom
         self.job_id = job_id
+        # Key tiles in the cache by item id, falling back to the url without the query
+        # string so the api key never ends up in a cache key
+        self.item_id = item_id or url.split("?")[0]
+        self.cache = cache
+        self.manifest = manifest
+        self.engine = engine
+        # Only bounds the streaming and chunked paths, None for no limit; the in-memory
+        # mosaic stays capped at IN_MEMORY_MAX_DEGREES
+        self.max_extent_degrees = max_extent_degrees
+        self.chunk_tiles = chunk_tiles
+        self.chunk_workers = chunk_workers
+        self.chunk_output = chunk_output
+        self.fetcher = fetcher or TileFetcher(url, self.subdomains)
+        self.async_fetcher = async_fetcher or AsyncTileFetcher(url, self.subdomains)
 
-    def _get_image_from_tile(self, tile):
+    def _get_tile_bytes(self, tile):
+        """
+        Args:
+            tile: a mercantile Tile object
+        Returns
+            the encoded image bytes for the input tile, read from the job manifest or
+                the tile cache when possible, or None if the tile server has no imagery
+                for the tile
+        """
+        if self.manifest is not None:
+            found, data = self.manifest.get(tile)
+            if found:
+                return data
+
+        if self.cache is None:
+            data = self.fetcher.fetch(tile)
+        else:
+            data = self.cache.get(self.item_id, tile.z, tile.x, tile.y)
+            if data is None:
+                data = self.fetcher.fetch(tile)
+                if data is not None:
+                    self.cache.put(self.item_id, tile.z, tile.x, tile.y, data)
+
+        if self.manifest is not None:
+            self.manifest.put(tile, data)
+        return data
+
+    async def _aget_tile_bytes(self, tile, executor):
+        """
+        Async version of _get_tile_bytes. Manifest and cache file IO runs on the
+        executor so it never blocks the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self.manifest is not None:
+            found, data = await loop.run_in_executor(executor, self.manifest.get, tile)
+            if found:
+                return data
+
+        if self.cache is None:
+            data = await self.async_fetcher.fetch(tile)
+        else:
+            data = await loop.run_in_executor(
+                executor, self.cache.get, self.item_id, tile.z, tile.x, tile.y
+            )
+            if data is None:
+                data = await self.async_fetcher.fetch(tile)
+                if data is not None:
+                    await loop.run_in_executor(
+                        executor, self.cache.put, self.item_id, tile.z, tile.x, tile.y, data
+                    )
+
+        if self.manifest is not None:
+            await loop.run_in_executor(executor, self.manifest.put, tile, data)
+        return data
+
+    def _decode_tile(self, tile, data):
         """
         Args:
             tile: a mercantile Tile object
+            data: the encoded image bytes for the tile, or None
         Returns
             a np.ndarray of size 256x256x3 with uint8 datatype containing the imagery
-                for the input tile
+                for the input tile, all zeros (nodata) if the tile has no imagery
         """
-        url = self.url.format(
-            subdomain=np.random.choice(self.subdomains),
-            x=tile.x,
-            y=tile.y,
-            z=tile.z
-        )
-        with requests.get(url) as r:
-            arr = np.asarray(bytearray(r.content), dtype=np.uint8)
-        img = cv2.imdecode(arr, -1)
+        if data is None:
+            return np.zeros((256, 256, 3), dtype=np.uint8)
+
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), -1)
+        if img is None:
+            raise TileFetchError(f"Could not decode image for tile {tuple(tile)}")
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
         return img
 
-    def _get_tile_as_virtual_raster(self, tile):
+    def _get_image_from_tile(self, tile):
         """
         Args:
             tile: a mercantile Tile object
         Returns
-            a rasterio.io.MemoryFile with the imagery for the input tile
+            a np.ndarray of size 256x256x3 with uint8 datatype containing the imagery
+                for the input tile
         """
-        img = self._get_image_from_tile(tile)
-        geom = shapely.geometry.shape(mercantile.feature(tile)["geometry"])
-        minx, miny, maxx, maxy = geom.bounds
-        dst_transform = rasterio.transform.from_bounds(minx, miny, maxx, maxy, 256, 256)
-        dst_profile = {
-            "driver": "GTiff",
-            "width": 256,
-            "height": 256,
-            "transform": dst_transform,
-            "nodata": 0,
-            "crs": "epsg:4326",
-            "count": 3,
-            "dtype": "uint8",
-        }
-        test_f = rasterio.io.MemoryFile()
-        with test_f.open(**dst_profile) as test_d:
-            test_d.write(img[:, :, 0], 1)
-            test_d.write(img[:, :, 1], 2)
-            test_d.write(img[:, :, 2], 3)
-        test_f.seek(0)
+        return self._decode_tile(tile, self._get_tile_bytes(tile))
 
-        return test_f
+    def _fetch_images(self, tiles):
+        """
+        Args:
+            tiles: a list of mercantile Tile objects
+        Returns
+            an iterator of (tile, image) pairs, fetched with the thread engine
+        """
+        return zip(tiles, self.fetcher.map(self._get_image_from_tile, tiles))
+
+    async def _afetch_images(self, tiles, executor):
+        """
+        Async version of _fetch_images, yielding (tile, image) pairs as they complete.
+        Must be called with the async fetcher open. The first exception is re-raised
+        here once the tiles still in flight have been cancelled.
+        """
+        loop = asyncio.get_running_loop()
 
-    def _dequeue_get_tile_as_virtual_raster(self, q, virtual_files, virtual_datasets):
-        while not q.empty():
-            tile = q.get()
-            f = self._get_tile_as_virtual_raster(tile)
-            virtual_files.append(f)
-            virtual_datasets.append(f.open())
-            q.task_done()
+        async def fetch(tile):
+            data = await self._aget_tile_bytes(tile, executor)
+            # PNG decoding releases the GIL, so the thread pool keeps it off the event
+            # loop while the requests stay in flight
+            img = await loop.run_in_executor(executor, self._decode_tile, tile, data)
+            return tile, img
+
+        tasks = [asyncio.ensure_future(fetch(tile)) for tile in tiles]
+        try:
+            for result in asyncio.as_completed(tasks):
+                yield await result
+        finally:
+            # On failure (or an abandoned generator) stop the other requests before the
+            # session closes and collect their outcomes so none is left unretrieved
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
     def get_data_from_extent(self, geom, zoom_level=16):
         """Gets georeferenced imagery from the input geom at a given zoom level.
-        Specifically, this will iterate over all the quadkeys in the input geom at the
-        given zoom level and save the imagery as a virtual raster. The virtual raster
-        lets us either quickly read the data or quickly write it to file as a GeoTIFF.
+        Specifically, this will iterate over all the tiles covering the input geom at
+        the given zoom level and copy each one straight into its slot of a single
+        preallocated mosaic, cropped to the geom bounds. The tiles are fetched with the
+        engine chosen for this dataset. When already running inside an event loop, use
+        aget_data_from_extent instead.
         Args:
             geom: A geojson object in EPSG:4326 (i.e. with lat/lon coordinates)
         Returns:
-            a rasterio.io.MemoryFile with the corresponding data
+            a rasterio.io.MemoryFile with the corresponding data in EPSG:3857
         """
-        shape = shapely.geometry.shape(geom)
-        minx, miny, maxx, maxy = shape.bounds
+        if self.engine == "async":
+            return asyncio.run(self.aget_data_from_extent(geom, zoom_level))
+
+        grid = self._grid_from_extent(geom, zoom_level)
+        mosaic = grid.empty_mosaic()
+        print(f"Fetching {len(grid.tiles)} tiles with {self.fetcher.concurrency} threads...")
+        for tile, img in self._fetch_images(grid.tiles):
+            grid.paste(mosaic, tile, img)
+
+        return self._mosaic_to_memory_file(grid, mosaic)
+
+    async def aget_data_from_extent(self, geom, zoom_level=16):
+        """Async version of get_data_from_extent. The async engine is always used since
+        a running loop is available. Copying tiles into the mosaic and encoding it run
+        on a thread pool, so the event loop is never blocked by whole-mosaic work."""
+        loop = asyncio.get_running_loop()
+        grid = self._grid_from_extent(geom, zoom_level)
+        mosaic = grid.empty_mosaic()
+        print(
+            f"Fetching {len(grid.tiles)} tiles with up to"
+            + f" {self.async_fetcher.concurrency} concurrent requests..."
+        )
+        with ThreadPoolExecutor() as executor:
+            async with self.async_fetcher:
+                async for tile, img in self._afetch_images(grid.tiles, executor):
+                    await loop.run_in_executor(executor, grid.paste, mosaic, tile, img)
+
+            return await loop.run_in_executor(
+                executor, self._mosaic_to_memory_file, grid, mosaic
+            )
+
+    def download_extent(self, geom, prepost, zoom_level=16):
+        """Writes georeferenced imagery for the input geom to a single tiled GeoTIFF,
+        splitting extents wider or taller than chunk_tiles tiles into a grid of chunks.
+        Each chunk is streamed to its own GeoTIFF under <job_id>/chunks/<prepost>, so a
+        retried download skips chunks that already finished. The chunks are then
+        mosaicked through a VRT into the merged GeoTIFF by GDAL, which streams blocks
+        and keeps memory bounded; with chunk_output="vrt" the VRT itself is the output,
+        written next to where the GeoTIFF would be.
+        Args:
+            geom: A geojson object in EPSG:4326 (i.e. with lat/lon coordinates)
+            prepost: "pre" or "post"
+        Returns:
+            the path of the merged GeoTIFF (or VRT)
+        """
+        bounds = shapely.geometry.shape(geom).bounds
+        self._check_extent(bounds, self.max_extent_degrees, "TILE_MAX_EXTENT_DEGREES")
+        minx, miny, maxx, maxy = bounds
+        x_min, x_max, y_min, y_max = (
+            int(v) for v in bbox_to_xyz(minx, maxx, miny, maxy, zoom_level)
+        )
+        if x_max - x_min < self.chunk_tiles and y_max - y_min < self.chunk_tiles:
+            return self.save_extent_to_disk(geom, prepost, zoom_level)
 
-        virtual_files = []
-        virtual_datasets = []
+        chunk_dir = self.output_dir / self.job_id / "chunks" / prepost
+        chunks = []
+        for y in range(y_min, y_max + 1, self.chunk_tiles):
+            for x in range(x_min, x_max + 1, self.chunk_tiles):
+                tile_range = (
+                    x, min(x + self.chunk_tiles - 1, x_max),
+                    y, min(y + self.chunk_tiles - 1, y_max),
+                )
+                path = chunk_dir / f"{self.job_id}_{prepost}_{y}_{x}.tif"
+                chunks.append((TileGrid(bounds, zoom_level, tile_range), path))
+
+        todo = [(grid, path) for grid, path in chunks if not path.exists()]
+        print(f"Downloading {len(todo)} of {len(chunks)} chunks for {prepost}...")
+
+        if self.engine == "async":
+            # A single event loop already keeps async_fetcher.concurrency requests in
+            # flight, so chunks run one after the other on it
+            async def save_chunks():
+                for grid, path in todo:
+                    await self._asave_grid(grid, path)
+            asyncio.run(save_chunks())
+        else:
+            with ThreadPoolExecutor(max_workers=self.chunk_workers) as executor:
+                list(executor.map(lambda chunk: self._save_grid(*chunk), todo))
+
+        return self._merge_chunks([path for _, path in chunks], prepost)
+
+    def _merge_chunks(self, chunk_paths, prepost):
+        output_path = self._output_path(prepost)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+
+        if self.chunk_output == "vrt":
+            # Where inference looks for the merged GeoTIFF; the chunks stay in place
+            vrt_path = output_path.with_suffix(".vrt")
+            gdal.BuildVRT(str(vrt_path), [str(p) for p in chunk_paths]).FlushCache()
+            return vrt_path
+
+        vrt_path = chunk_paths[0].parent / f"{self.job_id}_{prepost}_merged.vrt"
+        gdal.BuildVRT(str(vrt_path), [str(p) for p in chunk_paths]).FlushCache()
+
+        tmp_path = output_path.with_suffix(".tmp.tif")
+        gdal.Translate(
+            str(tmp_path),
+            str(vrt_path),
+            creationOptions=[
+                "TILED=YES",
+                f"BLOCKXSIZE={TILE_SIZE}",
+                f"BLOCKYSIZE={TILE_SIZE}",
+                "COMPRESS=LZW",
+                "PREDICTOR=2",
+                "BIGTIFF=IF_SAFER",
+            ],
+        ).FlushCache()
+        os.replace(tmp_path, output_path)
+
+        shutil.rmtree(chunk_paths[0].parent)
+        return output_path
+
+    def save_extent_to_disk(self, geom, prepost, zoom_level=16):
+        """Streams georeferenced imagery for the input geom straight into a tiled,
+        LZW-compressed GeoTIFF. Tiles are fetched one band of tile rows at a time and
+        each band is written as soon as it is complete, so peak memory is bounded by a
+        band (one row of tiles for large extents) rather than the whole extent.
+        Args:
+            geom: A geojson object in EPSG:4326 (i.e. with lat/lon coordinates)
+            prepost: "pre" or "post"
+        Returns:
+            the path of the written GeoTIFF
+        """
+        grid = self._grid_from_extent(geom, zoom_level, streaming=True)
+        if self.engine == "async":
+            return asyncio.run(self._asave_grid(grid, self._output_path(prepost)))
+        return self._save_grid(grid, self._output_path(prepost))
+
+    async def asave_extent_to_disk(self, geom, prepost, zoom_level=16):
+        """Async version of save_extent_to_disk using the async engine."""
+        grid = self._grid_from_extent(geom, zoom_level, streaming=True)
+        return await self._asave_grid(grid, self._output_path(prepost))
+
+    def _save_grid(self, grid, path):
+        print(f"Streaming {len(grid.tiles)} tiles with {self.fetcher.concurrency} threads...")
+        with MosaicWriter(path, grid) as writer:
+            for tiles, row_start, row_end in grid.bands(self.fetcher.concurrency):
+                strip = np.zeros((3, row_end - row_start, grid.width), dtype=np.uint8)
+                for tile, img in zip(tiles, self.fetcher.map(self._get_image_from_tile, tiles)):
+                    grid.paste(strip, tile, img, row_start)
+                writer.write(strip)
+
+        self._print_cache_stats()
+        return path
+
+    async def _asave_grid(self, grid, path):
+        loop = asyncio.get_running_loop()
+        print(
+            f"Streaming {len(grid.tiles)} tiles with up to"
+            + f" {self.async_fetcher.concurrency} concurrent requests..."
+        )
+        with MosaicWriter(path, grid) as writer:
+            with ThreadPoolExecutor() as executor:
+                async with self.async_fetcher:
+                    for tiles, row_start, row_end in grid.bands(self.async_fetcher.concurrency):
+                        strip = np.zeros((3, row_end - row_start, grid.width), dtype=np.uint8)
+                        async for tile, img in self._afetch_images(tiles, executor):
+                            await loop.run_in_executor(
+                                executor, grid.paste, strip, tile, img, row_start
+                            )
+                        await loop.run_in_executor(executor, writer.write, strip)
+
+        self._print_cache_stats()
+        return path
+
+    def _grid_from_extent(self, geom, zoom_level, streaming=False):
+        bounds = shapely.geometry.shape(geom).bounds
+        if streaming:
+            self._check_extent(bounds, self.max_extent_degrees, "TILE_MAX_EXTENT_DEGREES")
+        else:
+            self._check_extent(
+                bounds,
+                IN_MEMORY_MAX_DEGREES,
+                "the in-memory limit; download_extent streams larger extents to disk"
+                + " in chunks",
+            )
+        return TileGrid(bounds, zoom_level)
+
+    @staticmethod
+    def _check_extent(bounds, max_degrees, limit):
+        if max_degrees is None:
+            return
+        minx, miny, maxx, maxy = bounds
 
         output_width_degrees = maxx-minx
         output_height_degrees = maxy-miny
-        if output_width_degrees > 1 or output_height_degrees > 1:
+        if output_width_degrees > max_degrees or output_height_degrees > max_degrees:
             raise ValueError(
-                "Trying to export file with height or width larger than a degree which"
-                + " will result in a huge output tile. The input geom should be split"
-                + " up into smaller chunks."
+                f"Trying to export file with height or width larger than {max_degrees}"
+                + f" degree(s), which exceeds {limit}."
             )
 
-        # TODO: This should _probably_ be done multithreaded
-        # for tile in mercantile.tiles(minx, miny, maxx, maxy, zoom_level):
-        #     f = self._get_tile_as_virtual_raster(tile)
-        #     virtual_files.append(f)
-        #     virtual_datasets.append(f.open())
-
-        tile_queue = Queue()
-        num_threads = 4
-        num_tiles = 0
-        for tile in mercantile.tiles(minx, miny, maxx, maxy, zoom_level):
-            tile_queue.put(tile)
-            num_tiles += 1
-
-        print(f"Fetching {num_tiles} tiles...")
-
-        for i in range(num_threads):
-            thread = threading.Thread(
-                target = self._dequeue_get_tile_as_virtual_raster,
-                args=(tile_queue, virtual_files, virtual_datasets)
-            )
-            thread.start()
-
-        tile_queue.join()
-
-        # get the largest x and y resolutions over all patches to use as the merged tile
-        # resolution if we don't explicitely set this, then it is likely that some of
-        # the patches not have the correct resolution (they will be off by tiny
-        # fractions of a degree) and there will be single nodata lines between rows of
-        # tiles
-        x_res = 0
-        y_res = 0
-        for ds in virtual_datasets:
-            x_res = max(x_res, ds.res[0])
-            y_res = max(y_res, ds.res[1])
-
-        out_image, out_transform = rasterio.merge.merge(
-            virtual_datasets,
-            res=(x_res, y_res),
-            bounds=(minx, miny, maxx, maxy),
-        )
+    def _output_path(self, prepost):
+        return self.output_dir / self.job_id / prepost / f"{self.job_id}_{prepost}_merged.tif"
 
-        for ds in virtual_datasets:
-            ds.close()
-        for f in virtual_files:
-            f.close()
+    def _print_cache_stats(self):
+        if self.cache is not None:
+            print(f"Tile cache stats: {self.cache.stats()}")
+
+    def _mosaic_to_memory_file(self, grid, mosaic):
+        self._print_cache_stats()
 
-        dst_crs = "epsg:4326"
-        dst_profile = {
-            "driver": "GTiff",
-            "width": out_image.shape[2],
-            "height": out_image.shape[1],
-            "transform": out_transform,
-            "crs": dst_crs,
-            "count": 3,
-            "dtype": "uint8",
-        }
         test_f = rasterio.io.MemoryFile()
-        with test_f.open(**dst_profile) as test_d:
-            test_d.write(out_image)
+        with test_f.open(**grid.profile()) as test_d:
+            test_d.write(mosaic)
         test_f.seek(0)
 
         return test_f
@@ -167,9 +563,9 @@ class TileDataset:
     def save_memory_file_to_disk(self, memory_file, prepost):
         with memory_file.open() as src:
             profile = src.profile.copy()
-            profile["compress"] = "lzw",
+            profile["compress"] = "lzw"
             profile["predictor"] = 2
-            output_path = self.output_dir / self.job_id / prepost / f"{self.job_id}_{prepost}_merged.tif"
+            output_path = self._output_path(prepost)
             output_path.parent.mkdir(parents=True, exist_ok=True)
             with rasterio.open(output_path, "w", **profile) as dst:
                 dst.write(src.read())
\ No newline at end of file
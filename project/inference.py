@@ -0,0 +1,285 @@
+"""
+Warm xView2 inference server.
+
+`run_xv` used to start `conda run -n xview2 python handler.py` for every job, paying for
+conda activation, interpreter start-up and imports each time. This server is started
+once, inside the model's environment, builds the model once and then takes jobs from
+the Celery workers over a local socket. HandlerModel loads the weights once through the
+handler's load_model()/predict() pair when it has one, and otherwise falls back to
+re-running the handler's main() per job, which loads them every time.
+
+    conda run -n xview2 python inference.py serve
+
+INFERENCE_ADDRESS (host:port or a unix socket path) and INFERENCE_AUTHKEY must match
+between the server and the workers; neither side runs without an authkey. Jobs that
+take longer than INFERENCE_TIMEOUT seconds fail. INFERENCE_MODEL names the model factory as
+module:callable; it returns a callable that takes the handler's command line arguments.
+Check on a running server with `python inference.py ping`.
+"""
+import argparse
+import importlib
+import json
+import os
+import runpy
+import socket
+import struct
+import sys
+import threading
+import traceback
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import (Connection, Listener, address_type,
+                                        answer_challenge, deliver_challenge)
+from pathlib import Path
+
+
+class InferenceError(Exception):
+    pass
+
+
+class InferenceUnavailable(InferenceError):
+    pass
+
+
+class HandlerModel:
+    """
+    Runs the xView2 handler script in-process. Its imports happen once, when the server
+    starts.
+
+    A handler that splits loading from inference provides load_model(), returning the
+    loaded model, and predict(model, args), taking the job's command line arguments;
+    the model is then built once here and reused for every job. Otherwise each job runs
+    the handler's main() (or the script itself), and only what the handler keeps at
+    module level stays loaded between jobs.
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path or os.getenv("INFERENCE_HANDLER_PATH"))
+        sys.path.insert(0, str(self.path.parent))
+        self.module = importlib.import_module(self.path.stem)
+        self.model = None
+        if hasattr(self.module, "load_model") and hasattr(self.module, "predict"):
+            print(f"Loading model from {self.path}")
+            self.model = self.module.load_model()
+
+    def __call__(self, args):
+        argv = sys.argv
+        sys.argv = [str(self.path)] + list(args)
+        try:
+            if self.model is not None:
+                self.module.predict(self.model, list(args))
+            elif hasattr(self.module, "main"):
+                self.module.main()
+            else:
+                runpy.run_path(str(self.path), run_name="__main__")
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                raise InferenceError(f"{self.path} exited with {e.code}") from e
+        finally:
+            sys.argv = argv
+
+
+class StubModel:
+    """
+    CPU-only stand-in for tests: scores every building polygon as undamaged and
+    writes output/vector/damage.geojson the way the handler does.
+    """
+
+    def __call__(self, args):
+        import geopandas as gpd
+
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--pre_directory")
+        parser.add_argument("--post_directory")
+        parser.add_argument("--output_directory", required=True)
+        parser.add_argument("--bldg_polys", required=True)
+        opts, _ = parser.parse_known_args(args)
+
+        gdf = gpd.read_file(opts.bldg_polys)
+        gdf["dmg"] = 0.0
+        gdf["area"] = gdf.to_crs(gdf.estimate_utm_crs()).area
+
+        out_file = Path(opts.output_directory) / "vector" / "damage.geojson"
+        out_file.parent.mkdir(parents=True, exist_ok=True)
+        gdf.to_file(out_file, driver="GeoJSON")
+
+
+def load_model(spec=None):
+    """Builds the model named by spec, or INFERENCE_MODEL, as module:callable."""
+    spec = spec or os.getenv("INFERENCE_MODEL") or "inference:HandlerModel"
+    module_name, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), name)()
+
+
+def _address(address=None):
+    address = address or os.getenv("INFERENCE_ADDRESS")
+    if not address:
+        return None
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return (host, int(port))
+    return address
+
+
+def _authkey():
+    # multiprocessing skips the handshake on the listening side for an empty key while
+    # the client still waits for it, and an unauthenticated server would unpickle
+    # whatever reaches its port, so an empty key is never used
+    return os.getenv("INFERENCE_AUTHKEY", "").encode() or None
+
+
+def _recv_timeout(sock, timeout):
+    sec, usec = divmod(round(timeout * 1e6), 10 ** 6)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack("ll", sec, usec))
+
+
+def _connect(address, authkey, timeout):
+    """
+    Client() with timeout seconds each to connect and to finish the authkey handshake,
+    which Client() can wait on forever. The socket is closed on any failure.
+    """
+    family = getattr(socket, address_type(address))
+    with socket.socket(family) as s:
+        s.settimeout(timeout)
+        s.connect(address)
+        # Connection reads the raw descriptor, which ignores settimeout, so the
+        # handshake is bounded by a receive timeout on the socket itself
+        s.setblocking(True)
+        _recv_timeout(s, timeout)
+        conn = Connection(s.detach())
+
+    try:
+        answer_challenge(conn, authkey)
+        deliver_challenge(conn, authkey)
+        # Replies are waited for with conn.poll from here on
+        with socket.fromfd(conn.fileno(), family, socket.SOCK_STREAM) as s:
+            _recv_timeout(s, 0)
+    except BaseException:
+        conn.close()
+        raise
+    return conn
+
+
+def serve(address=None, model=None):
+    """
+    Accepts jobs until interrupted. Jobs run one at a time, while pings are answered
+    straight away so health checks keep working during a long job.
+    """
+    authkey = _authkey()
+    if authkey is None:
+        raise InferenceError("INFERENCE_AUTHKEY must be set to serve")
+    model = model or load_model()
+    lock = threading.Lock()
+    name = type(model).__name__
+
+    def handle(conn):
+        with conn:
+            try:
+                request = conn.recv()
+                if request.get("op") == "ping":
+                    conn.send({"ok": True, "model": name, "busy": lock.locked()})
+                elif request.get("op") == "run":
+                    with lock:
+                        print(f"Running inference: {json.dumps(request['args'])}")
+                        model(request["args"])
+                    conn.send({"ok": True})
+                else:
+                    conn.send({"ok": False, "error": f"Unknown request {request}"})
+            except (EOFError, OSError):
+                # Client went away
+                return
+            except (Exception, SystemExit):
+                # SystemExit too, e.g. from a model's argparse rejecting the arguments
+                error = traceback.format_exc()
+                print(error)
+                try:
+                    conn.send({"ok": False, "error": error})
+                except OSError:
+                    pass
+
+    with Listener(_address(address), authkey=authkey) as listener:
+        print(f"Inference server for {name} listening on {listener.address}")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                # e.g. a client with the wrong authkey
+                print(f"Rejected inference connection: {e}")
+                continue
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+def _request(request, address=None, timeout=None, connect_timeout=10):
+    address = _address(address)
+    if address is None:
+        raise InferenceUnavailable("INFERENCE_ADDRESS is not set")
+    authkey = _authkey()
+    if authkey is None:
+        raise InferenceUnavailable("INFERENCE_AUTHKEY is not set")
+    try:
+        conn = _connect(address, authkey, connect_timeout)
+    except (OSError, EOFError) as e:
+        raise InferenceUnavailable(f"No inference server at {address}: {e}") from e
+    except AuthenticationError as e:
+        raise InferenceError(f"INFERENCE_AUTHKEY rejected by {address}") from e
+
+    with conn:
+        conn.send(request)
+        if timeout is not None and not conn.poll(timeout):
+            # Only safe to retry elsewhere if nothing was started
+            if request.get("op") == "run":
+                raise InferenceError(
+                    f"Inference server at {address} did not finish within {timeout}s"
+                )
+            raise InferenceUnavailable(f"Inference server at {address} did not answer")
+        try:
+            response = conn.recv()
+        except EOFError as e:
+            raise InferenceError(f"Inference server at {address} died mid-request") from e
+
+    if not response["ok"]:
+        raise InferenceError(response["error"])
+    return response
+
+
+def ping(address=None, timeout=5):
+    """
+    Returns
+        the server's status, e.g. {"ok": True, "model": "HandlerModel", "busy": False}
+    Raises
+        InferenceUnavailable if no healthy server answers within timeout seconds
+    """
+    return _request({"op": "ping"}, address, timeout, connect_timeout=timeout)
+
+
+def run(args, address=None, timeout=None):
+    """
+    Runs one job on the inference server and waits up to timeout seconds, or
+    INFERENCE_TIMEOUT, for it to finish.
+
+    Raises
+        InferenceUnavailable if no server is reachable, InferenceError with the
+            server-side traceback if the job failed or if it did not finish in time
+    """
+    timeout = timeout or float(os.getenv("INFERENCE_TIMEOUT") or 2 * 3600)
+    _request({"op": "run", "args": list(args)}, address, timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("command", choices=["serve", "ping"])
+    parser.add_argument("--address", help="overrides INFERENCE_ADDRESS")
+    parser.add_argument("--model", help="overrides INFERENCE_MODEL")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.address, load_model(args.model))
+    else:
+        try:
+            print(ping(args.address))
+        except InferenceError as e:
+            print(e)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+Deduplication of assessment jobs.
+
+Two launches that ask for the same bbox with the same pre/post images and model
+produce the same results, so each launched job is fingerprinted from its ordered
+coordinate, image IDs and model and recorded in xviewui_job_fingerprints:
+
+- if a finished job with the same images and model covers the bbox, its stored OSM and
+  result polygons inside the bbox are cloned with INSERT ... SELECT and the new job is
+  done straight away; an identical bbox is just the case of a superset that fits exactly
+- if a job with the same fingerprint is still running, the new job attaches to it: it
+  follows the running job's status (update_pdb_status cascades to attached jobs) and
+  gets its results cloned when the running job stores them
+- otherwise the job runs the full chain
+
+Lookups and the hand-over in finish_pdb_job hold a transaction-level advisory lock on
+the fingerprint, so a job can't attach just after the running one has finished.
+"""
+import hashlib
+import json
+import os
+from datetime import timedelta
+
+import psycopg2.sql
+
+import rediscache
+from schemas import Coordinate
+from utils import bump_pdb_results_version, order_coordinate
+
+# Class of the two-key advisory locks taken on fingerprints, keyed apart from
+# PDB_MIGRATION_LOCK
+PDB_JOB_LOCK_CLASS = 0x78766A
+
+# Statuses written by worker.task_error_callback end with this
+ERROR_STATUS_SUFFIX = ":error"
+
+# Status of a job attached to one that is still running
+RUNNING_STATUS = "running_assessment"
+
+# Columns cloned from each per-job polygon table, besides uid
+CLONED_COLUMNS = {
+    "xviewui_osm_polys": ["osmid", "geometry"],
+    "xviewui_results": ["osmid", "dmg", "area", "geometry"],
+}
+
+COORDINATE_DIGITS = 6
+
+NEW = "new"
+ATTACHED = "attached"
+CLONED = "cloned"
+LAUNCHED = "launched"
+
+
+def enabled():
+    return os.getenv("JOB_DEDUP", "true").lower() not in ("0", "false", "off")
+
+
+def max_inflight_age():
+    """Running jobs older than this are assumed stuck and never attached to."""
+    return timedelta(hours=float(os.getenv("JOB_DEDUP_MAX_INFLIGHT_HOURS") or 6))
+
+
+def assessment_model():
+    return os.getenv("CHIP_MODEL") or "xview2"
+
+
+def _digest(item):
+    return hashlib.sha256(json.dumps(item, sort_keys=True).encode()).hexdigest()
+
+
+def imagery_fingerprint(pre_image_id, post_image_id, model=None):
+    return _digest(
+        {
+            "pre_image_id": pre_image_id,
+            "post_image_id": post_image_id,
+            "model": model or assessment_model(),
+        }
+    )
+
+
+def ordered_bbox(coordinate: Coordinate):
+    """
+    Returns
+        (west, south, east, north) of the ordered coordinate
+    """
+    coordinate = order_coordinate(coordinate)
+    return (
+        coordinate.start_lon,
+        coordinate.end_lat,
+        coordinate.end_lon,
+        coordinate.start_lat,
+    )
+
+
+def job_fingerprint(coordinate: Coordinate, pre_image_id, post_image_id, model=None):
+    """
+    Canonical key of a job: the same bbox, however its corners were given, with the
+    same images and model always gets the same fingerprint.
+    """
+    bbox = [round(v, COORDINATE_DIGITS) for v in ordered_bbox(coordinate)]
+    return _digest(
+        {
+            "bbox": bbox,
+            "imagery": imagery_fingerprint(pre_image_id, post_image_id, model),
+        }
+    )
+
+
+def _lock(cur, fingerprint):
+    cur.execute(
+        "SELECT pg_advisory_xact_lock(%s, hashtext(%s))",
+        (PDB_JOB_LOCK_CLASS, fingerprint),
+    )
+
+
+def _clone_polygons(cur, source_uid, uid):
+    """Copies source_uid's polygons inside uid's bbox to uid, replacing uid's own."""
+    for table, columns in CLONED_COLUMNS.items():
+        table = psycopg2.sql.Identifier(table)
+        cur.execute(
+            psycopg2.sql.SQL("DELETE FROM {} WHERE uid = %s").format(table), (uid,)
+        )
+        cur.execute(
+            psycopg2.sql.SQL(
+                """INSERT INTO {table} (uid, {columns})
+                SELECT f.uid, {source_columns}
+                FROM {table} p JOIN xviewui_job_fingerprints f ON f.uid = %s
+                WHERE p.uid = %s
+                AND p.geometry && f.bbox AND ST_Intersects(p.geometry, f.bbox)"""
+            ).format(
+                table=table,
+                columns=psycopg2.sql.SQL(", ").join(
+                    map(psycopg2.sql.Identifier, columns)
+                ),
+                source_columns=psycopg2.sql.SQL(", ").join(
+                    psycopg2.sql.Identifier("p", column) for column in columns
+                ),
+            ),
+            (uid, source_uid),
+        )
+    bump_pdb_results_version(cur, uid)
+
+
+def _set_status(cur, uids, status=rediscache.DONE_STATUS):
+    cur.execute(
+        "UPDATE xviewui_status SET status = %s WHERE uid = ANY(%s::uuid[]) RETURNING uid",
+        (status, [str(uid) for uid in uids]),
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+def _transaction(conn, fn):
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                return fn(cur)
+    finally:
+        conn.autocommit = autocommit
+
+
+def register_pdb_job(conn, uid, coordinate: Coordinate, pre_image_id, post_image_id):
+    """
+    Records a job that is being launched and reuses the results of an equivalent one
+    where possible. Finished matches are cloned before returning and the job's status
+    set to done; attached jobs are set running while the fingerprint is locked, so the
+    running job's finish_pdb_job can't mark them done first.
+
+    Returns
+        (outcome, source_uid): NEW to run the full chain, ATTACHED or CLONED with the
+            job reused, or LAUNCHED if uid was already launched before
+    """
+    uid = str(uid)
+    fingerprint = job_fingerprint(coordinate, pre_image_id, post_image_id)
+    imagery = imagery_fingerprint(pre_image_id, post_image_id)
+    west, south, east, north = ordered_bbox(coordinate)
+
+    def register(cur):
+        _lock(cur, fingerprint)
+        cur.execute(
+            "SELECT source_uid FROM xviewui_job_fingerprints WHERE uid = %s", (uid,)
+        )
+        row = cur.fetchone()
+        if row is not None:
+            return LAUNCHED, row[0], []
+
+        # Any finished job with the same imagery whose bbox covers this one, smallest
+        # first since it has the fewest rows to filter
+        cur.execute(
+            """SELECT f.uid FROM xviewui_job_fingerprints f
+            JOIN xviewui_status s ON s.uid = f.uid
+            WHERE f.imagery_fingerprint = %s AND s.status = %s
+            AND f.bbox ~ ST_MakeEnvelope(%s, %s, %s, %s, 4326)
+            ORDER BY ST_Area(f.bbox) LIMIT 1""",
+            (imagery, rediscache.DONE_STATUS, west, south, east, north),
+        )
+        row = cur.fetchone()
+        if row is not None:
+            outcome, source_uid = CLONED, row[0]
+        else:
+            # A job with the same fingerprint still running its own chain
+            cur.execute(
+                """SELECT f.uid FROM xviewui_job_fingerprints f
+                JOIN xviewui_status s ON s.uid = f.uid
+                WHERE f.fingerprint = %s AND f.source_uid IS NULL
+                AND s.status <> %s AND s.status NOT LIKE %s
+                AND f.created_at > now() - %s
+                ORDER BY f.created_at DESC LIMIT 1""",
+                (
+                    fingerprint,
+                    rediscache.DONE_STATUS,
+                    f"%{ERROR_STATUS_SUFFIX}",
+                    max_inflight_age(),
+                ),
+            )
+            row = cur.fetchone()
+            outcome, source_uid = (ATTACHED, row[0]) if row is not None else (NEW, None)
+
+        cur.execute(
+            """INSERT INTO xviewui_job_fingerprints
+            (uid, fingerprint, imagery_fingerprint, bbox, source_uid)
+            VALUES (%s, %s, %s, ST_MakeEnvelope(%s, %s, %s, %s, 4326), %s)""",
+            (uid, fingerprint, imagery, west, south, east, north, source_uid),
+        )
+
+        done = []
+        if outcome == CLONED:
+            _clone_polygons(cur, source_uid, uid)
+            done = _set_status(cur, [uid])
+        elif outcome == ATTACHED:
+            # Cached before the lock is released too, so it can't overwrite the done
+            # status finish_pdb_job caches once it gets the lock
+            for running_uid in _set_status(cur, [uid], RUNNING_STATUS):
+                rediscache.set_status(running_uid, RUNNING_STATUS)
+        return outcome, source_uid, done
+
+    outcome, source_uid, done = _transaction(conn, register)
+    for done_uid in done:
+        rediscache.set_status(done_uid, rediscache.DONE_STATUS)
+    return outcome, source_uid
+
+
+def finish_pdb_job(conn, uid):
+    """
+    Marks a job done once its results are stored, first cloning them to every job
+    attached to it, which are marked done along with it.
+    """
+    uid = str(uid)
+
+    def finish(cur):
+        cur.execute(
+            "SELECT fingerprint FROM xviewui_job_fingerprints WHERE uid = %s", (uid,)
+        )
+        row = cur.fetchone()
+        attached = []
+        if row is not None:
+            _lock(cur, row[0])
+            cur.execute(
+                """SELECT f.uid FROM xviewui_job_fingerprints f
+                JOIN xviewui_status s ON s.uid = f.uid
+                WHERE f.source_uid = %s AND s.status <> %s""",
+                (uid, rediscache.DONE_STATUS),
+            )
+            attached = [row[0] for row in cur.fetchall()]
+            for attached_uid in attached:
+                _clone_polygons(cur, uid, attached_uid)
+        return _set_status(cur, [uid] + attached)
+
+    for done_uid in _transaction(conn, finish):
+        rediscache.set_status(done_uid, rediscache.DONE_STATUS)
@@ -1,16 +1,23 @@
+import asyncio
 import json
 import os
 import uuid
+import zlib
 from datetime import datetime
 from decimal import Decimal
 from pathlib import Path
 from typing import Dict, List
 
-import geopandas as gpd
 from celery import chain, chord, group
 from dotenv import load_dotenv
 from fastapi import Depends, FastAPI, Header, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+import asyncdb
+import jobdedup
+import rediscache
+from statusevents import StatusEvents
 
 from schemas import (
     Coordinate,
@@ -24,21 +31,28 @@ from utils import (
     awsddb_client,
     create_bounding_box_poly,
     create_postgres_tables,
-    download_planet_imagery,
     get_pdb_coordinate,
-    get_pdb_status,
     get_planet_imagery,
     insert_pdb_coordinates,
     insert_pdb_planet_result,
     insert_pdb_selected_imagery,
     insert_pdb_status,
     order_coordinate,
-    rdspostgis_client,
-    rdspostgis_sa_client,
+    pdb_connection,
     update_pdb_status,
 )
-from worker import get_osm_polys, run_xv, store_results, task_error_callback
+from worker import (
+    STATE_DELIMITER,
+    STATE_ERROR,
+    get_imagery,
+    get_osm_polys,
+    run_chips,
+    run_xv,
+    store_results,
+    task_error_callback,
+)
 from downloader import TileDataset
+from vectortilecache import VectorTileCache
 
 
 def verify_key(access_key: str = Header("null")) -> bool:
@@ -61,6 +75,10 @@ app = FastAPI(
 client = None
 ddb = None
 cursor = None
+mvt_cache = None
+status_events = StatusEvents()
+
+MVT_MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
 
 conf = load_dotenv(override=True)
 
@@ -70,15 +88,25 @@ access_keys = {}
 @app.on_event("startup")
 async def startup_event():
     global ddb
-    global conn
     global access_keys
+    global mvt_cache
 
     # Set up DynamoDB
     ddb = awsddb_client()
 
-    # Create connection to AWS RDS Postgres
-    conn = rdspostgis_client()
-    create_postgres_tables(conn)
+    # Create tables in AWS RDS Postgres. Handlers check connections out of the
+    # process-wide pool with pdb_connection() rather than sharing one connection
+    with pdb_connection() as conn:
+        create_postgres_tables(conn)
+
+    # Pool for the async endpoints
+    await asyncdb.init_pool()
+
+    # Vector tiles of finished jobs are kept in memory
+    mvt_cache = VectorTileCache.from_env()
+
+    # One Redis subscription per process feeds every /jobs/{job_id}/events stream
+    status_events.start(asyncio.get_running_loop())
 
     # Load valid access keys into memory
     access_keys = set(
@@ -86,6 +114,12 @@ async def startup_event():
     )
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    status_events.stop()
+    await asyncdb.close_pool()
+
+
 @app.post("/send-coordinates")
 def send_coordinates(coordinate: Coordinate) -> str:
 
@@ -98,23 +132,77 @@ def send_coordinates(coordinate: Coordinate) -> str:
     # Convert floats to Decimals
     item = json.loads(coordinate.json(), parse_float=Decimal)
 
-    insert_pdb_coordinates(conn, uid, item)
-    insert_pdb_status(conn, uid, "waiting_imagery")
+    with pdb_connection() as conn:
+        insert_pdb_coordinates(conn, uid, item)
+        insert_pdb_status(conn, uid, "waiting_imagery")
 
     return uid
 
 
 @app.get("/fetch-coordinates", response_model=Coordinate)
-def fetch_coordinates(job_id: str) -> Coordinate:
+async def fetch_coordinates(job_id: str) -> Coordinate:
 
-    resp = get_pdb_coordinate(conn, job_id)
+    resp = await asyncdb.get_pdb_coordinate(asyncdb.get_pool(), job_id)
     return resp
 
 
+async def read_job_status(job_id: str):
+    """
+    Read-through lookup of a job's status: Redis first, then Postgres.
+    """
+    status = await run_in_threadpool(rediscache.get_status, job_id)
+    if status is None:
+        status = await asyncdb.get_pdb_status(asyncdb.get_pool(), job_id)
+        if status is not None:
+            await run_in_threadpool(rediscache.fill_status, job_id, status)
+    return status
+
+
+async def cached_payload_response(request: Request, name: str, job_id: str):
+    """
+    Returns the cached JSON payload for a finished job, or None on a miss. Clients that
+    accept deflate get the stored compressed bytes as they are.
+    """
+    blob = await run_in_threadpool(rediscache.get_payload, name, job_id)
+    if blob is None:
+        return None
+
+    if "deflate" in request.headers.get("accept-encoding", ""):
+        return Response(
+            content=blob,
+            media_type="application/json",
+            headers={"Content-Encoding": "deflate", "Vary": "Accept-Encoding"},
+        )
+    content = await run_in_threadpool(rediscache.decompress, blob)
+    return Response(content=content, media_type="application/json")
+
+
+async def cache_payload_stream(name: str, job_id: str, chunks):
+    """
+    Passes a streamed payload through while compressing a copy of it into the cache.
+    Nothing is cached if the stream is cut short or grows past the cache size.
+    """
+    compressor = zlib.compressobj(rediscache.COMPRESS_LEVEL)
+    parts, size, limit = [], 0, rediscache.max_payload_bytes()
+
+    async for chunk in chunks:
+        yield chunk
+        if parts is not None:
+            part = await run_in_threadpool(compressor.compress, chunk)
+            parts.append(part)
+            size += len(part)
+            if size > limit:
+                parts = None
+
+    if parts is not None:
+        parts.append(compressor.flush())
+        await run_in_threadpool(rediscache.put_payload, name, job_id, b"".join(parts))
+
+
 @app.get("/job-status")
-def job_status(job_id: str) -> Dict:
+async def job_status(job_id: str) -> Dict:
 
-    resp = get_pdb_status(conn, job_id)
+    resp = await read_job_status(job_id)
 
     if resp is None:
         return None
@@ -122,8 +210,59 @@ def job_status(job_id: str) -> Dict:
         return {"uid": job_id, "status": resp}
 
 
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, request: Request):
+    """
+    Streams a job's status changes as Server-Sent Events, starting with its current
+    status, until the job is done or a task fails.
+
+        Parameters:
+            job_id (str): Job ID for a task
+
+        Returns:
+            events (text/event-stream): `status` events with {"uid", "status"} data
+    """
+
+    def event(status):
+        data = json.dumps({"uid": job_id, "status": status})
+        return f"event: status\ndata: {data}\n\n".encode()
+
+    def finished(status):
+        return status == rediscache.DONE_STATUS or status.endswith(
+            f"{STATE_DELIMITER}{STATE_ERROR}"
+        )
+
+    async def events():
+        # Subscribe before reading the current status so no change falls in between
+        queue = status_events.subscribe(job_id)
+        try:
+            status = await read_job_status(job_id)
+            if status is not None:
+                yield event(status)
+                if finished(status):
+                    return
+
+            while not await request.is_disconnected():
+                try:
+                    status = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+                    continue
+                yield event(status)
+                if finished(status):
+                    return
+        finally:
+            status_events.unsubscribe(job_id, queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/fetch-osm-polygons", response_model=OsmGeoJson)
-def fetch_osm_polygons(job_id: str) -> Dict:
+async def fetch_osm_polygons(job_id: str, request: Request) -> Dict:
     """
     Returns GeoJSON for a Job ID that exists in DynamoDB.
 
@@ -133,22 +272,32 @@ def fetch_osm_polygons(job_id: str) -> Dict:
         Returns:
             osm_geojson (dict): The FeatureCollection representing all building polygons for the bounding box
     """
-    engine = rdspostgis_sa_client()
-    sql = f"SELECT geometry FROM xviewui_osm_polys WHERE uid='{job_id}'"
-    gdf = gpd.GeoDataFrame.from_postgis(sql, engine, geom_col="geometry")
-
-    geojson = json.loads(gdf.to_json())
+    cached = await cached_payload_response(request, "osm_polygons", job_id)
+    if cached is not None:
+        return cached
 
-    if len(geojson["features"]) == 0:
+    pool = asyncdb.get_pool()
+    if not await asyncdb.has_pdb_osm_polygons(pool, job_id):
         return None
-    else:
-        return {"uid": job_id, "geojson": geojson}
+
+    # The FeatureCollection is generated by PostGIS and streamed straight through
+    body = asyncdb.stream_feature_collection(
+        pool,
+        asyncdb.OSM_POLYGON_FEATURES_SQL,
+        job_id,
+        prefix=f'{{"uid": {json.dumps(job_id)}, "geojson": '.encode(),
+        suffix=b"}",
+    )
+    if await read_job_status(job_id) == rediscache.DONE_STATUS:
+        body = cache_payload_stream("osm_polygons", job_id, body)
+    return StreamingResponse(body, media_type="application/json")
 
 
 @app.post("/fetch-planet-imagery", response_model=Planet)
 def fetch_planet_imagery(body: FetchPlanetImagery) -> List[Dict]:
     # Get the coordinates for the job from DynamoDB
-    coords = fetch_coordinates(body.job_id)
+    with pdb_connection() as conn:
+        coords = get_pdb_coordinate(conn, body.job_id)
 
     # Convert the coordinates to a Shapely polygon
     bounding_box = create_bounding_box_poly(coords)
@@ -169,11 +318,12 @@ def fetch_planet_imagery(body: FetchPlanetImagery) -> List[Dict]:
             }
         )
 
-    # Insert Planet API results to Postgres as blob
-    insert_pdb_planet_result(conn, body.job_id, json.dumps(ret))
+    with pdb_connection() as conn:
+        # Insert Planet API results to Postgres as blob
+        insert_pdb_planet_result(conn, body.job_id, json.dumps(ret))
 
-    # Update status of job
-    update_pdb_status(conn, body.job_id, "waiting_assessment")
+        # Update status of job
+        update_pdb_status(conn, body.job_id, "waiting_assessment")
 
     return Planet(uid=body.job_id, images=ret)
 
@@ -181,30 +331,35 @@ def fetch_planet_imagery(body: FetchPlanetImagery) -> List[Dict]:
 @app.post("/launch-assessment")
 def launch_assessment(body: LaunchAssessment):
 
-    # Insert selected imagery IDs to Postgres
-    insert_pdb_selected_imagery(
-        conn, body.job_id, body.pre_image_id, body.post_image_id
-    )
+    with pdb_connection() as conn:
+        coords = get_pdb_coordinate(conn, body.job_id)
+
+    # Reuse an earlier job for the same bbox and imagery where there is one: its results
+    # are cloned if it has finished, or handed over when it does
+    outcome = jobdedup.NEW
+    if jobdedup.enabled():
+        with pdb_connection() as conn:
+            outcome, source_uid = jobdedup.register_pdb_job(
+                conn, body.job_id, coords, body.pre_image_id, body.post_image_id
+            )
+        if outcome == jobdedup.LAUNCHED:
+            # Repeated click on a job that is already running or done
+            return None
+        if outcome != jobdedup.NEW:
+            print(f"Job {body.job_id} reuses job {source_uid} ({outcome})")
 
-    # Download the images for given job
-    coords = fetch_coordinates(body.job_id)
+    # Insert selected imagery IDs to Postgres
+    with pdb_connection() as conn:
+        insert_pdb_selected_imagery(
+            conn, body.job_id, body.pre_image_id, body.post_image_id
+        )
 
-    # Convert the coordinates to a Shapely polygon
-    bounding_box = create_bounding_box_poly(coords)
+    if outcome in (jobdedup.CLONED, jobdedup.ATTACHED):
+        # register_pdb_job has already set the job's status
+        return None
 
-    temp_dir_path = Path(os.getenv("PLANET_IMAGERY_TEMP_DIR"))
     output_dir_path = Path(os.getenv("PLANET_IMAGERY_OUTPUT_DIR"))
 
-    for pre_post in ["pre", "post"]:
-        if pre_post == "pre":
-            image = body.pre_image_id
-        else:
-            image = body.post_image_id
-
-        url = f"https://tiles0.planet.com/data/v1/SkySatCollect/{image}/{{z}}/{{x}}/{{y}}.png?api_key={os.getenv('PLANET_API_KEY')}"
-
-        download_planet_imagery(url, pre_post, output_dir_path, body.job_id, bounding_box)
-
     # Prepare our args for fetching OSM data
     bbox = (coords.start_lat, coords.end_lat, coords.end_lon, coords.start_lon)
     osm_out_path = (
@@ -226,24 +381,31 @@ def launch_assessment(body: LaunchAssessment):
     # Todo: check that we got polygons before we write the file, and make sure we have the file before we pass it as an arg
     args += ["--bldg_polys", str(osm_out_path)]
 
-    # Run our celery tasks
+    damage_path = output_dir_path / body.job_id / "output" / "vector" / "damage.geojson"
+
+    # With a chip model configured, inference runs in the backend and only on chips
+    # with buildings, and every OSM footprint gets its own damage score
+    if os.getenv("CHIP_MODEL"):
+        assess = run_chips.si(body.job_id, str(osm_out_path), str(damage_path))
+    else:
+        assess = run_xv.si(body.job_id, args)
+
+    # Run our celery tasks. The imagery downloads and the OSM fetch run in parallel and
+    # inference is chorded after all three. Use pipes to avoid chain/chord bug
+    # https://github.com/celery/celery/issues/6197
     infer = (
-        get_osm_polys.si(body.job_id, str(osm_out_path), bbox)
-        | run_xv.si(body.job_id, args)
-        | store_results.si(
-            str(
-                output_dir_path
-                / body.job_id
-                / "output"
-                / "vector"
-                / "damage.geojson"
-            ),
-            body.job_id,
+        group(
+            get_imagery.si(body.job_id, body.pre_image_id, "pre", coords.dict()),
+            get_imagery.si(body.job_id, body.post_image_id, "post", coords.dict()),
+            get_osm_polys.si(body.job_id, str(osm_out_path), bbox),
         )
+        | assess
+        | store_results.si(str(damage_path), body.job_id)
     )
 
     # Update job status
-    update_pdb_status(conn, body.job_id, "running_assessment")
+    with pdb_connection() as conn:
+        update_pdb_status(conn, body.job_id, "running_assessment")
 
     result = infer.apply_async(link_error=task_error_callback.s(body.job_id))
 
@@ -251,7 +413,7 @@ def launch_assessment(body: LaunchAssessment):
 
 
 @app.get("/fetch-assessment")
-def fetch_assessment(job_id: str):
+async def fetch_assessment(job_id: str, request: Request):
 
     # Required for serialization of DDB object
     def dumps(item: dict) -> str:
@@ -262,15 +424,60 @@ def fetch_assessment(job_id: str):
             return float(obj)
         raise TypeError
 
-    engine = rdspostgis_sa_client()
-    sql = f"SELECT dmg, geometry FROM xviewui_results WHERE uid='{job_id}'"
-    gdf = gpd.GeoDataFrame.from_postgis(sql, engine, geom_col="geometry")
+    cached = await cached_payload_response(request, "assessment", job_id)
+    if cached is not None:
+        return cached
+
+    # The stored response is in EPSG 4326 for Deck.gl to render. The FeatureCollection
+    # is generated by PostGIS and streamed straight through
+    body = asyncdb.stream_feature_collection(
+        asyncdb.get_pool(), asyncdb.RESULT_FEATURES_SQL, job_id
+    )
+    if await read_job_status(job_id) == rediscache.DONE_STATUS:
+        body = cache_payload_stream("assessment", job_id, body)
+    return StreamingResponse(body, media_type="application/json")    
+
+
+@app.get("/jobs/{job_id}/tiles/{z}/{x}/{y}.mvt")
+async def fetch_vector_tile(
+    job_id: str, z: int, x: int, y: int, if_none_match: str = Header(None)
+):
+    """
+    Returns a Mapbox vector tile of a job's assessment and OSM polygons.
 
-    # The stored response is in a local, projected CRS. We reproject to EPSG 4326 for Deck.gl to render.
-    if gdf is not None:
-        return json.loads(gdf.to_json())
+        Parameters:
+            job_id (str): Job ID for a task
+            z, x, y (int): Web Mercator tile index
+
+        Returns:
+            tile (bytes): The `assessment` (dmg, area, osmid) and `osm` (osmid) layers
+                clipped to the tile
+    """
+    if not (0 <= z <= 30 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=400, detail="Invalid tile index")
+
+    # Results can be stored again by a re-run, so cached tiles are keyed on the
+    # version of the job's rows and clients revalidate with the ETag
+    pool = asyncdb.get_pool()
+    version = await asyncdb.get_pdb_results_version(pool, job_id)
+    cached = mvt_cache.get(job_id, version, z, x, y)
+    if cached is not None:
+        data, etag = cached
     else:
-        return None    
+        data = await asyncdb.get_pdb_mvt(pool, job_id, z, x, y)
+        etag = VectorTileCache.etag(data)
+
+        # Tiles only stop changing once the results have been stored
+        if await read_job_status(job_id) == rediscache.DONE_STATUS:
+            mvt_cache.put(job_id, version, z, x, y, data, etag)
+
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if if_none_match is not None and etag in [
+        tag.strip() for tag in if_none_match.split(",")
+    ]:
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=data, media_type=MVT_MEDIA_TYPE, headers=headers)
 
 
 # No longer works but this is how we should call our chain/chord
@@ -289,7 +496,7 @@ def fetch_assessment(job_id: str):
 # 3. Send imagery to UI. ✅
 # 4. User selects pre and post image and submits. ✅
 # 5. Launch the AI inference.
-# 6. Once 1A and 5 are done, clip the AI polygons with the OSM polygons
+# 6. Once 1A and 5 are done, clip the AI polygons with the OSM polygons ✅ (run_chips)
 # 7. Return the GeoJSON to the UI for rendering
 
 # Nice to haves
@@ -297,5 +504,5 @@ def fetch_assessment(job_id: str):
 # 2. Opacity slider for the displayed GeoJSON.
 # 3. A method in which a count of damaged polygons can be displayed to the user.
 # 4. The ability to search for a location using Military Grid Reference System.
-# 5. Caching user requests.
+# 5. Caching user requests. ✅ (jobdedup)
 # 6. Better localization models / improved ability to create regular polygons (not blobby).
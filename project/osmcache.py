@@ -0,0 +1,324 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from datetime import timedelta
+from pathlib import Path
+
+import geopandas as gpd
+import mercantile
+import numpy as np
+import osmnx as ox
+import pandas as pd
+import shapely
+
+from tileserverutils import bbox_to_tiles, bbox_to_xyz
+from utils import copy_pdb_polygons, pdb_connection
+
+COLUMNS = ["element_type", "osmid"]
+
+# osmnx raises instead of returning an empty frame when an area has no matching
+# features; the exception was renamed across releases
+_EMPTY_RESPONSE_ERRORS = tuple(
+    getattr(ox._errors, name)
+    for name in ("EmptyOverpassResponse", "InsufficientResponseError")
+    if hasattr(ox._errors, name)
+)
+
+
+def empty_footprints():
+    return gpd.GeoDataFrame(
+        {"element_type": pd.Series(dtype=str), "osmid": pd.Series(dtype="int64")},
+        geometry=gpd.GeoSeries([], crs=4326),
+    )
+
+
+def fetch_osm_footprints(north, south, east, west, tags):
+    """
+    Queries Overpass for the non-node features matching tags in the bbox.
+
+    Returns
+        a GeoDataFrame with element_type, osmid and geometry columns in EPSG 4326
+    """
+    try:
+        gdf = ox.geometries_from_bbox(north, south, east, west, tags=tags)
+    except _EMPTY_RESPONSE_ERRORS:
+        return empty_footprints()
+
+    gdf = gdf.reset_index()
+    gdf = gdf.loc[gdf.element_type != "node", COLUMNS + ["geometry"]]
+    return gpd.GeoDataFrame(gdf.reset_index(drop=True), geometry="geometry", crs=4326)
+
+
+class FileOsmTileStore:
+    """
+    Keeps each cached tile's footprints in a GeoParquet file whose mtime is the time
+    the tile was fetched. Files are written atomically so workers can share the cache
+    directory.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+
+    def _path(self, namespace, quadkey):
+        return self.cache_dir / namespace / f"{quadkey}.parquet"
+
+    def get(self, namespace, quadkeys, max_age):
+        """
+        Returns
+            {quadkey: GeoDataFrame} for the requested tiles that are cached and fresh
+        """
+        oldest = time.time() - max_age.total_seconds()
+        tiles = {}
+        for quadkey in quadkeys:
+            path = self._path(namespace, quadkey)
+            try:
+                if path.stat().st_mtime < oldest:
+                    continue
+                tiles[quadkey] = gpd.read_parquet(path)
+            except FileNotFoundError:
+                # Never cached or evicted by another worker
+                continue
+        return tiles
+
+    def put(self, namespace, tiles):
+        directory = self.cache_dir / namespace
+        directory.mkdir(parents=True, exist_ok=True)
+        for quadkey, gdf in tiles.items():
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            os.close(fd)
+            gdf.to_parquet(tmp_path)
+            os.replace(tmp_path, self._path(namespace, quadkey))
+
+    def evict(self, max_age):
+        """
+        Deletes tiles older than max_age, then the oldest remaining tiles until the
+        cache fits in max_bytes.
+        """
+        oldest = time.time() - max_age.total_seconds()
+        entries = []
+        for path in self.cache_dir.glob("*/*.parquet"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime < oldest:
+                path.unlink(missing_ok=True)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        if self.max_bytes is None:
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+
+class PostgisOsmTileStore:
+    """
+    Keeps cached tiles in the xviewui_osm_tiles / xviewui_osm_tile_polys tables, so
+    every worker shares one cache without a shared filesystem.
+    """
+
+    def __init__(self, max_tiles=None):
+        self.max_tiles = max_tiles
+
+    def get(self, namespace, quadkeys, max_age):
+        with pdb_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """SELECT quadkey FROM xviewui_osm_tiles
+                    WHERE namespace = %s AND quadkey = ANY(%s)
+                    AND fetched_at > now() - %s""",
+                    (namespace, list(quadkeys), max_age),
+                )
+                fresh = [row[0] for row in cur.fetchall()]
+                cur.execute(
+                    """SELECT quadkey, element_type, osmid, ST_AsBinary(geometry)
+                    FROM xviewui_osm_tile_polys
+                    WHERE namespace = %s AND quadkey = ANY(%s)""",
+                    (namespace, fresh),
+                )
+                rows = cur.fetchall()
+
+        if not rows:
+            return {quadkey: empty_footprints() for quadkey in fresh}
+
+        quadkey, element_type, osmid, wkb = zip(*rows)
+        gdf = gpd.GeoDataFrame(
+            {"element_type": element_type, "osmid": np.array(osmid, dtype="int64")},
+            geometry=shapely.from_wkb([bytes(b) for b in wkb]),
+            crs=4326,
+        )
+        quadkey = np.array(quadkey)
+        return {
+            key: gdf[quadkey == key].reset_index(drop=True) for key in fresh
+        }
+
+    def put(self, namespace, tiles):
+        quadkeys = list(tiles)
+        gdf = pd.concat(
+            [gdf.assign(quadkey=quadkey) for quadkey, gdf in tiles.items()],
+            ignore_index=True,
+        )
+        df = gdf[["quadkey"] + COLUMNS].astype({"osmid": str})
+        df.insert(0, "namespace", namespace)
+
+        with pdb_connection() as conn:
+            conn.autocommit = False
+            try:
+                with conn:
+                    with conn.cursor() as cur:
+                        cur.execute(
+                            """DELETE FROM xviewui_osm_tile_polys
+                            WHERE namespace = %s AND quadkey = ANY(%s)""",
+                            (namespace, quadkeys),
+                        )
+                        copy_pdb_polygons(cur, "xviewui_osm_tile_polys", df, gdf.geometry)
+                        cur.execute(
+                            """INSERT INTO xviewui_osm_tiles (namespace, quadkey)
+                            SELECT %s, unnest(%s::text[])
+                            ON CONFLICT (namespace, quadkey)
+                            DO UPDATE SET fetched_at = now()""",
+                            (namespace, quadkeys),
+                        )
+            finally:
+                conn.autocommit = True
+
+    def evict(self, max_age):
+        """
+        Deletes tiles older than max_age, then the oldest remaining tiles until at most
+        max_tiles are left.
+        """
+        condition = "fetched_at <= now() - %(max_age)s"
+        if self.max_tiles is not None:
+            condition += """ OR (namespace, quadkey) IN (
+                SELECT namespace, quadkey FROM xviewui_osm_tiles
+                ORDER BY fetched_at DESC OFFSET %(max_tiles)s
+            )"""
+
+        with pdb_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""WITH evicted AS (
+                        DELETE FROM xviewui_osm_tiles WHERE {condition}
+                        RETURNING namespace, quadkey
+                    )
+                    DELETE FROM xviewui_osm_tile_polys p USING evicted e
+                    WHERE p.namespace = e.namespace AND p.quadkey = e.quadkey""",
+                    {"max_age": max_age, "max_tiles": self.max_tiles},
+                )
+
+
+class OsmFootprintCache:
+    """
+    Caches OSM footprints per zoom-`zoom` web mercator tile, keyed by quadkey.
+
+    A job's bbox is served from the fresh cached tiles it covers; the tiles that are
+    missing or stale are fetched from Overpass in one request over the rectangle that
+    spans them, split per tile and stored. Footprints that straddle tiles are stored
+    with each of them and deduplicated on read.
+    """
+
+    def __init__(
+        self, store, fetch=fetch_osm_footprints, zoom=14, max_age=timedelta(days=30)
+    ):
+        self.store = store
+        self.fetch = fetch
+        self.zoom = zoom
+        self.max_age = max_age
+
+    @classmethod
+    def from_env(cls):
+        """
+        Builds an OsmFootprintCache from OSM_CACHE_BACKEND (file or postgis),
+        OSM_CACHE_DIR, OSM_CACHE_MAX_AGE_DAYS, OSM_CACHE_MAX_BYTES and
+        OSM_CACHE_MAX_TILES, or returns None if no backend is configured or the file
+        backend has no cache directory.
+        """
+        backend = os.getenv("OSM_CACHE_BACKEND")
+        max_bytes = os.getenv("OSM_CACHE_MAX_BYTES")
+        max_tiles = os.getenv("OSM_CACHE_MAX_TILES")
+        if backend == "file":
+            cache_dir = os.getenv("OSM_CACHE_DIR")
+            if not cache_dir:
+                # Path("") is the working directory, which eviction would then prune
+                return None
+            store = FileOsmTileStore(cache_dir, int(max_bytes) if max_bytes else None)
+        elif backend == "postgis":
+            store = PostgisOsmTileStore(int(max_tiles) if max_tiles else None)
+        else:
+            return None
+
+        max_age_days = os.getenv("OSM_CACHE_MAX_AGE_DAYS")
+        if max_age_days:
+            return cls(store, max_age=timedelta(days=float(max_age_days)))
+        return cls(store)
+
+    @staticmethod
+    def namespace(tags):
+        return hashlib.sha256(json.dumps(tags, sort_keys=True).encode()).hexdigest()[:16]
+
+    def _split(self, gdf, xs, ys):
+        """Assigns each footprint to every tile its bounds touch."""
+        bounds = shapely.bounds(np.asarray(gdf.geometry.values))
+        x_min, x_max, y_min, y_max = bbox_to_xyz(
+            bounds[:, 0], bounds[:, 2], bounds[:, 1], bounds[:, 3], self.zoom
+        )
+        tiles = {}
+        for x, y in zip(xs, ys):
+            mask = (x_min <= x) & (x <= x_max) & (y_min <= y) & (y <= y_max)
+            quadkey = mercantile.quadkey(int(x), int(y), self.zoom)
+            tiles[quadkey] = gdf[mask].reset_index(drop=True)
+        return tiles
+
+    def get_footprints(self, north, south, east, west, tags={"building": True}):
+        """
+        Returns
+            a GeoDataFrame of the footprints intersecting the bbox, with element_type,
+                osmid and geometry columns in EPSG 4326
+        """
+        north, south = max(north, south), min(north, south)
+        east, west = max(east, west), min(east, west)
+        namespace = self.namespace(tags)
+
+        xs, ys, _, _ = bbox_to_tiles(west, east, south, north, self.zoom)
+        quadkeys = [
+            mercantile.quadkey(int(x), int(y), self.zoom) for x, y in zip(xs, ys)
+        ]
+        tiles = self.store.get(namespace, quadkeys, self.max_age)
+
+        missing = np.array([quadkey not in tiles for quadkey in quadkeys])
+        print(
+            f"OSM footprint cache: {len(quadkeys) - missing.sum()} of {len(quadkeys)} "
+            f"zoom {self.zoom} tiles cached"
+        )
+        if missing.any():
+            # Every tile inside the rectangle spanning the missing ones is refetched
+            x0, x1 = xs[missing].min(), xs[missing].max()
+            y0, y1 = ys[missing].min(), ys[missing].max()
+            rect_west = mercantile.bounds(int(x0), int(y0), self.zoom).west
+            rect_north = mercantile.bounds(int(x0), int(y0), self.zoom).north
+            rect_east = mercantile.bounds(int(x1), int(y1), self.zoom).east
+            rect_south = mercantile.bounds(int(x1), int(y1), self.zoom).south
+
+            fetched = self.fetch(rect_north, rect_south, rect_east, rect_west, tags)
+            inside = (xs >= x0) & (xs <= x1) & (ys >= y0) & (ys <= y1)
+            fetched_tiles = self._split(fetched, xs[inside], ys[inside])
+            self.store.put(namespace, fetched_tiles)
+            self.store.evict(self.max_age)
+            tiles.update(fetched_tiles)
+
+        frames = [tiles[quadkey] for quadkey in quadkeys if len(tiles[quadkey])]
+        if not frames:
+            return empty_footprints()
+
+        gdf = gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs=4326)
+        gdf = gdf.drop_duplicates(subset=COLUMNS)
+        gdf = gdf[gdf.intersects(shapely.box(west, south, east, north))]
+        return gdf.reset_index(drop=True)
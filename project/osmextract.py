@@ -0,0 +1,192 @@
+"""
+Offline OSM footprint source built from a local .osm.pbf regional extract.
+
+`build` reads the extract once with pyosmium and writes the matching footprints to a
+GeoParquet file, sorted along a Z-order curve and carrying per-feature bbox columns.
+Every row group therefore covers a compact area, and bbox queries read only the row
+groups whose min/max statistics overlap the query. Build an extract with:
+    python osmextract.py build region-latest.osm.pbf region-buildings.parquet
+"""
+import argparse
+import json
+import os
+
+import geopandas as gpd
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import shapely
+
+from tileserverutils import latlon_to_xyz
+
+BBOX_COLUMNS = ["minx", "miny", "maxx", "maxy"]
+TAGS_METADATA_KEY = b"xviewui:tags"
+SORT_ZOOM = 16
+
+
+def _matches(tags, wanted):
+    """osmnx-style tag filter: True matches any value, a str or list specific ones."""
+    for key, value in wanted.items():
+        if key not in tags:
+            continue
+        if value is True and tags.get(key) != "no":
+            return True
+        if isinstance(value, str) and tags.get(key) == value:
+            return True
+        if isinstance(value, list) and tags.get(key) in value:
+            return True
+    return False
+
+
+def _interleave(v):
+    v = v.astype(np.uint64)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+    v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return v
+
+
+def _zorder(bounds):
+    """Z-order (quadkey order) of the bbox centres at SORT_ZOOM."""
+    lon = (bounds[:, 0] + bounds[:, 2]) / 2
+    lat = (bounds[:, 1] + bounds[:, 3]) / 2
+    x, y = latlon_to_xyz(lat, lon, SORT_ZOOM)
+    tile_max = 2 ** SORT_ZOOM - 1
+    x = np.clip(np.floor(x), 0, tile_max)
+    y = np.clip(np.floor(y), 0, tile_max)
+    return _interleave(x) | (_interleave(y) << np.uint64(1))
+
+
+def build(pbf_path, out_path, tags={"building": True}, row_group_size=4096):
+    """
+    Indexes the areas matching tags in an .osm.pbf extract into a GeoParquet file.
+    """
+    # Only needed to build extracts, not to query them
+    import osmium
+
+    class FootprintHandler(osmium.SimpleHandler):
+        def __init__(self):
+            super().__init__()
+            self.factory = osmium.geom.WKBFactory()
+            self.element_type = []
+            self.osmid = []
+            self.wkb = []
+
+        def area(self, a):
+            if not _matches(a.tags, tags):
+                return
+            try:
+                wkb = self.factory.create_multipolygon(a)
+            except RuntimeError:
+                # Broken multipolygon or missing node locations in the extract
+                return
+            self.element_type.append("way" if a.from_way() else "relation")
+            self.osmid.append(a.orig_id())
+            self.wkb.append(wkb)
+
+    handler = FootprintHandler()
+    handler.apply_file(str(pbf_path), locations=True, idx="flex_mem")
+    print(f"Read {len(handler.wkb)} footprints from {pbf_path}")
+
+    wkb = np.array([bytes.fromhex(w) for w in handler.wkb], dtype=object)
+    bounds = shapely.bounds(shapely.from_wkb(wkb))
+    order = np.argsort(_zorder(bounds), kind="stable")
+
+    # Plain GeoParquet: WKB geometries, CRS84 by default
+    geo = {
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        "columns": {"geometry": {"encoding": "WKB", "geometry_types": []}},
+    }
+    table = pa.table(
+        {
+            "element_type": pa.array(handler.element_type, pa.string()).take(order),
+            "osmid": pa.array(handler.osmid, pa.int64()).take(order),
+            **{name: bounds[order, i] for i, name in enumerate(BBOX_COLUMNS)},
+            "geometry": pa.array(wkb[order], pa.binary()),
+        },
+        metadata={
+            b"geo": json.dumps(geo),
+            TAGS_METADATA_KEY: json.dumps(tags, sort_keys=True),
+        },
+    )
+    pq.write_table(table, out_path, row_group_size=row_group_size)
+    print(f"Wrote {len(wkb)} footprints to {out_path}")
+
+
+class OsmExtract:
+    """
+    Answers bbox footprint queries from a GeoParquet file written by `build`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dataset = ds.dataset(path, format="parquet")
+        metadata = self.dataset.schema.metadata or {}
+        self.tags = json.loads(metadata.get(TAGS_METADATA_KEY, b"null"))
+
+    @classmethod
+    def from_env(cls):
+        """Opens the extract at OSM_EXTRACT_PATH."""
+        return cls(os.getenv("OSM_EXTRACT_PATH"))
+
+    def get_footprints(self, north, south, east, west, tags={"building": True}):
+        """
+        Returns
+            a GeoDataFrame of the footprints intersecting the bbox, with element_type,
+                osmid and geometry columns in EPSG 4326, like fetch_osm_footprints
+        Raises
+            ValueError if the extract was built for other tags
+        """
+        if self.tags is not None and self.tags != json.loads(
+            json.dumps(tags, sort_keys=True)
+        ):
+            raise ValueError(
+                f"{self.path} holds footprints for tags {self.tags}, not {tags}"
+            )
+
+        north, south = max(north, south), min(north, south)
+        east, west = max(east, west), min(east, west)
+        table = self.dataset.to_table(
+            columns=["element_type", "osmid", "geometry"],
+            filter=(ds.field("maxx") >= west)
+            & (ds.field("minx") <= east)
+            & (ds.field("maxy") >= south)
+            & (ds.field("miny") <= north),
+        )
+
+        gdf = gpd.GeoDataFrame(
+            {
+                "element_type": table.column("element_type").to_numpy(
+                    zero_copy_only=False
+                ),
+                "osmid": table.column("osmid").to_numpy(),
+            },
+            geometry=shapely.from_wkb(
+                table.column("geometry").to_numpy(zero_copy_only=False)
+            ),
+            crs=4326,
+        )
+        return gdf[gdf.intersects(shapely.box(west, south, east, north))].reset_index(
+            drop=True
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="index an .osm.pbf extract")
+    build_parser.add_argument("pbf_path")
+    build_parser.add_argument("out_path")
+    build_parser.add_argument("--row-group-size", type=int, default=4096)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build(args.pbf_path, args.out_path, row_group_size=args.row_group_size)
+
+
+if __name__ == "__main__":
+    main()
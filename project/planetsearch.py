@@ -0,0 +1,258 @@
+"""
+Cached Planet quick-search.
+
+Searches are cached in Redis per normalized filter: the date window (its end rounded up
+to the hour), cloud cover, item types and the fixed permission/quality filters. The
+search geometry is snapped outwards to a PLANET_SEARCH_SNAP_DEGREES grid before it is
+sent, so nearby AOIs share a search, and a later AOI covered by any cached search
+geometry is answered from that search's item footprints with a local shapely
+intersection instead of another API call.
+
+Result pages are followed lazily through `_links._next` and no more are requested once
+PLANET_SEARCH_MAX_ITEMS items have been read. A search cut short that way only answers
+AOIs with the same snapped geometry, since items further down its list are missing.
+Like rediscache, any Redis error is logged and treated as a cache miss.
+"""
+import hashlib
+import json
+import math
+import os
+import zlib
+from datetime import timedelta
+
+import dateutil.parser
+import planet.api as api
+import redis
+import requests
+import shapely
+from dateutil.relativedelta import relativedelta
+from requests.auth import HTTPBasicAuth
+from shapely.geometry import mapping
+
+import rediscache
+
+QUICK_SEARCH_URL = "https://api.planet.com/data/v1/quick-search"
+KEY_PREFIX = f"{rediscache.KEY_PREFIX}:planet_search"
+
+
+def _index_key(filter_key):
+    return f"{KEY_PREFIX}:{filter_key}"
+
+
+def _search_key(filter_key, bounds):
+    return f"{KEY_PREFIX}:{filter_key}:{bounds}"
+
+
+def date_window(current_date, years=1):
+    """
+    Returns
+        (start, end) of the search window ending at current_date, rounded up to the
+            hour so repeated searches within an hour share a cache key
+    """
+    end = dateutil.parser.isoparse(current_date)
+    floored = end.replace(minute=0, second=0, microsecond=0)
+    if floored != end:
+        end = floored + timedelta(hours=1)
+    return end - relativedelta(years=years), end
+
+
+def snap_bounds(geom, snap_degrees):
+    """
+    Returns
+        the bounds of geom snapped outwards to a snap_degrees grid, as a
+            "west,south,east,north" string
+    """
+    west, south, east, north = geom.bounds
+    if snap_degrees:
+        west = math.floor(west / snap_degrees) * snap_degrees
+        south = math.floor(south / snap_degrees) * snap_degrees
+        east = math.ceil(east / snap_degrees) * snap_degrees
+        north = math.ceil(north / snap_degrees) * snap_degrees
+    return ",".join(f"{v:.6f}" for v in (west, south, east, north))
+
+
+def search_request(geometry, start, end, cloud_cover=0.2, item_types=("SkySatCollect",)):
+    query = api.filters.and_filter(
+        api.filters.geom_filter(geometry),
+        api.filters.date_range("acquired", gte=start, lte=end),
+        api.filters.range_filter("cloud_cover", lte=cloud_cover),
+        api.filters.permission_filter("assets.ortho_pansharpened:download"),
+        api.filters.string_filter("quality_category", "standard"),
+    )
+    return api.filters.build_search_request(query, list(item_types))
+
+
+class PlanetSearch:
+    """
+    Args:
+        api_key: Planet API key
+        ttl: seconds a cached search stays valid; 0 disables the cache
+        snap_degrees: grid the search geometry is snapped out to; 0 searches the AOI's
+            own bounds
+        max_items: items read per search, across pages
+        timeout: seconds to wait for each page
+        page_size: items requested per page
+    """
+
+    def __init__(
+        self,
+        api_key,
+        ttl=3600,
+        snap_degrees=0.02,
+        max_items=500,
+        timeout=30,
+        page_size=250,
+    ):
+        self.api_key = api_key
+        self.ttl = ttl
+        self.snap_degrees = snap_degrees
+        self.max_items = max_items
+        self.timeout = timeout
+        self.page_size = page_size
+
+    @classmethod
+    def from_env(cls, api_key):
+        """
+        Builds a PlanetSearch using PLANET_SEARCH_CACHE_TTL, PLANET_SEARCH_SNAP_DEGREES,
+        PLANET_SEARCH_MAX_ITEMS and PLANET_SEARCH_TIMEOUT when they are set.
+        """
+        settings = {
+            "ttl": ("PLANET_SEARCH_CACHE_TTL", int),
+            "snap_degrees": ("PLANET_SEARCH_SNAP_DEGREES", float),
+            "max_items": ("PLANET_SEARCH_MAX_ITEMS", int),
+            "timeout": ("PLANET_SEARCH_TIMEOUT", float),
+        }
+        kwargs = {}
+        for name, (env, cast) in settings.items():
+            if os.getenv(env):
+                kwargs[name] = cast(os.getenv(env))
+        return cls(api_key, **kwargs)
+
+    def pages(self, request):
+        """
+        Yields
+            (features, has_next) for each page of the search, fetching the next page
+                only when asked for it
+        """
+        with requests.Session() as session:
+            session.auth = HTTPBasicAuth(self.api_key, "")
+            response = session.post(
+                QUICK_SEARCH_URL,
+                params={"_page_size": self.page_size},
+                json=request,
+                timeout=self.timeout,
+            )
+            while True:
+                response.raise_for_status()
+                page = response.json()
+                next_url = page.get("_links", {}).get("_next")
+                has_next = bool(next_url and page["features"])
+                yield page["features"], has_next
+                if not has_next:
+                    return
+                response = session.get(next_url, timeout=self.timeout)
+
+    def _fetch(self, request):
+        """
+        Returns
+            (features, complete): the first max_items features and whether that is all
+                of them
+        """
+        features = []
+        for page, has_next in self.pages(request):
+            features += [
+                {
+                    "id": f["id"],
+                    "published": f["properties"]["published"],
+                    "geometry": f["geometry"],
+                }
+                for f in page
+            ]
+            if len(features) >= self.max_items:
+                complete = not has_next and len(features) == self.max_items
+                return features[: self.max_items], complete
+        return features, True
+
+    def _cached(self, filter_key, geom, bounds):
+        """
+        Returns
+            the cached features of the smallest fresh search that can answer geom, or
+                None
+        """
+        client = rediscache.get_client()
+        index_key = _index_key(filter_key)
+        candidates = []
+        for member in client.smembers(index_key):
+            member = member.decode()
+            box = shapely.box(*map(float, member.split(",")))
+            if box.covers(geom):
+                candidates.append((box.area, member))
+
+        for _, member in sorted(candidates):
+            blob = client.get(_search_key(filter_key, member))
+            if blob is None:
+                # Expired
+                client.srem(index_key, member)
+                continue
+            entry = json.loads(zlib.decompress(blob))
+            if entry["complete"] or member == bounds:
+                return entry["features"]
+        return None
+
+    def _store(self, filter_key, bounds, features, complete):
+        blob = zlib.compress(
+            json.dumps({"complete": complete, "features": features}).encode(),
+            rediscache.COMPRESS_LEVEL,
+        )
+        pipe = rediscache.get_client().pipeline()
+        pipe.set(_search_key(filter_key, bounds), blob, ex=self.ttl)
+        pipe.sadd(_index_key(filter_key), bounds)
+        pipe.expire(_index_key(filter_key), self.ttl)
+        pipe.execute()
+
+    def search(
+        self, geom, current_date, cloud_cover=0.2, item_types=("SkySatCollect",)
+    ):
+        """
+        Returns
+            [{"image_id", "timestamp"}] of the items intersecting geom acquired in the
+                year up to current_date, in the order Planet returns them
+        """
+        start, end = date_window(current_date)
+        filter_key = hashlib.sha256(
+            json.dumps(
+                search_request(None, start, end, cloud_cover, item_types),
+                sort_keys=True,
+            ).encode()
+        ).hexdigest()[:16]
+        bounds = snap_bounds(geom, self.snap_degrees)
+
+        features = None
+        if self.ttl:
+            try:
+                features = self._cached(filter_key, geom, bounds)
+            except redis.RedisError as e:
+                print(f"Redis cache unavailable for Planet search: {e}")
+        if features is None:
+            search_geom = shapely.box(*map(float, bounds.split(",")))
+            features, complete = self._fetch(
+                search_request(mapping(search_geom), start, end, cloud_cover, item_types)
+            )
+            print(f"Planet search returned {len(features)} items (complete={complete})")
+            if self.ttl:
+                try:
+                    self._store(filter_key, bounds, features, complete)
+                except redis.RedisError as e:
+                    print(f"Redis cache unavailable for Planet search: {e}")
+        else:
+            print(f"Planet search answered from cache ({len(features)} items)")
+
+        # The search geometry may be larger than geom; keep the items that reach geom
+        if not features:
+            return []
+        footprints = shapely.from_geojson([json.dumps(f["geometry"]) for f in features])
+        return [
+            {"image_id": f["id"], "timestamp": f["published"]}
+            for f, hit in zip(features, shapely.intersects(footprints, geom))
+            if hit
+        ]
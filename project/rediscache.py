@@ -0,0 +1,198 @@
+"""
+Read-through cache for job status and finished-job payloads, kept in the Redis instance
+that already serves as the Celery broker.
+
+Statuses are written through whenever Postgres is updated, so polling /job-status is
+answered from Redis. Payloads of jobs that are `done` never change again, so they are
+stored zlib-compressed with a TTL, and the least recently read ones are evicted once
+they add up to more than REDIS_CACHE_MAX_BYTES. Any Redis error is logged and treated
+as a cache miss; Postgres stays the source of truth.
+
+Every status write is also published on STATUS_CHANNEL for statusevents.
+
+Tests can swap in a fakeredis.FakeRedis with set_client.
+"""
+import functools
+import json
+import os
+import time
+import zlib
+
+import redis
+
+KEY_PREFIX = "xviewui"
+STATUS_CHANNEL = f"{KEY_PREFIX}:status_events"
+DONE_STATUS = "done"
+PAYLOAD_NAMES = ("assessment", "osm_polygons")
+COMPRESS_LEVEL = 6
+
+INDEX_KEY = f"{KEY_PREFIX}:payloads"
+SIZES_KEY = f"{KEY_PREFIX}:payload_sizes"
+
+_client = None
+
+
+def set_client(client):
+    """Use client (e.g. a fakeredis.FakeRedis) instead of connecting from the env."""
+    global _client
+    _client = client
+
+
+def connect(timeout=None):
+    url = os.getenv("REDIS_CACHE_URL") or os.getenv(
+        "CELERY_BROKER_URL", "redis://localhost:6379"
+    )
+    return redis.Redis.from_url(
+        url, socket_timeout=timeout, socket_connect_timeout=timeout
+    )
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = connect(float(os.getenv("REDIS_CACHE_TIMEOUT") or 0.5))
+    return _client
+
+
+def _settings():
+    return (
+        int(os.getenv("REDIS_CACHE_STATUS_TTL") or 24 * 3600),
+        int(os.getenv("REDIS_CACHE_PAYLOAD_TTL") or 24 * 3600),
+        int(os.getenv("REDIS_CACHE_MAX_BYTES") or 512 * 1024 ** 2),
+    )
+
+
+def max_payload_bytes():
+    return _settings()[2]
+
+
+def _best_effort(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except redis.RedisError as e:
+            print(f"Redis cache unavailable in {fn.__name__}: {e}")
+            return None
+
+    return wrapper
+
+
+def _status_key(job_id):
+    return f"{KEY_PREFIX}:status:{job_id}"
+
+
+def _payload_key(name, job_id):
+    return f"{KEY_PREFIX}:payload:{name}:{job_id}".encode()
+
+
+@_best_effort
+def get_status(job_id):
+    status = get_client().get(_status_key(job_id))
+    return None if status is None else status.decode()
+
+
+@_best_effort
+def set_status(job_id, status):
+    status_ttl, _, _ = _settings()
+    client = get_client()
+    try:
+        client.set(_status_key(job_id), status, ex=status_ttl)
+    except redis.RedisError:
+        # Reads fall through to Postgres rather than serve the previous status until
+        # it expires
+        client.delete(_status_key(job_id))
+        raise
+    client.publish(STATUS_CHANNEL, json.dumps({"uid": str(job_id), "status": status}))
+
+    # A job that is (re)started no longer matches any payload cached for it
+    if status != DONE_STATUS:
+        delete_payloads(job_id)
+
+
+@_best_effort
+def fill_status(job_id, status):
+    """
+    Caches a status read from Postgres, unless a newer one was written through
+    meanwhile.
+    """
+    status_ttl, _, _ = _settings()
+    get_client().set(_status_key(job_id), status, ex=status_ttl, nx=True)
+
+
+@_best_effort
+def get_payload(name, job_id):
+    """
+    Returns
+        the zlib-compressed payload cached for the job, or None on a miss
+    """
+    client = get_client()
+    key = _payload_key(name, job_id)
+    blob = client.get(key)
+    if blob is not None:
+        client.zadd(INDEX_KEY, {key: time.time()})
+    return blob
+
+
+@_best_effort
+def put_payload(name, job_id, blob):
+    """
+    Caches an already zlib-compressed payload for a finished job.
+    """
+    _, payload_ttl, max_bytes = _settings()
+    if len(blob) > max_bytes:
+        return
+
+    client = get_client()
+    key = _payload_key(name, job_id)
+    pipe = client.pipeline()
+    pipe.set(key, blob, ex=payload_ttl)
+    pipe.zadd(INDEX_KEY, {key: time.time()})
+    pipe.hset(SIZES_KEY, key, len(blob))
+    pipe.execute()
+
+    _evict(client, max_bytes)
+
+
+@_best_effort
+def delete_payloads(job_id):
+    keys = [_payload_key(name, job_id) for name in PAYLOAD_NAMES]
+    pipe = get_client().pipeline()
+    pipe.delete(*keys)
+    pipe.zrem(INDEX_KEY, *keys)
+    pipe.hdel(SIZES_KEY, *keys)
+    pipe.execute()
+
+
+def _evict(client, max_bytes):
+    sizes = {key: int(size) for key, size in client.hgetall(SIZES_KEY).items()}
+    total = sum(sizes.values())
+    if total <= max_bytes:
+        return
+
+    # Keys that reached their TTL still have bookkeeping entries; drop those first
+    pipe = client.pipeline()
+    for key in sizes:
+        pipe.exists(key)
+    evict = [key for key, alive in zip(list(sizes), pipe.execute()) if not alive]
+    total -= sum(sizes[key] for key in evict)
+
+    # Then the least recently read payloads until the total fits again
+    for key in client.zrange(INDEX_KEY, 0, -1):
+        if total <= max_bytes:
+            break
+        if key in sizes and key not in evict:
+            evict.append(key)
+            total -= sizes[key]
+
+    if not evict:
+        return
+    pipe = client.pipeline()
+    pipe.delete(*evict)
+    pipe.zrem(INDEX_KEY, *evict)
+    pipe.hdel(SIZES_KEY, *evict)
+    pipe.execute()
+
+
+def decompress(blob):
+    return zlib.decompress(blob)
@@ -0,0 +1,90 @@
+import asyncio
+import json
+import threading
+
+import redis
+
+import rediscache
+
+
+class StatusEvents:
+    """
+    Fans job status changes out to the clients streaming them.
+
+    A single background thread per API process subscribes to the Redis channel that
+    rediscache.set_status publishes every status write on, and hands each event to the
+    asyncio queues of the clients following that job. Clients therefore cost nothing
+    while a job is idle, however many of them there are.
+    """
+
+    def __init__(self, client=None, queue_size=100):
+        self.queue_size = queue_size
+        self._client = client
+        self._loop = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._subscribers = {}
+
+    def start(self, loop):
+        self._loop = loop
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="status-events", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def subscribe(self, job_id):
+        """
+        Returns
+            an asyncio.Queue that receives every status published for the job from now
+                on. Pass it to unsubscribe once the client has gone away.
+        """
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(str(job_id), set()).add(queue)
+        return queue
+
+    def unsubscribe(self, job_id, queue):
+        queues = self._subscribers.get(str(job_id))
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[str(job_id)]
+
+    def _dispatch(self, job_id, status):
+        # Runs on the event loop
+        for queue in list(self._subscribers.get(job_id, ())):
+            if queue.full():
+                # A client that stopped reading only needs the latest states
+                queue.get_nowait()
+            queue.put_nowait(status)
+
+    def _run(self):
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                client = self._client or rediscache.connect()
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(rediscache.STATUS_CHANNEL)
+                backoff = 1
+                while not self._stop.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+                    try:
+                        event = json.loads(message["data"])
+                    except (TypeError, ValueError):
+                        continue
+                    self._loop.call_soon_threadsafe(
+                        self._dispatch, event["uid"], event["status"]
+                    )
+                pubsub.close()
+            except redis.RedisError as e:
+                print(f"Status event subscription lost, retrying in {backoff}s: {e}")
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 30)
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The backend modules are imported top-level, as the API and the workers do
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,129 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import rasterio
+import rasterio.features
+import shapely
+from rasterio.transform import from_origin
+
+from chips import ChipPipeline, StubChipModel, chip_windows, occupied_chips
+
+WIDTH, HEIGHT = 700, 500
+TRANSFORM = from_origin(3395000, 6520000, 0.5, 0.5)
+CRS = "EPSG:3857"
+
+
+def write_raster(path, data, dtype="uint8"):
+    count = 1 if data.ndim == 2 else data.shape[0]
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=data.shape[-1],
+        height=data.shape[-2],
+        count=count,
+        dtype=dtype,
+        crs=CRS,
+        transform=TRANSFORM,
+    ) as dst:
+        dst.write(data if data.ndim == 3 else data[None])
+    return path
+
+
+@pytest.fixture
+def mosaics(tmp_path):
+    rng = np.random.default_rng(0)
+    pre = rng.integers(0, 255, (3, HEIGHT, WIDTH), dtype=np.uint8)
+    post = rng.integers(0, 255, (3, HEIGHT, WIDTH), dtype=np.uint8)
+    return (
+        write_raster(tmp_path / "pre.tif", pre),
+        write_raster(tmp_path / "post.tif", post),
+        pre,
+        post,
+    )
+
+
+def footprints(geoms):
+    return gpd.GeoDataFrame(
+        {"osmid": np.arange(len(geoms))}, geometry=list(geoms), crs=CRS
+    )
+
+
+def pixel_box(col0, row0, col1, row1):
+    left, top = TRANSFORM * (col0, row0)
+    right, bottom = TRANSFORM * (col1, row1)
+    return shapely.box(left, bottom, right, top)
+
+
+@pytest.mark.parametrize(
+    "width, height, chip_size, overlap",
+    [(700, 500, 256, 32), (256, 256, 256, 32), (100, 1000, 256, 64), (1025, 300, 512, 100)],
+)
+def test_write_windows_tile_the_raster(width, height, chip_size, overlap):
+    read, write = chip_windows(width, height, chip_size, overlap)
+    coverage = np.zeros((height, width), dtype=int)
+    for r, w in zip(read, write):
+        # Every read window is a whole chip inside the raster holding its write window
+        assert r.width == min(chip_size, width) and r.height == min(chip_size, height)
+        assert 0 <= r.col_off and r.col_off + r.width <= width
+        assert 0 <= r.row_off and r.row_off + r.height <= height
+        assert r.col_off <= w.col_off and w.col_off + w.width <= r.col_off + r.width
+        assert r.row_off <= w.row_off and w.row_off + w.height <= r.row_off + r.height
+        coverage[w.row_off : w.row_off + w.height, w.col_off : w.col_off + w.width] += 1
+    assert (coverage == 1).all()
+
+
+def test_occupied_chips():
+    read, _ = chip_windows(WIDTH, HEIGHT, 256, 32)
+    gdf = footprints([pixel_box(10, 10, 20, 20)])
+    selected = occupied_chips(read, TRANSFORM, gdf)
+    assert list(selected) == [0]
+    assert len(occupied_chips(read, TRANSFORM, footprints([]))) == 0
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_stitched_output_matches_whole_raster(tmp_path, mosaics, executor):
+    pre_path, post_path, pre, post = mosaics
+    expected = StubChipModel()(pre[None], post[None])[0]
+
+    pipeline = ChipPipeline(
+        "chips:StubChipModel",
+        chip_size=256,
+        overlap=32,
+        batch_size=3,
+        workers=2,
+        executor=executor,
+    )
+    everything = footprints([pixel_box(0, 0, WIDTH, HEIGHT)])
+    out = pipeline.run(pre_path, post_path, everything, tmp_path / "damage.tif")
+
+    with rasterio.open(out) as src:
+        assert (src.crs, src.transform, src.shape) == (CRS, TRANSFORM, (HEIGHT, WIDTH))
+        np.testing.assert_allclose(src.read(1), expected, atol=1e-6)
+    assert not list(tmp_path.glob("*.tmp.tif"))
+
+
+def test_chips_without_buildings_are_skipped(tmp_path, mosaics):
+    pre_path, post_path, pre, post = mosaics
+    expected = StubChipModel()(pre[None], post[None])[0]
+
+    pipeline = ChipPipeline(
+        "chips:StubChipModel", chip_size=256, overlap=32, executor="thread"
+    )
+    gdf = footprints([pixel_box(10, 10, 20, 20)])
+    out = pipeline.run(pre_path, post_path, gdf, tmp_path / "damage.tif")
+
+    read, write = chip_windows(WIDTH, HEIGHT, 256, 32)
+    with rasterio.open(out) as src:
+        damage = src.read(1)
+    w = write[0]
+    rows = slice(w.row_off, w.row_off + w.height)
+    cols = slice(w.col_off, w.col_off + w.width)
+    np.testing.assert_allclose(damage[rows, cols], expected[rows, cols], atol=1e-6)
+    damage[rows, cols] = 0
+    assert not damage.any()
+
+
+def test_rejects_overlap_larger_than_chip():
+    with pytest.raises(ValueError):
+        ChipPipeline("chips:StubChipModel", chip_size=128, overlap=128)
@@ -0,0 +1,85 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import rasterio
+import rasterio.features
+import shapely
+from rasterio.transform import from_origin
+
+from damagescore import score_footprints
+
+WIDTH, HEIGHT = 700, 500
+TRANSFORM = from_origin(3395000, 6520000, 0.5, 0.5)
+CRS = "EPSG:3857"
+
+
+def write_raster(path, data, dtype="uint8"):
+    count = 1 if data.ndim == 2 else data.shape[0]
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=data.shape[-1],
+        height=data.shape[-2],
+        count=count,
+        dtype=dtype,
+        crs=CRS,
+        transform=TRANSFORM,
+    ) as dst:
+        dst.write(data if data.ndim == 3 else data[None])
+    return path
+
+
+def footprints(geoms):
+    return gpd.GeoDataFrame(
+        {"osmid": np.arange(len(geoms))}, geometry=list(geoms), crs=CRS
+    )
+
+
+def pixel_box(col0, row0, col1, row1):
+    left, top = TRANSFORM * (col0, row0)
+    right, bottom = TRANSFORM * (col1, row1)
+    return shapely.box(left, bottom, right, top)
+
+
+def test_score_footprints_matches_masks(tmp_path):
+    rng = np.random.default_rng(1)
+    damage = rng.random((HEIGHT, WIDTH)).astype(np.float32)
+    path = write_raster(tmp_path / "damage.tif", damage, dtype="float32")
+
+    geoms = [
+        pixel_box(10, 10, 40, 30),
+        pixel_box(100, 200, 160, 260).buffer(3),
+        # Straddles a band boundary
+        pixel_box(300, 90, 340, 140),
+    ]
+    gdf = footprints(geoms).to_crs(4326)
+    scores = score_footprints(path, gdf, band_rows=100)
+
+    assert scores.crs == "EPSG:4326"
+    assert list(scores.osmid) == [0, 1, 2]
+    for geom, dmg in zip(geoms, scores.dmg):
+        mask = rasterio.features.geometry_mask(
+            [geom], (HEIGHT, WIDTH), TRANSFORM, invert=True
+        )
+        assert dmg == pytest.approx(damage[mask].mean(), abs=1e-5)
+
+    # Areas in square metres: web mercator areas shrunk by the squared scale factor
+    lat = np.array([shapely.centroid(g).y for g in gdf.geometry])
+    expected = np.array([g.area for g in geoms]) * np.cos(np.radians(lat)) ** 2
+    np.testing.assert_allclose(scores["area"], expected, rtol=0.01)
+
+
+def test_score_footprints_subpixel_and_duplicates(tmp_path):
+    damage = np.zeros((HEIGHT, WIDTH), dtype=np.float32)
+    damage[50, 60] = 0.75
+    path = write_raster(tmp_path / "damage.tif", damage, dtype="float32")
+
+    # A footprint too small to cover a pixel centre, listed twice
+    x, y = TRANSFORM * (60.5, 50.5)
+    tiny = shapely.box(x - 0.05, y - 0.05, x + 0.05, y + 0.05)
+    gdf = gpd.GeoDataFrame({"osmid": [7, 7]}, geometry=[tiny, tiny], crs=CRS)
+    scores = score_footprints(path, gdf)
+
+    assert list(scores.osmid) == [7]
+    assert scores.dmg[0] == pytest.approx(0.75)
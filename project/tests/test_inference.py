@@ -0,0 +1,121 @@
+import os
+import socket
+import threading
+import time
+
+import geopandas as gpd
+import pytest
+import shapely
+
+import inference
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setenv("INFERENCE_AUTHKEY", "test-key")
+    address = str(tmp_path / "inference.sock")
+    thread = threading.Thread(
+        target=inference.serve, args=(address, inference.StubModel()), daemon=True
+    )
+    thread.start()
+    for _ in range(50):
+        try:
+            inference.ping(address, timeout=1)
+            break
+        except inference.InferenceUnavailable:
+            time.sleep(0.1)
+    return address
+
+
+def test_ping(server):
+    assert inference.ping(server) == {"ok": True, "model": "StubModel", "busy": False}
+
+
+def test_run_with_stub_model(server, tmp_path):
+    polys = tmp_path / "polys.geojson"
+    gpd.GeoDataFrame(
+        {"osmid": [1]}, geometry=[shapely.box(30.5, 50.45, 30.5001, 50.4501)], crs=4326
+    ).to_file(polys, driver="GeoJSON")
+
+    inference.run(
+        ["--output_directory", str(tmp_path / "output"), "--bldg_polys", str(polys)],
+        server,
+    )
+    damage = gpd.read_file(tmp_path / "output" / "vector" / "damage.geojson")
+    assert list(damage.osmid) == [1]
+    assert list(damage.dmg) == [0.0]
+
+
+def test_failed_job_raises_with_traceback(server):
+    with pytest.raises(inference.InferenceError, match="SystemExit"):
+        inference.run(["--output_directory", "/nonexistent"], server)
+
+
+def test_no_server(tmp_path, monkeypatch):
+    monkeypatch.setenv("INFERENCE_AUTHKEY", "test-key")
+    with pytest.raises(inference.InferenceUnavailable):
+        inference.ping(str(tmp_path / "missing.sock"))
+
+
+def test_empty_authkey_is_refused(tmp_path, monkeypatch):
+    monkeypatch.setenv("INFERENCE_AUTHKEY", "")
+    with pytest.raises(inference.InferenceError):
+        inference.serve(str(tmp_path / "inference.sock"), inference.StubModel())
+    with pytest.raises(inference.InferenceUnavailable):
+        inference.ping(str(tmp_path / "inference.sock"))
+
+
+HANDLER = """
+loads = 0
+runs = []
+
+
+def load_model():
+    global loads
+    loads += 1
+    return {"weights": loads}
+
+
+def predict(model, args):
+    runs.append((model["weights"], args))
+"""
+
+
+def test_handler_model_loads_once(tmp_path):
+    path = tmp_path / "split_handler.py"
+    path.write_text(HANDLER)
+    model = inference.HandlerModel(path)
+    model(["--a", "1"])
+    model(["--a", "2"])
+    assert model.module.loads == 1
+    assert model.module.runs == [(1, ["--a", "1"]), (1, ["--a", "2"])]
+
+
+def test_handler_model_falls_back_to_main(tmp_path):
+    path = tmp_path / "main_handler.py"
+    path.write_text(
+        "import sys\nruns = []\n\ndef main():\n    runs.append(sys.argv[1:])\n"
+    )
+    model = inference.HandlerModel(path)
+    assert model.model is None
+    model(["--a", "1"])
+    assert model.module.runs == [["--a", "1"]]
+
+
+def test_connect_times_out_without_leaking(tmp_path, monkeypatch):
+    monkeypatch.setenv("INFERENCE_AUTHKEY", "test-key")
+    address = str(tmp_path / "silent.sock")
+    # Accepts connections into its backlog but never answers the handshake
+    silent = socket.socket(socket.AF_UNIX)
+    silent.bind(address)
+    silent.listen()
+
+    fds = len(os.listdir("/proc/self/fd"))
+    threads = threading.active_count()
+    start = time.monotonic()
+    with pytest.raises(inference.InferenceUnavailable):
+        inference.ping(address, timeout=0.5)
+    assert time.monotonic() - start < 5
+    assert len(os.listdir("/proc/self/fd")) == fds
+    assert threading.active_count() == threads
+    silent.close()
@@ -0,0 +1,51 @@
+import pytest
+
+from jobdedup import imagery_fingerprint, job_fingerprint, ordered_bbox
+from schemas import Coordinate
+
+WEST, SOUTH, EAST, NORTH = 30.500974, 50.453302, 30.506612, 50.456442
+
+
+def corners(start_lon, start_lat, end_lon, end_lat):
+    return Coordinate(
+        start_lon=start_lon, start_lat=start_lat, end_lon=end_lon, end_lat=end_lat
+    )
+
+
+@pytest.mark.parametrize(
+    "coordinate",
+    [
+        corners(WEST, NORTH, EAST, SOUTH),
+        corners(EAST, SOUTH, WEST, NORTH),
+        corners(WEST, SOUTH, EAST, NORTH),
+        corners(EAST, NORTH, WEST, SOUTH),
+    ],
+)
+def test_corner_order_does_not_change_the_fingerprint(coordinate):
+    assert ordered_bbox(coordinate) == (WEST, SOUTH, EAST, NORTH)
+    assert job_fingerprint(coordinate, "pre", "post", "xview2") == job_fingerprint(
+        corners(WEST, NORTH, EAST, SOUTH), "pre", "post", "xview2"
+    )
+
+
+def test_model_and_images_change_the_fingerprint():
+    coordinate = corners(WEST, NORTH, EAST, SOUTH)
+    fingerprint = job_fingerprint(coordinate, "pre", "post", "xview2")
+    assert job_fingerprint(coordinate, "pre", "post", "other") != fingerprint
+    assert job_fingerprint(coordinate, "pre2", "post", "xview2") != fingerprint
+    assert job_fingerprint(coordinate, "pre", "post2", "xview2") != fingerprint
+    # Swapping pre and post is a different job
+    assert job_fingerprint(coordinate, "post", "pre", "xview2") != fingerprint
+
+
+def test_model_defaults_to_chip_model(monkeypatch):
+    monkeypatch.setenv("CHIP_MODEL", "other")
+    assert imagery_fingerprint("pre", "post") == imagery_fingerprint(
+        "pre", "post", "other"
+    )
+
+
+def test_bbox_changes_the_fingerprint():
+    assert job_fingerprint(
+        corners(WEST, NORTH, EAST, SOUTH), "pre", "post", "xview2"
+    ) != job_fingerprint(corners(WEST, NORTH, EAST + 0.001, SOUTH), "pre", "post", "xview2")
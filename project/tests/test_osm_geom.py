@@ -0,0 +1,105 @@
+import geopandas as gpd
+import pytest
+from shapely.geometry import MultiPolygon, Polygon, box
+
+from utils import osm_geom_to_gdf
+
+
+def legacy_polygons(osm_data):
+    """The per-feature conversion osm_geom_to_gdf replaced, kept as the reference."""
+    buildings = []
+    for element in osm_data["elements"]:
+        if element["type"] == "way":
+            buildings.append(Polygon([(x["lon"], x["lat"]) for x in element["geometry"]]))
+        elif element["type"] == "relation":
+            outers = [
+                Polygon([(x["lon"], x["lat"]) for x in member["geometry"]])
+                for member in element["members"]
+                if member["role"] == "outer" and len(member["geometry"]) > 2
+            ]
+            inners = [
+                Polygon([(x["lon"], x["lat"]) for x in member["geometry"]])
+                for member in element["members"]
+                if member["role"] == "inner" and len(member["geometry"]) > 2
+            ]
+            merged = MultiPolygon(outers)
+            for inner in inners:
+                merged = merged - inner
+            buildings.append(merged)
+    return buildings
+
+
+def nodes(polygon):
+    return [{"lon": x, "lat": y} for x, y in polygon.exterior.coords]
+
+
+def way(osmid, polygon):
+    return {"type": "way", "id": osmid, "geometry": nodes(polygon)}
+
+
+def relation(osmid, outers, inners=()):
+    members = [{"role": "outer", "geometry": nodes(p)} for p in outers]
+    members += [{"role": "inner", "geometry": nodes(p)} for p in inners]
+    return {"type": "relation", "id": osmid, "members": members}
+
+
+@pytest.fixture
+def osm_data():
+    return {
+        "elements": [
+            way(1, box(30.500, 50.450, 30.501, 50.451)),
+            way(2, box(30.502, 50.450, 30.5035, 50.4512)),
+            # Courtyard building: one outer ring with one hole
+            relation(
+                3,
+                [box(30.510, 50.460, 30.512, 50.462)],
+                [box(30.5105, 50.4605, 30.5115, 50.4615)],
+            ),
+            # Two outer rings, a hole in the second one only
+            relation(
+                4,
+                [box(30.520, 50.470, 30.521, 50.471), box(30.522, 50.470, 30.524, 50.472)],
+                [box(30.5225, 50.4705, 30.5235, 50.4715)],
+            ),
+            {"type": "node", "id": 5, "lat": 50.45, "lon": 30.5},
+        ]
+    }
+
+
+def test_matches_legacy_conversion(osm_data):
+    gdf = osm_geom_to_gdf(osm_data)
+    expected = legacy_polygons(osm_data)
+
+    assert list(gdf.osmid) == [1, 2, 3, 4]
+    assert list(gdf.element_type) == ["way", "way", "relation", "relation"]
+    assert gdf.crs == "EPSG:4326"
+    for geometry, reference in zip(gdf.geometry, expected):
+        assert geometry.is_valid
+        assert geometry.symmetric_difference(reference).area == pytest.approx(0, abs=1e-15)
+
+
+def test_geometry_types(osm_data):
+    gdf = osm_geom_to_gdf(osm_data)
+    assert list(gdf.geom_type) == ["Polygon", "Polygon", "MultiPolygon", "MultiPolygon"]
+    assert len(gdf.geometry[2].geoms[0].interiors) == 1
+
+
+def test_degenerate_rings_are_dropped():
+    osm_data = {
+        "elements": [
+            {"type": "way", "id": 1, "geometry": [{"lon": 0, "lat": 0}, {"lon": 1, "lat": 1}]},
+            relation(2, [box(0, 0, 1, 1)]),
+        ]
+    }
+    osm_data["elements"][1]["members"].append(
+        {"role": "inner", "geometry": [{"lon": 0.5, "lat": 0.5}]}
+    )
+    gdf = osm_geom_to_gdf(osm_data)
+    assert list(gdf.osmid) == [2]
+    assert gdf.geometry[0].equals(MultiPolygon([box(0, 0, 1, 1)]))
+
+
+def test_empty_response():
+    gdf = osm_geom_to_gdf({"elements": []})
+    assert isinstance(gdf, gpd.GeoDataFrame)
+    assert len(gdf) == 0
@@ -0,0 +1,177 @@
+import os
+import time
+from datetime import timedelta
+
+import geopandas as gpd
+import mercantile
+import pytest
+import shapely
+
+from osmcache import FileOsmTileStore, OsmFootprintCache, empty_footprints
+
+ZOOM = 14
+TAGS = {"building": True}
+
+# Two zoom 14 tiles side by side and a footprint straddling their shared edge
+WEST_TILE = mercantile.Tile(9580, 5548, ZOOM)
+EAST_TILE = mercantile.Tile(9581, 5548, ZOOM)
+
+
+def footprints_in(bounds, xy):
+    """Small square footprints centred on each (lon, lat) of xy inside bounds."""
+    west, south, east, north = bounds
+    rows = [
+        (i, shapely.box(lon - 1e-4, lat - 1e-4, lon + 1e-4, lat + 1e-4))
+        for i, (lon, lat) in enumerate(xy)
+    ]
+    gdf = gpd.GeoDataFrame(
+        {"element_type": "way", "osmid": [i for i, _ in rows]},
+        geometry=[g for _, g in rows],
+        crs=4326,
+    )
+    return gdf[gdf.intersects(shapely.box(west, south, east, north))].reset_index(
+        drop=True
+    )
+
+
+class CannedFetch:
+    """Stands in for Overpass with a fixed set of footprints, counting requests."""
+
+    def __init__(self):
+        west = mercantile.bounds(WEST_TILE)
+        east = mercantile.bounds(EAST_TILE)
+        lat = (west.north + west.south) / 2
+        self.xy = [
+            ((west.west + west.east) / 2, lat),
+            ((east.west + east.east) / 2, lat),
+            (west.east, lat),
+        ]
+        self.calls = []
+
+    def __call__(self, north, south, east, west, tags):
+        self.calls.append((north, south, east, west))
+        return footprints_in((west, south, east, north), self.xy)
+
+
+@pytest.fixture
+def fetch():
+    return CannedFetch()
+
+
+@pytest.fixture
+def cache(tmp_path, fetch):
+    return OsmFootprintCache(FileOsmTileStore(tmp_path), fetch, zoom=ZOOM)
+
+
+def both_tiles_bbox():
+    west = mercantile.bounds(WEST_TILE)
+    east = mercantile.bounds(EAST_TILE)
+    pad = 1e-3
+    return (
+        west.north - pad,
+        west.south + pad,
+        east.east - pad,
+        west.west + pad,
+    )
+
+
+def test_first_request_fetches_and_later_ones_hit(cache, fetch):
+    north, south, east, west = both_tiles_bbox()
+    first = cache.get_footprints(north, south, east, west, TAGS)
+    assert len(fetch.calls) == 1
+    assert sorted(first.osmid) == [0, 1, 2]
+
+    second = cache.get_footprints(north, south, east, west, TAGS)
+    assert len(fetch.calls) == 1
+    assert sorted(second.osmid) == [0, 1, 2]
+
+
+def test_matches_direct_fetch(cache, fetch):
+    north, south, east, west = both_tiles_bbox()
+    cache.get_footprints(north, south, east, west, TAGS)
+
+    # A smaller bbox inside the cached tiles is cut out of them
+    lat = (north + south) / 2
+    sub = (lat + 1e-3, lat - 1e-3, fetch.xy[2][0] + 1e-3, fetch.xy[0][0])
+    cached = cache.get_footprints(*sub, TAGS)
+    direct = footprints_in((sub[3], sub[1], sub[2], sub[0]), fetch.xy)
+    assert len(fetch.calls) == 1
+    assert sorted(cached.osmid) == sorted(direct.osmid)
+
+
+def test_straddling_footprints_are_deduplicated(cache):
+    north, south, east, west = both_tiles_bbox()
+    gdf = cache.get_footprints(north, south, east, west, TAGS)
+    assert gdf.osmid.is_unique
+
+
+def test_only_missing_tiles_are_fetched(cache, fetch):
+    west = mercantile.bounds(WEST_TILE)
+    east = mercantile.bounds(EAST_TILE)
+    pad = 1e-3
+    cache.get_footprints(
+        west.north - pad, west.south + pad, west.east - pad, west.west + pad, TAGS
+    )
+    north, south, east_, west_ = both_tiles_bbox()
+    cache.get_footprints(north, south, east_, west_, TAGS)
+
+    assert len(fetch.calls) == 2
+    # The second request only covers the east tile
+    _, _, fetched_east, fetched_west = fetch.calls[1]
+    assert fetched_west == pytest.approx(east.west)
+    assert fetched_east == pytest.approx(east.east)
+
+
+def test_stale_tiles_are_refetched(tmp_path, fetch):
+    cache = OsmFootprintCache(
+        FileOsmTileStore(tmp_path), fetch, zoom=ZOOM, max_age=timedelta(days=1)
+    )
+    bbox = both_tiles_bbox()
+    cache.get_footprints(*bbox, TAGS)
+
+    old = time.time() - 2 * 24 * 3600
+    for path in tmp_path.rglob("*.parquet"):
+        os.utime(path, (old, old))
+    cache.get_footprints(*bbox, TAGS)
+    assert len(fetch.calls) == 2
+
+
+def test_tags_are_cached_separately(cache, fetch):
+    bbox = both_tiles_bbox()
+    cache.get_footprints(*bbox, {"building": True})
+    cache.get_footprints(*bbox, {"building": "house"})
+    assert len(fetch.calls) == 2
+
+
+def test_empty_area(tmp_path):
+    calls = []
+
+    def fetch(north, south, east, west, tags):
+        calls.append(1)
+        return empty_footprints()
+
+    cache = OsmFootprintCache(FileOsmTileStore(tmp_path), fetch, zoom=ZOOM)
+    bbox = both_tiles_bbox()
+    assert len(cache.get_footprints(*bbox, TAGS)) == 0
+    assert len(cache.get_footprints(*bbox, TAGS)) == 0
+    assert len(calls) == 1
+
+
+def test_file_store_evicts_to_max_bytes(tmp_path, fetch):
+    store = FileOsmTileStore(tmp_path, max_bytes=1)
+    cache = OsmFootprintCache(store, fetch, zoom=ZOOM)
+    cache.get_footprints(*both_tiles_bbox(), TAGS)
+    assert not list(tmp_path.rglob("*.parquet"))
+
+
+def test_from_env_needs_a_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("OSM_CACHE_BACKEND", "file")
+    monkeypatch.setenv("OSM_CACHE_DIR", "")
+    assert OsmFootprintCache.from_env() is None
+
+    monkeypatch.setenv("OSM_CACHE_DIR", str(tmp_path))
+    cache = OsmFootprintCache.from_env()
+    assert isinstance(cache.store, FileOsmTileStore)
+
+    monkeypatch.delenv("OSM_CACHE_BACKEND")
+    assert OsmFootprintCache.from_env() is None
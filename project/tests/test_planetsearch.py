@@ -0,0 +1,135 @@
+import fakeredis
+import pytest
+import redis
+import shapely
+from shapely.geometry import mapping
+
+import planetsearch
+import rediscache
+from planetsearch import PlanetSearch, date_window, snap_bounds
+
+CURRENT_DATE = "2022-03-01T10:20:00Z"
+
+
+def item(i, west, south, east, north):
+    return {
+        "id": f"item{i}",
+        "properties": {"published": f"2022-02-{i + 1:02d}T00:00:00Z"},
+        "geometry": mapping(shapely.box(west, south, east, north)),
+    }
+
+
+# Footprints around Kyiv, the last one well away from the AOIs below
+ITEMS = [
+    item(0, 30.50, 50.45, 30.51, 50.46),
+    item(1, 30.505, 50.455, 30.52, 50.47),
+    item(2, 30.53, 50.45, 30.54, 50.46),
+    item(3, 31.00, 51.00, 31.01, 51.01),
+]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(rediscache, "_client", client)
+    return client
+
+
+@pytest.fixture
+def requests_made(monkeypatch):
+    """Serves ITEMS in pages of page_size instead of calling the Planet API."""
+    made = []
+
+    def pages(self, request):
+        made.append(request)
+        for start in range(0, len(ITEMS), self.page_size):
+            end = start + self.page_size
+            yield ITEMS[start:end], end < len(ITEMS)
+
+    monkeypatch.setattr(PlanetSearch, "pages", pages)
+    return made
+
+
+def ids(results):
+    return [r["image_id"] for r in results]
+
+
+def test_date_window_rounds_up_to_the_hour():
+    start, end = date_window(CURRENT_DATE)
+    assert end.isoformat() == "2022-03-01T11:00:00+00:00"
+    assert start.isoformat() == "2021-03-01T11:00:00+00:00"
+    assert date_window("2022-03-01T11:00:00Z") == (start, end)
+
+
+def test_snap_bounds():
+    geom = shapely.box(30.501, 50.453, 30.507, 50.457)
+    assert snap_bounds(geom, 0.02) == "30.500000,50.440000,30.520000,50.460000"
+    assert snap_bounds(geom, 0) == "30.501000,50.453000,30.507000,50.457000"
+
+
+def test_covered_aoi_is_answered_from_cache(client, requests_made):
+    search = PlanetSearch("key", snap_degrees=0.02)
+    aoi = shapely.box(30.501, 50.441, 30.539, 50.459)
+    assert ids(search.search(aoi, CURRENT_DATE)) == ["item0", "item1", "item2"]
+    assert len(requests_made) == 1
+
+    # A smaller AOI inside the cached search, with other snapped bounds, only keeps
+    # the items that reach it
+    inner = shapely.box(30.531, 50.451, 30.539, 50.459)
+    assert snap_bounds(inner, 0.02) != snap_bounds(aoi, 0.02)
+    assert ids(search.search(inner, CURRENT_DATE)) == ["item2"]
+    assert len(requests_made) == 1
+
+    # A different date window is a different search
+    search.search(inner, "2022-03-02T10:00:00Z")
+    assert len(requests_made) == 2
+
+
+def test_incomplete_search_only_answers_its_own_bounds(client, requests_made):
+    search = PlanetSearch("key", snap_degrees=0.02, max_items=2, page_size=2)
+    aoi = shapely.box(30.501, 50.441, 30.539, 50.459)
+    assert ids(search.search(aoi, CURRENT_DATE)) == ["item0", "item1"]
+    assert len(requests_made) == 1
+
+    # Same snapped bounds: the truncated result is all it would get anyway
+    search.search(shapely.box(30.502, 50.442, 30.538, 50.458), CURRENT_DATE)
+    assert len(requests_made) == 1
+
+    # Covered by the truncated search but snapped differently, so it searches again
+    search.search(shapely.box(30.531, 50.451, 30.539, 50.459), CURRENT_DATE)
+    assert len(requests_made) == 2
+
+
+def test_expired_search_is_dropped_from_the_index(client, requests_made):
+    search = PlanetSearch("key", snap_degrees=0.1)
+    aoi = shapely.box(30.501, 50.451, 30.509, 50.459)
+    search.search(aoi, CURRENT_DATE)
+
+    (index_key,) = [k for k in client.keys() if client.type(k) == b"set"]
+    (bounds,) = client.smembers(index_key)
+    client.delete(f"{index_key.decode()}:{bounds.decode()}")
+
+    search.search(aoi, CURRENT_DATE)
+    assert len(requests_made) == 2
+    # The fresh search is indexed again, once
+    assert client.smembers(index_key) == {bounds}
+
+    client.delete(f"{index_key.decode()}:{bounds.decode()}")
+    filter_key = index_key.decode()[len(planetsearch.KEY_PREFIX) + 1 :]
+    assert search._cached(filter_key, aoi, bounds.decode()) is None
+    assert client.smembers(index_key) == set()
+
+
+def test_redis_errors_are_cache_misses(monkeypatch, requests_made):
+    class BrokenRedis:
+        def __getattr__(self, name):
+            def fail(*args, **kwargs):
+                raise redis.ConnectionError("down")
+
+            return fail
+
+    monkeypatch.setattr(rediscache, "_client", BrokenRedis())
+    search = PlanetSearch("key")
+    aoi = shapely.box(30.501, 50.451, 30.509, 50.459)
+    assert ids(search.search(aoi, CURRENT_DATE)) == ["item0", "item1"]
+    assert len(requests_made) == 1
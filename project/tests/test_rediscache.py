@@ -0,0 +1,100 @@
+import json
+import zlib
+
+import fakeredis
+import pytest
+import redis
+
+import rediscache
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(rediscache, "_client", client)
+    return client
+
+
+def test_status_roundtrip(client):
+    assert rediscache.get_status("job") is None
+    rediscache.set_status("job", "running_assessment")
+    assert rediscache.get_status("job") == "running_assessment"
+    assert client.ttl(rediscache._status_key("job")) > 0
+
+
+def test_fill_status_keeps_newer_write(client):
+    rediscache.set_status("job", "done")
+    rediscache.fill_status("job", "running_assessment")
+    assert rediscache.get_status("job") == "done"
+
+    rediscache.fill_status("other", "waiting_imagery")
+    assert rediscache.get_status("other") == "waiting_imagery"
+
+
+def test_set_status_publishes(client):
+    pubsub = client.pubsub()
+    pubsub.subscribe(rediscache.STATUS_CHANNEL)
+    pubsub.get_message(timeout=1)
+
+    rediscache.set_status("job", "get_imagery:start")
+    message = pubsub.get_message(timeout=1)
+    assert json.loads(message["data"]) == {"uid": "job", "status": "get_imagery:start"}
+
+
+def test_failed_status_write_drops_the_old_status(client, monkeypatch):
+    rediscache.set_status("job", "running_assessment")
+
+    def fail(*args, **kwargs):
+        raise redis.TimeoutError("timed out")
+
+    monkeypatch.setattr(client, "set", fail)
+    rediscache.set_status("job", "done")
+    monkeypatch.undo()
+
+    # A miss, so the next read falls through to Postgres
+    assert rediscache.get_status("job") is None
+
+
+def test_unavailable_redis_is_a_miss(monkeypatch):
+    client = fakeredis.FakeRedis()
+    client.connected = False
+    monkeypatch.setattr(rediscache, "_client", client)
+    assert rediscache.get_status("job") is None
+    assert rediscache.get_payload("assessment", "job") is None
+    rediscache.set_status("job", "done")
+
+
+def test_payload_roundtrip(client):
+    blob = zlib.compress(b'{"type": "FeatureCollection"}')
+    assert rediscache.get_payload("assessment", "job") is None
+    rediscache.put_payload("assessment", "job", blob)
+    assert rediscache.get_payload("assessment", "job") == blob
+    assert rediscache.decompress(blob) == b'{"type": "FeatureCollection"}'
+
+
+def test_restarted_job_drops_payloads(client):
+    rediscache.put_payload("assessment", "job", b"a")
+    rediscache.put_payload("osm_polygons", "job", b"b")
+    rediscache.set_status("job", "done")
+    assert rediscache.get_payload("assessment", "job") == b"a"
+
+    rediscache.set_status("job", "store_results:start")
+    assert rediscache.get_payload("assessment", "job") is None
+    assert rediscache.get_payload("osm_polygons", "job") is None
+
+
+def test_evicts_least_recently_read_payloads(client, monkeypatch):
+    monkeypatch.setenv("REDIS_CACHE_MAX_BYTES", "25")
+    rediscache.put_payload("assessment", "a", b"x" * 10)
+    rediscache.put_payload("assessment", "b", b"x" * 10)
+    # Reading a makes b the least recently read
+    assert rediscache.get_payload("assessment", "a") is not None
+
+    rediscache.put_payload("assessment", "c", b"x" * 10)
+    assert rediscache.get_payload("assessment", "b") is None
+    assert rediscache.get_payload("assessment", "a") is not None
+    assert rediscache.get_payload("assessment", "c") is not None
+
+    # Payloads larger than the whole cache are never stored
+    rediscache.put_payload("assessment", "d", b"x" * 30)
+    assert rediscache.get_payload("assessment", "d") is None
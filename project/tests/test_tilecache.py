@@ -0,0 +1,56 @@
+import os
+import time
+
+import pytest
+
+from tilecache import TileCache
+
+
+def test_get_put_roundtrip(tmp_path):
+    cache = TileCache(tmp_path)
+    assert cache.get("item", 18, 1, 2) is None
+    cache.put("item", 18, 1, 2, b"png")
+    assert cache.get("item", 18, 1, 2) == b"png"
+    assert cache.get("other", 18, 1, 2) is None
+    assert cache.stats() == {"hits": 1, "misses": 2, "hit_rate": 1 / 3}
+
+
+def test_put_leaves_no_temp_files(tmp_path):
+    cache = TileCache(tmp_path)
+    for x in range(5):
+        cache.put("item", 18, x, 0, b"x" * 10)
+    assert not list(tmp_path.rglob("*.tmp"))
+    assert len(list(tmp_path.rglob("*.png"))) == 5
+
+
+def test_failed_write_is_not_visible(tmp_path, monkeypatch):
+    cache = TileCache(tmp_path)
+
+    def fail(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", fail)
+    with pytest.raises(OSError):
+        cache.put("item", 18, 1, 2, b"png")
+    monkeypatch.undo()
+
+    assert cache.get("item", 18, 1, 2) is None
+    assert not list(tmp_path.rglob("*.tmp"))
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = TileCache(tmp_path, max_bytes=35)
+    now = time.time()
+    for x in range(3):
+        cache.put("item", 18, x, 0, b"x" * 10)
+        # Distinct mtimes, oldest first
+        os.utime(cache._path("item", 18, x, 0), (now - 100 + x, now - 100 + x))
+
+    # A hit refreshes tile 0, so tile 1 is now the least recently used
+    assert cache.get("item", 18, 0, 0) is not None
+    cache.put("item", 18, 3, 0, b"x" * 10)
+
+    assert cache.get("item", 18, 1, 0) is None
+    for x in (0, 2, 3):
+        assert cache.get("item", 18, x, 0) is not None
+    assert cache._scan_size() <= 35 * 0.9
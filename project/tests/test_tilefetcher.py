@@ -0,0 +1,201 @@
+import asyncio
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import mercantile
+import numpy as np
+import pytest
+import shapely
+from shapely.geometry import mapping
+
+from downloader import TileDataset
+from tilefetcher import AsyncTileFetcher, TileFetchError, TileFetcher
+from tilemanifest import TileManifest
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    """
+    /<subdomain>/<z>/<x>/<y>.png where x picks the behaviour: 0 is a tile, 1 is
+    missing, 2 fails twice with 503 before succeeding and 3 is a client error.
+    """
+
+    def do_GET(self):
+        _, subdomain, z, x, y = self.path[: -len(".png")].split("/")
+        x = int(x)
+        self.server.requests[x] += 1
+        self.server.subdomains[subdomain] += 1
+
+        if x == 1:
+            self.send_response(404)
+        elif x == 2 and self.server.requests[x] <= 2:
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+        elif x == 3:
+            self.send_response(400)
+        else:
+            body = f"tile {z}/{x}/{y}".encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), TileHandler)
+    server.requests = Counter()
+    server.subdomains = Counter()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fetcher(server):
+    url = f"http://127.0.0.1:{server.server_port}/{{subdomain}}/{{z}}/{{x}}/{{y}}.png"
+    with TileFetcher(
+        url, subdomains=("a", "b"), concurrency=4, retries=3, backoff_factor=0
+    ) as fetcher:
+        yield fetcher
+
+
+def test_fetches_tile(fetcher):
+    assert fetcher.fetch(mercantile.Tile(0, 5, 18)) == b"tile 18/0/5"
+
+
+def test_missing_tile_is_none(fetcher, server):
+    assert fetcher.fetch(mercantile.Tile(1, 5, 18)) is None
+    assert server.requests[1] == 1
+
+
+def test_retries_server_errors(fetcher, server):
+    assert fetcher.fetch(mercantile.Tile(2, 5, 18)) == b"tile 18/2/5"
+    assert server.requests[2] == 3
+
+
+def test_client_error_raises(fetcher, server):
+    with pytest.raises(TileFetchError):
+        fetcher.fetch(mercantile.Tile(3, 5, 18))
+    assert server.requests[3] == 1
+
+
+def test_spreads_requests_over_subdomains(fetcher, server):
+    for y in range(4):
+        fetcher.fetch(mercantile.Tile(0, y, 18))
+    assert server.subdomains == {"a": 2, "b": 2}
+
+
+def test_map_keeps_order_and_reraises(fetcher):
+    tiles = [mercantile.Tile(0, y, 18) for y in range(8)]
+    assert list(fetcher.map(fetcher.fetch, tiles)) == [
+        f"tile 18/0/{y}".encode() for y in range(8)
+    ]
+
+    with pytest.raises(TileFetchError):
+        list(fetcher.map(fetcher.fetch, tiles + [mercantile.Tile(3, 0, 18)]))
+
+
+def test_retried_download_resumes_from_the_manifest(fetcher, server, tmp_path):
+    tile_dir = tmp_path / "tiles"
+
+    def download(tiles):
+        manifest = TileManifest(tile_dir)
+        ds = TileDataset(
+            fetcher.url, tmp_path, None, 18, "job", fetcher=fetcher, manifest=manifest
+        )
+        data = [ds._get_tile_bytes(tile) for tile in tiles]
+        manifest.close()
+        return data
+
+    tiles = [mercantile.Tile(0, y, 18) for y in range(6)] + [mercantile.Tile(1, 0, 18)]
+    expected = [f"tile 18/0/{y}".encode() for y in range(6)] + [None]
+
+    # The first attempt dies after four tiles and the 404, halfway through writing
+    # the fifth tile's line
+    assert download(tiles[:4] + tiles[6:]) == expected[:4] + expected[6:]
+    with open(tile_dir / "manifest.jsonl", "a") as f:
+        f.write('{"z": 18, "x": 0, "y": 4, "fi')
+
+    assert download(tiles) == expected
+    # Only the missing tiles and the torn one were fetched again; the 404 was not
+    assert server.requests == {0: 6, 1: 1}
+
+    # The entries written after the torn line are read back by a later attempt
+    assert download(tiles) == expected
+    assert server.requests == {0: 6, 1: 1}
+
+
+def afetch(server, tiles, **kwargs):
+    url = f"http://127.0.0.1:{server.server_port}/{{subdomain}}/{{z}}/{{x}}/{{y}}.png"
+
+    async def fetch_all():
+        async with AsyncTileFetcher(url, subdomains=("a", "b"), **kwargs) as fetcher:
+            return await asyncio.gather(*(fetcher.fetch(tile) for tile in tiles))
+
+    return asyncio.run(fetch_all())
+
+
+def test_async_fetches_tiles_and_missing_tiles(server):
+    tiles = [mercantile.Tile(0, y, 18) for y in range(4)] + [mercantile.Tile(1, 0, 18)]
+    assert afetch(server, tiles, concurrency=2) == [
+        f"tile 18/0/{y}".encode() for y in range(4)
+    ] + [None]
+    assert server.requests == {0: 4, 1: 1}
+    assert server.subdomains == {"a": 3, "b": 2}
+
+
+def test_async_retries_honour_retry_after(server):
+    # The server sends Retry-After: 0, which wins over the much longer backoff
+    start = time.monotonic()
+    assert afetch(server, [mercantile.Tile(2, 5, 18)], backoff_factor=30) == [
+        b"tile 18/2/5"
+    ]
+    assert time.monotonic() - start < 10
+    assert server.requests[2] == 3
+
+
+def test_async_gives_up_after_retries(server):
+    with pytest.raises(TileFetchError, match="HTTP 503"):
+        afetch(server, [mercantile.Tile(2, 5, 18)], retries=1, backoff_factor=0)
+    assert server.requests[2] == 2
+
+
+def test_async_client_error_raises(server):
+    with pytest.raises(TileFetchError, match="HTTP 400"):
+        afetch(server, [mercantile.Tile(3, 5, 18)], backoff_factor=0)
+    assert server.requests[3] == 1
+
+
+def test_aget_data_from_extent_builds_the_mosaic(server, tmp_path, monkeypatch):
+    url = f"http://127.0.0.1:{server.server_port}/{{subdomain}}/{{z}}/{{x}}/{{y}}.png"
+    ds = TileDataset(
+        url,
+        tmp_path,
+        None,
+        18,
+        "job",
+        engine="async",
+        async_fetcher=AsyncTileFetcher(url, subdomains=("a",)),
+    )
+    # The stub server's tiles aren't images; give every tile a solid colour instead
+    monkeypatch.setattr(
+        ds, "_decode_tile", lambda tile, data: np.full((256, 256, 3), 7, np.uint8)
+    )
+    geom = mapping(shapely.box(30.5010, 50.4533, 30.5066, 50.4564))
+
+    memory_file = asyncio.run(ds.aget_data_from_extent(geom, 18))
+    with memory_file.open() as src:
+        data = src.read()
+    assert data.shape[0] == 3 and data.size > 0
+    assert (data == 7).all()
+    assert sum(server.requests.values()) == len(ds._grid_from_extent(geom, 18).tiles)
@@ -0,0 +1,82 @@
+import mercantile
+import numpy as np
+import pytest
+import rasterio.transform
+
+from downloader import TileDataset, TileGrid
+from tileserverutils import TILE_SIZE
+
+BBOXES = [
+    (30.500974, 50.453302, 30.506612, 50.456442),
+    (-74.0123, 40.7011, -73.9712, 40.7301),
+    (151.2001, -33.8702, 151.2153, -33.8601),
+    # Edges exactly on zoom 16 tile boundaries
+    tuple(mercantile.bounds(mercantile.Tile(38000, 22000, 16)))[:2]
+    + tuple(mercantile.bounds(mercantile.Tile(38001, 21999, 16)))[2:],
+]
+
+
+@pytest.mark.parametrize("bbox", BBOXES)
+def test_tile_grid_matches_mercantile(bbox):
+    zoom = 17
+    grid = TileGrid(bbox, zoom)
+    assert set(grid.tiles) == set(mercantile.tiles(*bbox, zooms=zoom))
+
+    # Every tile sits at its mercantile bounds in the cropped output window
+    for tile in grid.tiles:
+        row, col = grid.tile_window(tile)
+        left, _, _, top = mercantile.xy_bounds(tile)
+        x, y = rasterio.transform.xy(grid.transform, row, col, offset="ul")
+        assert x == pytest.approx(left, abs=1e-6)
+        assert y == pytest.approx(top, abs=1e-6)
+
+    # The window covers the bbox and is at most a pixel larger on each side
+    west, south, east, north = bbox
+    left, top = mercantile.xy(west, north)
+    right, bottom = mercantile.xy(east, south)
+    out_left, out_top = rasterio.transform.xy(grid.transform, 0, 0, offset="ul")
+    out_right, out_bottom = rasterio.transform.xy(
+        grid.transform, grid.height, grid.width, offset="ul"
+    )
+    eps = 1e-6
+    assert -eps <= left - out_left < grid.res
+    assert -eps <= out_top - top < grid.res
+    assert -eps <= out_right - right < grid.res
+    assert -eps <= bottom - out_bottom < grid.res
+
+
+def test_paste_and_bands_rebuild_the_mosaic():
+    grid = TileGrid(BBOXES[0], 18)
+    images = {
+        tile: np.full((TILE_SIZE, TILE_SIZE, 3), i % 251, dtype=np.uint8)
+        for i, tile in enumerate(grid.tiles)
+    }
+    mosaic = grid.empty_mosaic()
+    for tile, img in images.items():
+        grid.paste(mosaic, tile, img)
+
+    banded = grid.empty_mosaic()
+    bands = grid.bands(min_tiles=3)
+    assert sum(len(tiles) for tiles, _, _ in bands) == len(grid.tiles)
+    for tiles, row_start, row_end in bands:
+        strip = np.zeros((3, row_end - row_start, grid.width), dtype=np.uint8)
+        for tile in tiles:
+            grid.paste(strip, tile, images[tile], row_start)
+        banded[:, row_start:row_end] = strip
+
+    np.testing.assert_array_equal(banded, mosaic)
+
+
+def test_only_the_in_memory_mosaic_is_capped(tmp_path):
+    ds = TileDataset("http://127.0.0.1/{subdomain}/{z}/{x}/{y}.png", tmp_path, None, 12, "job")
+    geom = {
+        "type": "Polygon",
+        "coordinates": [[[30, 50], [32, 50], [32, 52], [30, 52], [30, 50]]],
+    }
+    with pytest.raises(ValueError, match="download_extent"):
+        ds._grid_from_extent(geom, 12)
+    assert ds._grid_from_extent(geom, 12, streaming=True).tiles
+
+    ds.max_extent_degrees = 1.5
+    with pytest.raises(ValueError, match="TILE_MAX_EXTENT_DEGREES"):
+        ds._grid_from_extent(geom, 12, streaming=True)
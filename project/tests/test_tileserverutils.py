@@ -0,0 +1,45 @@
+import mercantile
+import numpy as np
+import pytest
+
+from tileserverutils import bbox_to_xyz, latlon_to_xyz
+
+BBOXES = [
+    (30.500974, 50.453302, 30.506612, 50.456442),
+    (-74.0123, 40.7011, -73.9712, 40.7301),
+    (151.2001, -33.8702, 151.2153, -33.8601),
+    # Edges exactly on zoom 16 tile boundaries
+    tuple(mercantile.bounds(mercantile.Tile(38000, 22000, 16)))[:2]
+    + tuple(mercantile.bounds(mercantile.Tile(38001, 21999, 16)))[2:],
+]
+
+
+def mercantile_range(bbox, zoom):
+    tiles = list(mercantile.tiles(*bbox, zooms=zoom))
+    xs = [t.x for t in tiles]
+    ys = [t.y for t in tiles]
+    return min(xs), max(xs), min(ys), max(ys)
+
+
+@pytest.mark.parametrize("bbox", BBOXES)
+@pytest.mark.parametrize("zoom", [12, 16, 18])
+def test_bbox_to_xyz_matches_mercantile(bbox, zoom):
+    west, south, east, north = bbox
+    assert tuple(int(v) for v in bbox_to_xyz(west, east, south, north, zoom)) == (
+        mercantile_range(bbox, zoom)
+    )
+
+
+def test_bbox_to_xyz_broadcasts():
+    bboxes = np.array(BBOXES[:3])
+    x_min, x_max, y_min, y_max = bbox_to_xyz(
+        bboxes[:, 0], bboxes[:, 2], bboxes[:, 1], bboxes[:, 3], 16
+    )
+    for i, bbox in enumerate(BBOXES[:3]):
+        assert (x_min[i], x_max[i], y_min[i], y_max[i]) == mercantile_range(bbox, 16)
+
+
+def test_latlon_to_xyz_matches_mercantile():
+    lat, lon = 50.4545, 30.5038
+    x, y = latlon_to_xyz(lat, lon, 18)
+    assert mercantile.tile(lon, lat, 18) == mercantile.Tile(int(x), int(y), 18)
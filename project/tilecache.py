@@ -0,0 +1,120 @@
+import hashlib
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+
+class TileCache:
+    """
+    A persistent, content-addressed cache of encoded tile images.
+
+    Tiles are keyed by (item_id, z, x, y) and stored as the raw bytes returned by the
+    tile server. Files are written atomically (temp file + rename) so several Celery
+    workers can share one cache directory. When the cache grows past max_bytes the
+    least recently used tiles (by mtime, refreshed on every hit) are evicted.
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 1024 ** 3):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = None
+
+    @classmethod
+    def from_env(cls):
+        """
+        Builds a TileCache from TILE_CACHE_DIR / TILE_CACHE_MAX_BYTES, or returns None
+        if no cache directory is configured.
+        """
+        cache_dir = os.getenv("TILE_CACHE_DIR")
+        if not cache_dir:
+            return None
+        max_bytes = os.getenv("TILE_CACHE_MAX_BYTES")
+        if max_bytes:
+            return cls(cache_dir, int(max_bytes))
+        return cls(cache_dir)
+
+    def _path(self, item_id, z, x, y):
+        digest = hashlib.sha256(f"{item_id}/{z}/{x}/{y}".encode()).hexdigest()
+        return self.cache_dir / digest[:2] / digest[2:4] / f"{digest}.png"
+
+    def get(self, item_id, z, x, y):
+        """
+        Returns the cached bytes for the tile, or None on a miss.
+        """
+        path = self._path(item_id, z, x, y)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            # Either never cached or evicted by another worker between read and utime
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, item_id, z, x, y, data):
+        path = self._path(item_id, z, x, y)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            self._size += len(data)
+            needs_eviction = self._size > self.max_bytes
+
+        if needs_eviction:
+            self.evict()
+
+    def _iter_files(self):
+        for path in self.cache_dir.glob("*/*/*.png"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            yield path, st
+
+    def _scan_size(self):
+        return sum(st.st_size for _, st in self._iter_files())
+
+    def evict(self):
+        """
+        Deletes the least recently used tiles until the cache is at 90% of max_bytes.
+        The directory is rescanned since other processes may be writing to it too.
+        """
+        files = sorted(self._iter_files(), key=lambda f: f[1].st_mtime)
+        size = sum(st.st_size for _, st in files)
+        target = int(self.max_bytes * 0.9)
+
+        for path, st in files:
+            if size <= target:
+                break
+            path.unlink(missing_ok=True)
+            size -= st.st_size
+
+        with self._lock:
+            self._size = size
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
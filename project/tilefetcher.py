@@ -0,0 +1,232 @@
+import asyncio
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_SUBDOMAINS = ("tiles0", "tiles1", "tiles2", "tiles3")
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TileFetchError(Exception):
+    pass
+
+
+class TileFetcher:
+    """
+    Downloads encoded tile images over pooled keep-alive connections.
+
+    One requests.Session (and so one connection pool) is kept per tile subdomain and
+    requests are spread over the subdomains round-robin. Every request has a timeout and
+    is retried with exponential backoff on connection errors and 429/5xx responses,
+    honouring any Retry-After header the server sends back.
+    """
+
+    def __init__(
+        self,
+        url,
+        subdomains=DEFAULT_SUBDOMAINS,
+        concurrency=16,
+        timeout=(5, 30),
+        retries=5,
+        backoff_factor=0.5,
+    ):
+        self.url = url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.sessions = {subdomain: self._make_session() for subdomain in subdomains}
+        self._subdomains = itertools.cycle(subdomains)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, url, **kwargs):
+        """
+        Builds a TileFetcher using TILE_FETCH_CONCURRENCY, TILE_FETCH_TIMEOUT and
+        TILE_FETCH_RETRIES when they are set.
+        """
+        if os.getenv("TILE_FETCH_CONCURRENCY"):
+            kwargs.setdefault("concurrency", int(os.getenv("TILE_FETCH_CONCURRENCY")))
+        if os.getenv("TILE_FETCH_TIMEOUT"):
+            kwargs.setdefault("timeout", float(os.getenv("TILE_FETCH_TIMEOUT")))
+        if os.getenv("TILE_FETCH_RETRIES"):
+            kwargs.setdefault("retries", int(os.getenv("TILE_FETCH_RETRIES")))
+        return cls(url, **kwargs)
+
+    def _make_session(self):
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(["GET"]),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.concurrency, max_retries=retry
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _next_subdomain(self):
+        with self._lock:
+            return next(self._subdomains)
+
+    def fetch(self, tile):
+        """
+        Args:
+            tile: a mercantile Tile object
+        Returns
+            the encoded image bytes for the tile, or None if the server has no imagery
+                for it (HTTP 404)
+        Raises
+            TileFetchError if the tile could not be fetched after all retries
+        """
+        subdomain = self._next_subdomain()
+        url = self.url.format(subdomain=subdomain, x=tile.x, y=tile.y, z=tile.z)
+        try:
+            r = self.sessions[subdomain].get(url, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise TileFetchError(f"Failed to fetch tile {tuple(tile)}: {e}") from e
+
+        with r:
+            if r.status_code == 404:
+                return None
+            if not r.ok:
+                raise TileFetchError(
+                    f"Failed to fetch tile {tuple(tile)}: HTTP {r.status_code}"
+                )
+            return r.content
+
+    def map(self, fn, tiles):
+        """
+        Applies fn to every tile on a pool of `concurrency` threads and yields the
+        results in order. The first exception raised by fn is re-raised here and the
+        tiles that have not started yet are cancelled.
+        """
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            yield from executor.map(fn, tiles)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncTileFetcher:
+    """
+    asyncio counterpart of TileFetcher.
+
+    Keeps up to `concurrency` tile requests in flight on a single aiohttp connection
+    pool, bounded by a semaphore, with the same round-robin over subdomains and the same
+    backoff/Retry-After handling. Must be used as an async context manager from inside a
+    running event loop (e.g. a FastAPI handler).
+    """
+
+    def __init__(
+        self,
+        url,
+        subdomains=DEFAULT_SUBDOMAINS,
+        concurrency=64,
+        timeout=30,
+        retries=5,
+        backoff_factor=0.5,
+    ):
+        self.url = url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._subdomains = itertools.cycle(subdomains)
+        self._session = None
+        self._semaphore = None
+
+    @classmethod
+    def from_env(cls, url, **kwargs):
+        """
+        Builds an AsyncTileFetcher using TILE_FETCH_ASYNC_CONCURRENCY,
+        TILE_FETCH_TIMEOUT and TILE_FETCH_RETRIES when they are set.
+        """
+        if os.getenv("TILE_FETCH_ASYNC_CONCURRENCY"):
+            kwargs.setdefault(
+                "concurrency", int(os.getenv("TILE_FETCH_ASYNC_CONCURRENCY"))
+            )
+        if os.getenv("TILE_FETCH_TIMEOUT"):
+            kwargs.setdefault("timeout", float(os.getenv("TILE_FETCH_TIMEOUT")))
+        if os.getenv("TILE_FETCH_RETRIES"):
+            kwargs.setdefault("retries", int(os.getenv("TILE_FETCH_RETRIES")))
+        return cls(url, **kwargs)
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+        self._session = None
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self.backoff_factor * (2 ** attempt)
+
+    async def fetch(self, tile):
+        """
+        Args:
+            tile: a mercantile Tile object
+        Returns
+            the encoded image bytes for the tile, or None if the server has no imagery
+                for it (HTTP 404)
+        Raises
+            TileFetchError if the tile could not be fetched after all retries
+        """
+        error = None
+        for attempt in range(self.retries + 1):
+            url = self.url.format(
+                subdomain=next(self._subdomains), x=tile.x, y=tile.y, z=tile.z
+            )
+            retry_after = None
+            try:
+                async with self._semaphore:
+                    async with self._session.get(url) as r:
+                        if r.status == 404:
+                            return None
+                        if r.status < 400:
+                            return await r.read()
+                        if r.status not in RETRY_STATUSES:
+                            raise TileFetchError(
+                                f"Failed to fetch tile {tuple(tile)}: HTTP {r.status}"
+                            )
+                        error = f"HTTP {r.status}"
+                        retry_after = r.headers.get("Retry-After")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+
+            if attempt < self.retries:
+                # Sleep outside of the semaphore so a backing-off tile doesn't hold a slot
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+
+        raise TileFetchError(f"Failed to fetch tile {tuple(tile)}: {error}")
@@ -0,0 +1,94 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+
+class TileManifest:
+    """
+    A per-job record of which tiles have been downloaded and where their bytes are.
+
+    Tile bytes are stored next to an append-only manifest.jsonl, one line per finished
+    tile, so a worker that dies halfway through a download loses at most the tiles that
+    were in flight. A retried download loads the manifest and only fetches the tiles
+    that are missing from it.
+    """
+
+    def __init__(self, tile_dir):
+        self.tile_dir = Path(tile_dir)
+        self.path = self.tile_dir / "manifest.jsonl"
+        self._lock = threading.Lock()
+        self._tiles = {}
+        self._file = None
+        # Whether the manifest ends in a torn line that new entries must not extend
+        self._torn = False
+
+        if self.path.exists():
+            with open(self.path) as f:
+                line = ""
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn final line from a crash mid-write; that tile is refetched
+                        continue
+                    self._tiles[(entry["z"], entry["x"], entry["y"])] = entry["file"]
+                self._torn = not line.endswith("\n") and line != ""
+            print(f"Resuming download with {len(self._tiles)} tiles from {self.path}")
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def get(self, tile):
+        """
+        Returns
+            (found, data) where data is the stored bytes for the tile, or None if the
+                tile was recorded as having no imagery
+        """
+        key = (tile.z, tile.x, tile.y)
+        if key not in self._tiles:
+            return False, None
+
+        file = self._tiles[key]
+        if file is None:
+            return True, None
+        try:
+            return True, (self.tile_dir / file).read_bytes()
+        except FileNotFoundError:
+            return False, None
+
+    def put(self, tile, data):
+        self.tile_dir.mkdir(parents=True, exist_ok=True)
+
+        file = None
+        if data is not None:
+            file = f"{tile.z}_{tile.x}_{tile.y}.png"
+            fd, tmp_path = tempfile.mkstemp(dir=self.tile_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.tile_dir / file)
+
+        entry = json.dumps({"z": tile.z, "x": tile.x, "y": tile.y, "file": file})
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a")
+                if self._torn:
+                    self._file.write("\n")
+                    self._torn = False
+            self._file.write(entry + "\n")
+            self._file.flush()
+            self._tiles[(tile.z, tile.x, tile.y)] = file
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def clear(self):
+        """Removes the manifest and stored tiles once the output has been written."""
+        self.close()
+        shutil.rmtree(self.tile_dir, ignore_errors=True)
+        self._tiles = {}
@@ -1,40 +1,125 @@
-from math import atan, cos, degrees, floor, log, pi, radians, sinh, tan
+import numpy as np
+
+EARTH_RADIUS = 6378137
+TILE_SIZE = 256
+MAX_LAT = 85.0511287798066
+LL_EPSILON = 1e-11
+
+# All of the functions below accept scalars or NumPy arrays of coordinates / tile
+# indices and broadcast over them.
 
 
 def sec(x):
-    return 1 / cos(x)
+    return 1 / np.cos(x)
 
 
 def latlon_to_xyz(lat, lon, z):
-    tile_count = pow(2, z)
-    x = (lon + 180) / 360
-    y = (1 - log(tan(radians(lat)) + sec(radians(lat))) / pi) / 2
+    tile_count = 2 ** z
+    lat = np.clip(lat, -MAX_LAT, MAX_LAT)
+    x = (np.asarray(lon) + 180) / 360
+    y = (1 - np.log(np.tan(np.radians(lat)) + sec(np.radians(lat))) / np.pi) / 2
     return (tile_count * x, tile_count * y)
 
 
 def bbox_to_xyz(lon_min, lon_max, lat_min, lat_max, z):
-    x_min, y_max = latlon_to_xyz(lat_min, lon_min, z)
-    x_max, y_min = latlon_to_xyz(lat_max, lon_max, z)
-    return (floor(x_min), floor(x_max), floor(y_min), floor(y_max))
+    """
+    Returns the inclusive (x_min, x_max, y_min, y_max) tile index range covering the
+    bbox. Edges that fall exactly on a tile boundary don't pull in the next tile, which
+    matches mercantile.tiles.
+    """
+    x_min, y_max = latlon_to_xyz(
+        np.asarray(lat_min) + LL_EPSILON, lon_min, z
+    )
+    x_max, y_min = latlon_to_xyz(
+        lat_max, np.asarray(lon_max) - LL_EPSILON, z
+    )
+    tile_max = 2 ** z - 1
+    return tuple(
+        np.clip(np.floor(v), 0, tile_max).astype(np.int64)
+        for v in (x_min, x_max, y_min, y_max)
+    )
 
 
 def mercatorToLat(mercatorY):
-    return degrees(atan(sinh(mercatorY)))
+    return np.degrees(np.arctan(np.sinh(mercatorY)))
 
 
 def y_to_lat_edges(y, z):
-    tile_count = pow(2, z)
+    tile_count = 2 ** z
     unit = 1 / tile_count
-    relative_y1 = y * unit
+    relative_y1 = np.asarray(y) * unit
     relative_y2 = relative_y1 + unit
-    lat1 = mercatorToLat(pi * (1 - 2 * relative_y1))
-    lat2 = mercatorToLat(pi * (1 - 2 * relative_y2))
+    lat1 = mercatorToLat(np.pi * (1 - 2 * relative_y1))
+    lat2 = mercatorToLat(np.pi * (1 - 2 * relative_y2))
     return (lat1, lat2)
 
 
 def x_to_lon_edges(x, z):
-    tile_count = pow(2, z)
+    tile_count = 2 ** z
     unit = 360 / tile_count
-    lon1 = -180 + x * unit
+    lon1 = -180 + np.asarray(x) * unit
     lon2 = lon1 + unit
-    return (lon1, lon2)
\ No newline at end of file
+    return (lon1, lon2)
+
+
+def lonlat_to_mercator(lon, lat):
+    """Projects lon/lat degrees to EPSG:3857 metres."""
+    lat = np.clip(lat, -MAX_LAT, MAX_LAT)
+    x = EARTH_RADIUS * np.radians(lon)
+    y = EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return (x, y)
+
+
+def tile_resolution(z, tile_size=TILE_SIZE):
+    """Size of one pixel in EPSG:3857 metres at zoom z."""
+    return 2 * np.pi * EARTH_RADIUS / (tile_size * 2 ** z)
+
+
+def tiles_in_range(x_min, x_max, y_min, y_max, z):
+    """
+    Enumerates every tile in the inclusive tile index range in one call.
+
+    Returns
+        (xs, ys, lon_edges, lat_edges) where xs and ys are flat, row-major arrays of
+            the tile indices, and lon_edges / lat_edges are (n, 2) arrays of each
+            tile's west/east and north/south edges in degrees
+    """
+    ys, xs = np.meshgrid(
+        np.arange(y_min, y_max + 1), np.arange(x_min, x_max + 1), indexing="ij"
+    )
+    xs = xs.ravel()
+    ys = ys.ravel()
+    lon_edges = np.stack(x_to_lon_edges(xs, z), axis=1)
+    lat_edges = np.stack(y_to_lat_edges(ys, z), axis=1)
+    return (xs, ys, lon_edges, lat_edges)
+
+
+def bbox_to_tiles(lon_min, lon_max, lat_min, lat_max, z):
+    """
+    Enumerates every tile covering the bbox, see tiles_in_range.
+    """
+    return tiles_in_range(*bbox_to_xyz(lon_min, lon_max, lat_min, lat_max, z), z)
+
+
+def tile_grid_geotransform(x_min, x_max, y_min, y_max, z, tile_size=TILE_SIZE):
+    """
+    Returns the EPSG:3857 bounds (left, bottom, right, top) of the tile range and its
+    pixel geotransform in GDAL order (left, res, 0, top, 0, -res).
+    """
+    res = tile_resolution(z, tile_size)
+    origin = np.pi * EARTH_RADIUS
+    left = x_min * tile_size * res - origin
+    right = (x_max + 1) * tile_size * res - origin
+    top = origin - y_min * tile_size * res
+    bottom = origin - (y_max + 1) * tile_size * res
+    return (left, bottom, right, top), (left, res, 0.0, top, 0.0, -res)
+
+
+def bbox_tile_grid(lon_min, lon_max, lat_min, lat_max, z, tile_size=TILE_SIZE):
+    """
+    Returns the tile index range covering the bbox together with the grid's EPSG:3857
+    bounds and pixel geotransform, see bbox_to_xyz and tile_grid_geotransform.
+    """
+    tile_range = bbox_to_xyz(lon_min, lon_max, lat_min, lat_max, z)
+    bounds, geotransform = tile_grid_geotransform(*tile_range, z, tile_size)
+    return tile_range, bounds, geotransform
@@ -1,27 +1,34 @@
 import glob
-import json
+import io
+import operator
 import os
 from pathlib import Path
 import shutil
+import threading
 import urllib.request
+from contextlib import contextmanager
 
 import boto3
-import dateutil.parser
 import geopandas as gpd
-import planet.api as api
-import requests
+import numpy as np
+import shapely
 import sqlalchemy
 from sqlalchemy.sql import text
-from dateutil.relativedelta import relativedelta
 from dotenv import load_dotenv
 from osgeo import gdal
-from requests.auth import HTTPBasicAuth
-from shapely.geometry import MultiPolygon, Polygon, mapping
+from shapely.geometry import Polygon
 from downloader import TileDataset
+import rediscache
+from planetsearch import PlanetSearch
+from tilecache import TileCache
+from tilefetcher import AsyncTileFetcher, TileFetcher
+from tilemanifest import TileManifest
 
 from schemas import Coordinate
 from tileserverutils import bbox_to_xyz, x_to_lon_edges, y_to_lat_edges
 import psycopg2
+import psycopg2.pool
+import psycopg2.sql
 from schemas import Coordinate
 
 
@@ -34,49 +41,117 @@ def order_coordinate(coordinate: Coordinate) -> Coordinate:
     return Coordinate(start_lon=west, start_lat=north, end_lon=east, end_lat=south)
 
 
-def osm_geom_to_poly_geojson(osm_data: dict):
-    buildings = []
+_lonlat = operator.itemgetter("lon", "lat")
 
-    # Get the list of elements in the OSM query
-    elements = osm_data["elements"]
-    for element in elements:
-        # If it is a way, then it's as simply polygon
-        if element["type"] == "way":
-            poly = Polygon([(x["lon"], x["lat"]) for x in element["geometry"]])
-            buildings.append(poly)
 
-        # If it is a relation, then it has an outer and inners
-        elif element["type"] == "relation":
-            outers = []
-            inners = []
-            for member in element["members"]:
-                if member["role"] == "outer":
-                    outers.append(member["geometry"])
-                elif member["role"] == "inner":
-                    inners.append(member["geometry"])
+def osm_geom_to_gdf(osm_data: dict) -> gpd.GeoDataFrame:
+    """
+    Converts building ways and relations from an Overpass JSON response into polygons
+
+        Every ring is flattened into one coordinate array plus ring offsets and built
+        with the shapely 2 array constructors, so the per-element Python work is just
+        reading coordinates. Inner rings of a relation are attached as holes of the
+        outer ring that contains them instead of being subtracted one at a time.
+
+        Parameters:
+            osm_data (dict): the parsed Overpass response
 
-            outers_lonlat = []
-            inners_lonlat = []
+        Returns:
+            gdf (GeoDataFrame): one row per element with osmid, element_type and a
+                Polygon (ways) or MultiPolygon (relations) geometry in EPSG:4326
+    """
+    coords = []
+    ring_sizes = []
+    ring_feature = []
+    ring_inner = []
+    osmids = []
+    element_types = []
+
+    # Flatten every ring of every element; rings with two or fewer nodes can't form a
+    # polygon and are dropped
+    for element in osm_data["elements"]:
+        if element["type"] == "way":
+            rings = [(element["geometry"], False)]
+        elif element["type"] == "relation":
+            rings = [
+                (member["geometry"], member["role"] == "inner")
+                for member in element["members"]
+                if member["role"] in ("outer", "inner")
+            ]
+        else:
+            continue
+
+        feature = len(osmids)
+        for geometry, inner in rings:
+            if len(geometry) <= 2:
+                continue
+            coords.extend(map(_lonlat, geometry))
+            ring_sizes.append(len(geometry))
+            ring_feature.append(feature)
+            ring_inner.append(inner)
+
+        osmids.append(element["id"])
+        element_types.append(element["type"])
+
+    if not ring_sizes:
+        return gpd.GeoDataFrame(
+            {"osmid": [], "element_type": []}, geometry=[], crs="EPSG:4326"
+        )
 
-            for outer in outers:
-                if len(outer) <= 2:
-                    continue
-                outers_lonlat.append(Polygon([(x["lon"], x["lat"]) for x in outer]))
+    ring_sizes = np.asarray(ring_sizes)
+    ring_feature = np.asarray(ring_feature)
+    ring_inner = np.asarray(ring_inner)
+    rings = shapely.linearrings(
+        np.asarray(coords), indices=np.repeat(np.arange(len(ring_sizes)), ring_sizes)
+    )
 
-            for inner in inners:
-                if len(inner) <= 2:
-                    continue
-                inners_lonlat.append(Polygon([(x["lon"], x["lat"]) for x in inner]))
+    # Each outer ring becomes one polygon; each inner ring becomes a hole of the outer
+    # ring of the same relation that contains it
+    outer_idx = np.flatnonzero(~ring_inner)
+    inner_idx = np.flatnonzero(ring_inner)
+    ring_polygon = np.full(len(rings), -1)
+    ring_polygon[outer_idx] = np.arange(len(outer_idx))
+
+    if len(inner_idx):
+        tree = shapely.STRtree(shapely.polygons(rings[outer_idx]))
+        points = shapely.point_on_surface(shapely.polygons(rings[inner_idx]))
+        inner_pos, outer_pos = tree.query(points, predicate="within")
+        same = ring_feature[inner_idx[inner_pos]] == ring_feature[outer_idx[outer_pos]]
+        inner_pos, outer_pos = inner_pos[same], outer_pos[same]
+        # An inner ring inside several outers of its relation goes to the first one
+        inner_pos, first = np.unique(inner_pos, return_index=True)
+        ring_polygon[inner_idx[inner_pos]] = outer_pos[first]
+
+    # Shells must come before their holes for shapely.polygons
+    keep = np.flatnonzero(ring_polygon >= 0)
+    keep = keep[np.lexsort((ring_inner[keep], ring_polygon[keep]))]
+    polygons = shapely.polygons(rings[keep], indices=ring_polygon[keep])
+    polygon_feature = ring_feature[outer_idx]
+
+    geometries = np.full(len(osmids), None, dtype=object)
+    is_way = np.asarray(element_types) == "way"
+    way_polygons = is_way[polygon_feature]
+    geometries[polygon_feature[way_polygons]] = polygons[way_polygons]
+
+    relation_polygons = ~way_polygons
+    if relation_polygons.any():
+        relation_feature = polygon_feature[relation_polygons]
+        features, relation_indices = np.unique(relation_feature, return_inverse=True)
+        geometries[features] = shapely.multipolygons(
+            polygons[relation_polygons], indices=relation_indices
+        )
 
-            # Create a MultiPoly from the outer, then remove the inners
-            merged_outer = MultiPolygon(outers_lonlat)
-            for inner in inners_lonlat:
-                merged_outer = merged_outer - inner
+    gdf = gpd.GeoDataFrame(
+        {"osmid": osmids, "element_type": element_types},
+        geometry=geometries,
+        crs="EPSG:4326",
+    )
+    # Relations whose outer rings were all degenerate have no geometry
+    return gdf[gdf.geometry.notna()].reset_index(drop=True)
 
-            buildings.append(merged_outer)
 
-    gdf = gpd.GeoDataFrame({"geometry": buildings})
-    return gdf.to_json()
+def osm_geom_to_poly_geojson(osm_data: dict) -> str:
+    return osm_geom_to_gdf(osm_data).to_json()
 
 
 def create_bounding_box_poly(coordinate: Coordinate) -> Polygon:
@@ -100,45 +175,54 @@ def create_bounding_box_poly(coordinate: Coordinate) -> Polygon:
     return poly
 
 
-def get_planet_imagery(api_key: str, geom: Polygon, current_date: str) -> dict:
-    end_date = dateutil.parser.isoparse(current_date)
-    start_date = end_date - relativedelta(years=1)
-
-    query = api.filters.and_filter(
-        api.filters.geom_filter(mapping(geom)),
-        api.filters.date_range("acquired", gte=start_date, lte=end_date),
-        api.filters.range_filter("cloud_cover", lte=0.2),
-        api.filters.permission_filter("assets.ortho_pansharpened:download"),
-        api.filters.string_filter("quality_category", "standard"),
-    )
-
-    request = api.filters.build_search_request(query, ["SkySatCollect"])
-    search_result = requests.post(
-        "https://api.planet.com/data/v1/quick-search",
-        auth=HTTPBasicAuth(api_key, ""),
-        json=request,
+def get_planet_imagery(
+    api_key: str,
+    geom: Polygon,
+    current_date: str,
+    cloud_cover: float = 0.2,
+    item_types=("SkySatCollect",),
+) -> list:
+    # Repeated and nearby searches are answered from the search cache
+    return PlanetSearch.from_env(api_key).search(
+        geom, current_date, cloud_cover, item_types
     )
 
-    search_result_json = json.loads(search_result.text)
-    items = search_result_json["features"]
 
-    # items_iter returns an iterator over API response pages
-    return [
-        {"image_id": i["id"], "timestamp": i["properties"]["published"]} for i in items
-    ]
+def planet_tile_url(image_id: str) -> str:
+    """
+    Returns the Planet tile server url template for a SkySatCollect item. The api key
+    is read here so it never travels through the Celery broker.
+    """
+    return f"https://{{subdomain}}.planet.com/data/v1/SkySatCollect/{image_id}/{{z}}/{{x}}/{{y}}.png?api_key={os.getenv('PLANET_API_KEY')}"
 
 
-def download_planet_imagery(url: str, prepost: str, output_path: Path, job_id: str, bounding_box: Polygon):
+def download_planet_imagery(url: str, prepost: str, output_path: Path, job_id: str, bounding_box: Polygon, item_id: str = None):
     ds = TileDataset(url,
         output_path,
         bounding_box,
         18,
-        job_id)
+        job_id,
+        item_id=item_id,
+        cache=TileCache.from_env(),
+        fetcher=TileFetcher.from_env(url),
+        engine=os.getenv("TILE_FETCH_ENGINE") or "thread",
+        async_fetcher=AsyncTileFetcher.from_env(url),
+        max_extent_degrees=(
+            float(os.getenv("TILE_MAX_EXTENT_DEGREES"))
+            if os.getenv("TILE_MAX_EXTENT_DEGREES")
+            else None
+        ),
+        chunk_tiles=int(os.getenv("TILE_CHUNK_TILES") or 256),
+        chunk_workers=int(os.getenv("TILE_CHUNK_WORKERS") or 2),
+        chunk_output=os.getenv("TILE_CHUNK_OUTPUT") or "gtiff",
+        manifest=TileManifest(output_path / job_id / "tiles" / prepost))
 
     import time
     stime = time.time()
-    memory_file = ds.get_data_from_extent(bounding_box, zoom_level=18)
-    ds.save_memory_file_to_disk(memory_file, prepost)
+    ds.download_extent(bounding_box, prepost, zoom_level=18)
+    ds.fetcher.close()
+    # The merged output is complete, so the per-tile resume data is no longer needed
+    ds.manifest.clear()
     print(f"Fetched imagery in {time.time() - stime} seconds.")
 
 
@@ -156,12 +240,18 @@ def awsddb_client():
     )
 
 
+def _pdb_settings():
+    return (
+        os.getenv("PSDB_HOST"),
+        os.getenv("PSDB_PORT"),
+        os.getenv("PSDB_USER"),
+        os.getenv("PSDB_PASSWORD"),
+        os.getenv("PSDB_DBNAME"),
+    )
+
+
 def rdspostgis_client():
-    host = os.getenv("PSDB_HOST")
-    port = os.getenv("PSDB_PORT")
-    user = os.getenv("PSDB_USER")
-    password = os.getenv("PSDB_PASSWORD")
-    dbname = os.getenv("PSDB_DBNAME")
+    host, port, user, password, dbname = _pdb_settings()
     conn = psycopg2.connect(
         f"host={host} port={port} user={user} password={password} dbname={dbname}"
     )
@@ -169,16 +259,78 @@ def rdspostgis_client():
     return conn
 
 
+# Process-wide connection pools, created lazily. Celery worker processes reset them in
+# worker_process_init so a forked child never reuses its parent's sockets.
+_pool_lock = threading.Lock()
+_sa_engine = None
+_pdb_pool = None
+_pdb_pool_slots = None
+
+
 def rdspostgis_sa_client():
-    host = os.getenv("PSDB_HOST")
-    port = os.getenv("PSDB_PORT")
-    user = os.getenv("PSDB_USER")
-    password = os.getenv("PSDB_PASSWORD")
-    dbname = os.getenv("PSDB_DBNAME")
-    engine = sqlalchemy.create_engine(
-        f"postgresql://{user}:{password}@{host}:{port}/{dbname}"
-    )
-    return engine
+    """
+    Returns the process-wide SQLAlchemy engine, sized by PSDB_POOL_SIZE and
+    PSDB_MAX_OVERFLOW.
+    """
+    global _sa_engine
+    with _pool_lock:
+        if _sa_engine is None:
+            host, port, user, password, dbname = _pdb_settings()
+            _sa_engine = sqlalchemy.create_engine(
+                f"postgresql://{user}:{password}@{host}:{port}/{dbname}",
+                pool_size=int(os.getenv("PSDB_POOL_SIZE") or 5),
+                max_overflow=int(os.getenv("PSDB_MAX_OVERFLOW") or 10),
+                pool_pre_ping=True,
+            )
+        return _sa_engine
+
+
+def _rdspostgis_pool():
+    global _pdb_pool, _pdb_pool_slots
+    with _pool_lock:
+        if _pdb_pool is None:
+            host, port, user, password, dbname = _pdb_settings()
+            maxconn = int(os.getenv("PSDB_POOL_MAX") or 10)
+            _pdb_pool = psycopg2.pool.ThreadedConnectionPool(
+                1,
+                maxconn,
+                f"host={host} port={port} user={user} password={password} dbname={dbname}",
+            )
+            # ThreadedConnectionPool raises when exhausted; the semaphore makes
+            # checkout wait for a free connection instead
+            _pdb_pool_slots = threading.BoundedSemaphore(maxconn)
+        return _pdb_pool, _pdb_pool_slots
+
+
+@contextmanager
+def pdb_connection():
+    """
+    Checks an autocommit psycopg2 connection out of the process-wide pool (bounded by
+    PSDB_POOL_MAX) for the duration of the block. Safe to use from any thread.
+    """
+    pool, slots = _rdspostgis_pool()
+    with slots:
+        conn = pool.getconn()
+        try:
+            conn.autocommit = True
+            yield conn
+        finally:
+            pool.putconn(conn, close=bool(conn.closed))
+
+
+def reset_pdb_pools():
+    """
+    Drops the process-wide pools without closing their connections. Call this in a
+    freshly forked process: the sockets belong to the parent, and closing them here
+    would terminate the parent's sessions.
+    """
+    global _sa_engine, _pdb_pool, _pdb_pool_slots
+    with _pool_lock:
+        if _sa_engine is not None:
+            _sa_engine.dispose(close=False)
+        _sa_engine = None
+        _pdb_pool = None
+        _pdb_pool_slots = None
 
 
 def check_postgres_table_exists(conn, table_name):
@@ -259,6 +411,126 @@ def create_postgres_tables(conn):
                 )"""
             )
 
+    migrate_postgres_schema(conn)
+
+
+# Schema changes applied on top of the tables above, in order. Each entry is
+# (version, description, statements); add new ones to the end and never edit one that
+# has shipped. Statements should be idempotent since the tables may predate tracking.
+PDB_MIGRATIONS = [
+    (
+        1,
+        "uid indexes on the per-job polygon tables",
+        [
+            "CREATE INDEX IF NOT EXISTS xviewui_osm_polys_uid_idx ON xviewui_osm_polys (uid)",
+            "CREATE INDEX IF NOT EXISTS xviewui_results_uid_idx ON xviewui_results (uid)",
+        ],
+    ),
+    (
+        2,
+        "GiST indexes on polygon geometries",
+        [
+            "CREATE INDEX IF NOT EXISTS xviewui_osm_polys_geometry_idx ON xviewui_osm_polys USING GIST (geometry)",
+            "CREATE INDEX IF NOT EXISTS xviewui_results_geometry_idx ON xviewui_results USING GIST (geometry)",
+            "ANALYZE xviewui_osm_polys",
+            "ANALYZE xviewui_results",
+        ],
+    ),
+    (
+        3,
+        "OSM footprint tile cache",
+        [
+            """CREATE TABLE IF NOT EXISTS xviewui_osm_tiles (
+                namespace text NOT NULL,
+                quadkey text NOT NULL,
+                fetched_at timestamptz NOT NULL DEFAULT now(),
+                PRIMARY KEY (namespace, quadkey)
+            )""",
+            """CREATE TABLE IF NOT EXISTS xviewui_osm_tile_polys (
+                namespace text NOT NULL,
+                quadkey text NOT NULL,
+                element_type text NOT NULL,
+                osmid text NOT NULL,
+                geometry geometry(Geometry,4326) NOT NULL
+            )""",
+            "CREATE INDEX IF NOT EXISTS xviewui_osm_tile_polys_tile_idx ON xviewui_osm_tile_polys (namespace, quadkey)",
+        ],
+    ),
+    (
+        4,
+        "job fingerprints for deduplicating assessments",
+        [
+            """CREATE TABLE IF NOT EXISTS xviewui_job_fingerprints (
+                uid uuid PRIMARY KEY,
+                fingerprint text NOT NULL,
+                imagery_fingerprint text NOT NULL,
+                bbox geometry(Polygon,4326) NOT NULL,
+                source_uid uuid,
+                created_at timestamptz NOT NULL DEFAULT now()
+            )""",
+            "CREATE INDEX IF NOT EXISTS xviewui_job_fingerprints_fingerprint_idx ON xviewui_job_fingerprints (fingerprint)",
+            "CREATE INDEX IF NOT EXISTS xviewui_job_fingerprints_imagery_idx ON xviewui_job_fingerprints (imagery_fingerprint)",
+            "CREATE INDEX IF NOT EXISTS xviewui_job_fingerprints_source_idx ON xviewui_job_fingerprints (source_uid)",
+        ],
+    ),
+    (
+        5,
+        "results version per job for invalidating cached tiles",
+        [
+            "ALTER TABLE xviewui_status ADD COLUMN IF NOT EXISTS results_version integer NOT NULL DEFAULT 0",
+        ],
+    ),
+]
+
+# Arbitrary key for the advisory lock serialising migrations across API processes
+PDB_MIGRATION_LOCK = 0x78766965
+
+
+def migrate_postgres_schema(conn):
+    """
+    Brings an existing database up to the latest entry in PDB_MIGRATIONS, recording
+    applied versions in xviewui_schema_version. Each migration runs in its own
+    transaction, and an advisory lock keeps concurrently starting processes from
+    applying the same one twice.
+    """
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_lock(%s)", (PDB_MIGRATION_LOCK,))
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS xviewui_schema_version (
+                    version integer PRIMARY KEY,
+                    description text NOT NULL,
+                    applied_at timestamptz NOT NULL DEFAULT now()
+                )"""
+            )
+            cur.execute("SELECT COALESCE(MAX(version), 0) FROM xviewui_schema_version")
+            current = cur.fetchone()[0]
+
+        for version, description, statements in PDB_MIGRATIONS:
+            if version <= current:
+                continue
+
+            print(f"Applying schema migration {version}: {description}")
+            conn.autocommit = False
+            with conn:
+                with conn.cursor() as cur:
+                    for statement in statements:
+                        cur.execute(statement)
+                    cur.execute(
+                        "INSERT INTO xviewui_schema_version (version, description) VALUES (%s, %s)",
+                        (version, description),
+                    )
+            conn.autocommit = True
+    finally:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (PDB_MIGRATION_LOCK,))
+        conn.autocommit = autocommit
+
 
 def insert_pdb_coordinates(conn, uid, item):
     with conn.cursor() as cur:
@@ -286,16 +558,30 @@ def insert_pdb_status(conn, uid, status):
             );
             """
         )
+    rediscache.set_status(uid, status)
 
 
 def update_pdb_status(conn, uid, status):
+    # Jobs attached to this one (see jobdedup) follow its status until its results
+    # have been cloned to them
     with conn.cursor() as cur:
         cur.execute(
             f"""UPDATE xviewui_status
             SET status = '{status}'
-            WHERE uid = '{uid}';
+            WHERE uid = '{uid}'
+            OR (
+                uid IN (
+                    SELECT uid FROM xviewui_job_fingerprints
+                    WHERE source_uid = '{uid}'
+                )
+                AND status <> 'done'
+            )
+            RETURNING uid;
             """
         )
+        uids = [row[0] for row in cur.fetchall()]
+    for updated_uid in uids or [uid]:
+        rediscache.set_status(updated_uid, status)
 
 def get_pdb_coordinate(conn, uid):
     with conn.cursor() as cur:
@@ -330,6 +616,7 @@ def get_pdb_status(conn, uid):
         return record[1]
 
 def insert_pdb_planet_result(conn, uid, planet_response):
+    # A job's imagery can be searched again, e.g. for another date
     with conn.cursor() as cur:
         cur.execute(
             f"""INSERT INTO xviewui_planet_api (uid, planet_response)
@@ -337,7 +624,8 @@ def insert_pdb_planet_result(conn, uid, planet_response):
             (
                 '{uid}',
                 '{planet_response}'
-            );
+            )
+            ON CONFLICT (uid) DO UPDATE SET planet_response = EXCLUDED.planet_response;
             """
         )
 
@@ -353,4 +641,73 @@ def insert_pdb_selected_imagery(conn, uid, pre_image_id, post_image_id):
                 '{post_image_id}'
             );
             """
-        )
\ No newline at end of file
+        )
+
+def copy_pdb_polygons(cur, table, df, geometry):
+    """
+    Streams rows into table with COPY ... FROM STDIN as CSV, with the geometry column
+    encoded as hex EWKB, which is a lot cheaper than the batched INSERTs of to_postgis.
+
+        Parameters:
+            table (str): Table to load into
+            df (DataFrame): Non-geometry columns, named as in the table
+            geometry (GeoSeries): Geometries of the rows, in EPSG 4326
+    """
+    geoms = shapely.set_srid(np.asarray(geometry.values), 4326)
+
+    df = df.copy()
+    df["geometry"] = shapely.to_wkb(geoms, hex=True, include_srid=True)
+
+    buf = io.StringIO()
+    df.to_csv(buf, header=False, index=False)
+    buf.seek(0)
+
+    cur.copy_expert(
+        psycopg2.sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)")
+        .format(
+            psycopg2.sql.Identifier(table),
+            psycopg2.sql.SQL(", ").join(map(psycopg2.sql.Identifier, df.columns)),
+        )
+        .as_string(cur),
+        buf,
+    )
+
+
+def replace_pdb_job_polygons(conn, table, uid, gdf, columns):
+    """
+    Replaces all of a job's rows in table with the rows of gdf in one transaction, so a
+    re-run task overwrites its earlier output instead of appending a second copy. Rows
+    are loaded with copy_pdb_polygons, and the job's results_version is bumped so
+    tiles cached for the old rows are no longer served.
+
+        Parameters:
+            table (str): One of the per-job polygon tables, e.g. xviewui_results
+            uid (str): Job ID the rows belong to
+            gdf (GeoDataFrame): Rows to load, in EPSG 4326
+            columns (list): Non-geometry columns of gdf to load alongside uid
+    """
+    df = gdf[columns].copy()
+    df.insert(0, "uid", str(uid))
+
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    psycopg2.sql.SQL("DELETE FROM {} WHERE uid = %s").format(
+                        psycopg2.sql.Identifier(table)
+                    ),
+                    (str(uid),),
+                )
+                copy_pdb_polygons(cur, table, df, gdf.geometry)
+                bump_pdb_results_version(cur, uid)
+    finally:
+        conn.autocommit = autocommit
+
+
+def bump_pdb_results_version(cur, uid):
+    cur.execute(
+        "UPDATE xviewui_status SET results_version = results_version + 1 WHERE uid = %s",
+        (str(uid),),
+    )
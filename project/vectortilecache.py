@@ -0,0 +1,67 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+
+class VectorTileCache:
+    """
+    A bounded in-memory LRU cache of encoded Mapbox vector tiles.
+
+    Entries are keyed by (job_id, version, z, x, y) and hold the tile bytes together
+    with their ETag. Only tiles for finished jobs should be put here, under the job's
+    results version, so tiles of results that were stored again are never served and
+    age out. Once the cached tiles add up to more than max_bytes the least recently
+    used ones are dropped.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()
+
+    @classmethod
+    def from_env(cls):
+        """
+        Builds a VectorTileCache using MVT_CACHE_MAX_BYTES when it is set.
+        """
+        max_bytes = os.getenv("MVT_CACHE_MAX_BYTES")
+        if max_bytes:
+            return cls(int(max_bytes))
+        return cls()
+
+    @staticmethod
+    def etag(data):
+        return f'"{hashlib.blake2b(data, digest_size=16).hexdigest()}"'
+
+    def get(self, job_id, version, z, x, y):
+        """
+        Returns
+            (data, etag) for the cached tile, or None on a miss
+        """
+        key = (job_id, version, z, x, y)
+        entry = self._tiles.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._tiles.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, job_id, version, z, x, y, data, etag=None):
+        if len(data) > self.max_bytes:
+            return
+
+        key = (job_id, version, z, x, y)
+        old = self._tiles.pop(key, None)
+        if old is not None:
+            self.size -= len(old[0])
+
+        self._tiles[key] = (data, etag or self.etag(data))
+        self.size += len(data)
+
+        while self.size > self.max_bytes:
+            _, (evicted, _) = self._tiles.popitem(last=False)
+            self.size -= len(evicted)
@@ -3,18 +3,30 @@ import os
 import subprocess
 import sys
 from decimal import Decimal
+from pathlib import Path
 
 import geopandas as gpd
-import osmnx as ox
 from celery import Celery
+from celery.signals import worker_process_init
 from shapely.geometry.multipolygon import MultiPolygon
 from shapely.geometry.polygon import Polygon
 
+from chips import ChipPipeline
+from damagescore import score_footprints
+import inference
+from inference import InferenceUnavailable
+from jobdedup import finish_pdb_job
+from osmcache import OsmFootprintCache, fetch_osm_footprints
+from osmextract import OsmExtract
+from schemas.coordinate import Coordinate
 from schemas.osmgeojson import OsmGeoJson
 from schemas.routes import SearchOsmPolygons
-from utils import (awsddb_client, insert_pdb_status, order_coordinate,
-                   osm_geom_to_poly_geojson, rdspostgis_client,
-                   rdspostgis_sa_client, update_pdb_status)
+from tilefetcher import TileFetchError
+from utils import (awsddb_client, create_bounding_box_poly,
+                   download_planet_imagery, insert_pdb_status,
+                   order_coordinate, osm_geom_to_poly_geojson,
+                   pdb_connection, planet_tile_url, replace_pdb_job_polygons,
+                   reset_pdb_pools, update_pdb_status)
 
 STATE_START = "start"
 STATE_END = "end"
@@ -30,7 +42,12 @@ celery.conf.result_backend = os.environ.get(
 )
 
 #ddb = awsddb_client()
-#conn = rdspostgis_client()
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    # Each prefork child builds its own connection pools on first use
+    reset_pdb_pools()
 
 
 def parse_status(state):
@@ -45,10 +62,10 @@ def make_status(task_name, state):
 
 
 def publish_task_status(job_id, task_name, state):
-    conn = rdspostgis_client()
     task_status = make_status(task_name, state)
     print(f"Publishing task status {task_status} for job_id={job_id}")
-    update_pdb_status(conn, job_id, task_status)
+    with pdb_connection() as conn:
+        update_pdb_status(conn, job_id, task_status)
 
 
 @celery.task()
@@ -63,19 +80,28 @@ def get_osm_polys(self,
 ) -> dict:
     publish_task_status(job_id, self.request.task, STATE_START)
     
-    gdf = ox.geometries_from_bbox(bbox[0], bbox[1], bbox[2], bbox[3], tags=osm_tags)
+    # bbox is (north, south, east, west). OSM_SOURCE=extract reads footprints from a
+    # local extract built with osmextract.py; otherwise they come from Overpass, and
+    # repeat jobs in the same area are served from the footprint cache if configured
+    if os.getenv("OSM_SOURCE") == "extract":
+        gdf = OsmExtract.from_env().get_footprints(*bbox, tags=osm_tags)
+    else:
+        cache = OsmFootprintCache.from_env()
+        if cache is not None:
+            gdf = cache.get_footprints(*bbox, tags=osm_tags)
+        else:
+            gdf = fetch_osm_footprints(*bbox, tags=osm_tags)
 
     cols = ["geometry", "osmid"]
-    gdf = gdf.reset_index()
-    gdf = gdf.loc[gdf.element_type != "node", cols]
+    gdf = gdf[cols].copy()
     gdf["uid"] = job_id
 
     gdf["geometry"] = [MultiPolygon([feature]) if isinstance(feature, Polygon) else feature for feature in gdf["geometry"]]
 
     gdf.to_file(out_file)
 
-    engine = rdspostgis_sa_client()
-    gdf.to_postgis("xviewui_osm_polys", engine, if_exists="append")
+    with pdb_connection() as conn:
+        replace_pdb_job_polygons(conn, "xviewui_osm_polys", job_id, gdf, ["osmid"])
 
     item = json.loads(gdf.reset_index().to_json(), parse_float=Decimal)
     # Todo: add CRS info to geojson
@@ -84,27 +110,84 @@ def get_osm_polys(self,
     return item
 
 
-@celery.task()
-def get_imagery():
-    pass
+@celery.task(bind=True, autoretry_for=(TileFetchError,), retry_backoff=True, max_retries=3)
+def get_imagery(self, job_id: str, image_id: str, prepost: str, coordinate: dict) -> None:
+    publish_task_status(job_id, self.request.task, STATE_START)
+
+    bounding_box = create_bounding_box_poly(Coordinate(**coordinate))
+    output_dir_path = Path(os.getenv("PLANET_IMAGERY_OUTPUT_DIR"))
+
+    download_planet_imagery(
+        planet_tile_url(image_id),
+        prepost,
+        output_dir_path,
+        job_id,
+        bounding_box,
+        item_id=image_id,
+    )
+
+    publish_task_status(job_id, self.request.task, STATE_END)
 
 
 @celery.task(bind=True)
 def run_xv(self, job_id: str, args: list) -> None:
     publish_task_status(job_id, self.request.task, STATE_START)
 
-    subprocess.run(
-        [
-            "conda",
-            "run",
-            "-n",
-            "xview2",
-            "python",
-            "/home/ubuntu/xView2_FDNY/handler.py",
-        ]
-        + args
+    # Prefer the warm inference server; start the handler from scratch only if none
+    # is running. Either way a failed run fails the task
+    try:
+        inference.run(args)
+    except InferenceUnavailable as e:
+        print(f"{e}, falling back to conda run")
+        subprocess.run(
+            [
+                "conda",
+                "run",
+                "-n",
+                "xview2",
+                "python",
+                "/home/ubuntu/xView2_FDNY/handler.py",
+            ]
+            + args,
+            check=True,
+        )
+
+    publish_task_status(job_id, self.request.task, STATE_END)
+
+
+def merged_mosaic_path(job_dir: Path, job_id: str, prepost: str) -> Path:
+    # With TILE_CHUNK_OUTPUT=vrt, large extents are merged into a VRT instead
+    path = job_dir / prepost / f"{job_id}_{prepost}_merged.tif"
+    if path.exists():
+        return path
+    return path.with_suffix(".vrt")
+
+
+@celery.task(bind=True)
+def run_chips(self, job_id: str, osm_file: str, out_file: str) -> None:
+    """
+    Backend-side alternative to run_xv: scores the chips of the pre/post mosaics that
+    contain buildings and writes one damage score per OSM footprint to out_file, in
+    the same damage.geojson layout store_results reads.
+    """
+    publish_task_status(job_id, self.request.task, STATE_START)
+
+    job_dir = Path(os.getenv("PLANET_IMAGERY_OUTPUT_DIR")) / job_id
+    damage_raster = job_dir / "output" / "raster" / "damage.tif"
+    damage_raster.parent.mkdir(parents=True, exist_ok=True)
+
+    footprints = gpd.read_file(osm_file)
+    ChipPipeline.from_env().run(
+        merged_mosaic_path(job_dir, job_id, "pre"),
+        merged_mosaic_path(job_dir, job_id, "post"),
+        footprints,
+        damage_raster,
     )
 
+    gdf = score_footprints(damage_raster, footprints)
+    Path(out_file).parent.mkdir(parents=True, exist_ok=True)
+    gdf.to_file(out_file, driver="GeoJSON")
+
     publish_task_status(job_id, self.request.task, STATE_END)
 
 
@@ -118,13 +201,12 @@ def store_results(self, in_file: str, job_id: str):
 
     gdf["geometry"] = [MultiPolygon([feature]) if isinstance(feature, Polygon) else feature for feature in gdf["geometry"]]
 
-    # Push results to Postgres
-    engine = rdspostgis_sa_client()
-    gdf.to_postgis("xviewui_results", engine, if_exists="append")
-
-    # Update job status
-    conn = rdspostgis_client()
-    update_pdb_status(conn, job_id, "done")
+    # Push results to Postgres and update job status
+    columns = [c for c in ("osmid", "dmg", "area") if c in gdf.columns]
+    with pdb_connection() as conn:
+        replace_pdb_job_polygons(conn, "xviewui_results", job_id, gdf, columns)
+        # Also hands the results to any identical jobs that attached to this one
+        finish_pdb_job(conn, job_id)
     #publish_task_status(job_id, self.request.task, STATE_END)
 
     return